@@ -1,14 +1,25 @@
 import os
-from zipfile import ZipFile
+import re
+import json
 import logging
 import shutil
-import requests
 import queue
 import secrets
+from collections import defaultdict
 from datetime import datetime
 from pathlib import Path
-from flask import Flask, request, jsonify
+from typing import Dict, List, Optional
+from zipfile import BadZipFile, ZipFile
+from flask import Flask, Response, request, jsonify
+from dispatcher.delivery import ResultDelivery
 from dispatcher.dispatcher import Dispatcher
+from dispatcher.exception import (
+    DuplicatedSubmissionIdError,
+    RequestNotSentError,
+)
+from dispatcher.metrics import timed
+from dispatcher.remote import elect
+from dispatcher.store import BlobStore, EntryTooLargeError
 
 logging.basicConfig(filename='logs/sandbox.log')
 
@@ -31,21 +42,44 @@ SUBMISSION_BACKUP_DIR = Path(
         'SUBMISSION_BACKUP_DIR',
         'submissions.bk',
     ))
+# results failed to send, will be re-sent later
+SUBMISSION_OUTBOX_DIR = Path(
+    os.getenv(
+        'SUBMISSION_OUTBOX_DIR',
+        'submissions.outbox',
+    ))
 SUBMISSION_HOST_DIR = os.getenv(
     'SUBMISSION_HOST_DIR',
     '/submissions',
 )
+# content-addressed testcase / attachment storage
+STORE_DIR = Path(os.getenv(
+    'STORE_DIR',
+    'store',
+))
+STORE_MAX_SIZE = int(os.getenv(
+    'STORE_MAX_SIZE',
+    2**30,
+))
+# re-read store directory to see data of other workers
+STORE_RESCAN_INTERVAL = float(os.getenv(
+    'STORE_RESCAN_INTERVAL',
+    60,
+))
 # check
 if SUBMISSION_DIR == SUBMISSION_BACKUP_DIR:
     logger.error('use the same dir for submission and backup!')
 # create directory
 SUBMISSION_DIR.mkdir(exist_ok=True)
 SUBMISSION_BACKUP_DIR.mkdir(exist_ok=True)
+STORE = BlobStore(STORE_DIR, STORE_MAX_SIZE, STORE_RESCAN_INTERVAL)
 # backend config
 BACKEND_API = os.environ.get(
     'BACKEND_API',
     f'http://web:8080',
 )
+# used to validate ids in batch submission
+SUBMISSION_ID_PATTERN = re.compile(r'[\w\-]+')
 # sandbox token
 SANDBOX_TOKEN = os.getenv(
     'SANDBOX_TOKEN',
@@ -68,22 +102,9 @@ def recieve_result(
     submission_id: str,
     data: dict,
 ):
-    data['token'] = SANDBOX_TOKEN
-    # extract files
-    files = [(
-        'files',
-        (f.name.split('/')[-1], f, None),
-    ) for f in data['files']]
-    del data['files']
-    logger.info(f'send {submission_id} to BE server')
-    resp = requests.put(
-        f'{BACKEND_API}/submission/{submission_id}/complete',
-        data=data,
-        files=files,
-    )
-    logger.debug(f'get BE response: [{resp.status_code}] {resp.text}', )
+    ok = DELIVERY.send(submission_id, data)
     # clear
-    if resp.status_code == 200 and app.logger.level != logging.DEBUG:
+    if ok and app.logger.level != logging.DEBUG:
         clean_data(submission_id)
     # copy to another place
     else:
@@ -96,39 +117,150 @@ DISPATCHER_CONFIG = os.environ.get(
     'DISPATCHER_CONFIG',
     '.config/dispatcher.json',
 )
-DISPATCHER = Dispatcher(
-    dispatcher_config=DISPATCHER_CONFIG,
-    on_complete=recieve_result,
+CONFIG = Dispatcher.load_config(DISPATCHER_CONFIG)
+DELIVERY = ResultDelivery(
+    backend_api=BACKEND_API,
+    token=SANDBOX_TOKEN,
+    outbox_dir=SUBMISSION_OUTBOX_DIR,
+    pool_size=CONFIG.get('delivery_workers', 4),
+    retries=CONFIG.get('delivery_retries', 3),
+    backoff=CONFIG.get('delivery_backoff', 0.5),
+    timeout=CONFIG.get('delivery_timeout', 30),
+    resend_interval=CONFIG.get('resend_interval', 30),
+    batch_size=CONFIG.get('delivery_batch_size', 1),
+    batch_window=CONFIG.get('delivery_batch_window', 0.1),
+)
+
+
+def create_dispatcher():
+    # only the worker running dispatcher sends results
+    DELIVERY.start()
+    return Dispatcher(
+        dispatcher_config=DISPATCHER_CONFIG,
+        on_complete=recieve_result,
+    )
+
+
+# only one worker process runs the dispatcher, others forward to it
+DISPATCHER_LOCK = os.getenv(
+    'DISPATCHER_LOCK',
+    'dispatcher.lock',
+)
+DISPATCHER_ADDRESS = os.getenv(
+    'DISPATCHER_ADDRESS',
+    'dispatcher.sock',
 )
-DISPATCHER.start()
+DISPATCHER = elect(
+    lock_path=DISPATCHER_LOCK,
+    address=DISPATCHER_ADDRESS,
+    authkey=SANDBOX_TOKEN.encode(),
+    factory=create_dispatcher,
+)
+
+
+def prepare_submission(
+    submission_id: str,
+    testcase_hash: Optional[str],
+    att_hashes: Dict[str, str],
+) -> List[str]:
+    '''
+    make submission directory with stored data
+
+    Returns:
+        digests not found in store, directory is not created if any
+    '''
+    missing = [
+        h for h in (testcase_hash, *att_hashes.values())
+        if h is not None and not STORE.has(h)
+    ]
+    if len(missing):
+        return missing
+    submission_dir = SUBMISSION_DIR / submission_id
+    submission_dir.mkdir()
+    try:
+        for name, digest in att_hashes.items():
+            STORE.link(digest, submission_dir / name)
+        if testcase_hash is not None:
+            STORE.link(testcase_hash, submission_dir)
+    except KeyError as e:
+        # evicted just now
+        clean_data(submission_id)
+        return [e.args[0]]
+    return []
+
+
+def missing_data(digests):
+    return jsonify({
+        'status': 'err',
+        'msg': 'data not found, please upload it.',
+        'data': {
+            'missing': digests,
+        },
+    }), 404
 
 
 @app.route('/<submission_id>', methods=['POST'])
 def submit(submission_id):
-    token = request.values['token']
+    # {phase: seconds}, passed to dispatcher
+    trace = {}
+    with timed(trace, 'parse'):
+        token = request.values['token']
     if not secrets.compare_digest(token, SANDBOX_TOKEN):
         logger.debug(f'get invalid token: {token}')
         return 'invalid token', 403
-    # make submission directory
-    submission_dir = SUBMISSION_DIR / submission_id
-    submission_dir.mkdir()
-    # save attachments
-    atts = request.files.getlist('attachments')
-    for a in atts:
-        a.save(submission_dir / a.filename)
-    # save input and output
+    # store uploaded data, or reuse stored one by its sha256
     testcase = request.files.get('testcase')
-    if testcase is not None:
-        with ZipFile(testcase, 'r') as z:
-            z.extractall(submission_dir)
+    testcase_hash = request.values.get('testcaseHash')
+    atts = request.files.getlist('attachments')
+    try:
+        att_hashes = json.loads(request.values.get('attachmentHashes', '{}'))
+        validate_attachments(att_hashes)
+        validate_attachments({a.filename: '' for a in atts})
+        with timed(trace, 'store'):
+            if testcase is not None:
+                testcase_hash = STORE.put_tree(testcase, testcase_hash)
+            for a in atts:
+                att_hashes[a.filename] = STORE.put_file(
+                    a,
+                    att_hashes.get(a.filename),
+                )
+        with timed(trace, 'link'):
+            missing = prepare_submission(
+                submission_id,
+                testcase_hash,
+                att_hashes,
+            )
+    except EntryTooLargeError as e:
+        return str(e), 413
+    except ValueError as e:
+        return str(e), 400
+    except FileExistsError:
+        return f'duplicated submission id {submission_id}.', 400
+    if len(missing):
+        return missing_data(missing)
+    submission_dir = SUBMISSION_DIR / submission_id
     # save source code
     code = request.values['src']
     if type(code) != type(''):
         return 'code should be string', 400
+    # testcase or attachments may have one, it's linked to stored data
+    try:
+        (submission_dir / 'main.py').unlink()
+    except FileNotFoundError:
+        pass
     (submission_dir / 'main.py').write_text(code)
     logger.debug(f'send submission {submission_id} to dispatcher')
     try:
-        DISPATCHER.handle(submission_id)
+        DISPATCHER.handle(
+            submission_id,
+            trace=trace,
+            priority=request.values.get('priority'),
+            owner=request.values.get('owner', ''),
+        )
+    except ValueError as e:
+        # unknown priority class
+        clean_data(submission_id)
+        return str(e), 400
     except queue.Full:
         return jsonify({
             'status': 'err',
@@ -136,6 +268,34 @@ def submit(submission_id):
             'please wait a moment and re-send the submission.',
             'data': None,
         }), 500
+    except RequestNotSentError:
+        logger.error('dispatcher is unavailable')
+        clean_data(submission_id)
+        return jsonify({
+            'status': 'err',
+            'msg': 'dispatcher is restarting now.\n'
+            'please wait a moment and re-send the submission.',
+            'data': None,
+        }), 503
+    except ConnectionError:
+        # it may be queued and kept in journal, don't remove its data
+        logger.error(f'lost dispatcher after sending {submission_id}')
+        return jsonify({
+            'status': 'err',
+            'msg': 'dispatcher is restarting now.\n'
+            'the submission may be queued, its result will be sent if so.',
+            'data': None,
+        }), 503
+    except OSError as e:
+        # journal can't be written
+        logger.error(f'fail to save submission {submission_id} [err={e}]')
+        clean_data(submission_id)
+        return jsonify({
+            'status': 'err',
+            'msg': 'fail to save the submission.\n'
+            'please wait a moment and re-send the submission.',
+            'data': None,
+        }), 500
     return jsonify({
         'status': 'ok',
         'msg': 'ok',
@@ -143,19 +303,167 @@ def submit(submission_id):
     })
 
 
+def validate_attachments(hashes):
+    '''
+    check `attachmentHashes`, names become paths in submission dir
+
+    Raises:
+        ValueError: it's not a {filename: digest} object
+    '''
+    if type(hashes) != dict:
+        raise ValueError('attachmentHashes should be an object')
+    for name, digest in hashes.items():
+        if type(name) != str or type(digest) != str:
+            raise ValueError('attachmentHashes should map names to strings')
+        if '/' in name or name in ('', '.', '..'):
+            raise ValueError(f'invalid attachment name: {name}')
+
+
+def validate_manifest(manifest):
+    '''
+    check types of batch manifest
+
+    Raises:
+        ValueError: manifest is malformed
+    '''
+    if type(manifest) != list:
+        raise ValueError('manifest should be a list')
+    for item in manifest:
+        if type(item) != dict:
+            raise ValueError('manifest item should be an object')
+        if type(item.get('id')) != str:
+            raise ValueError('submission id should be string')
+        validate_attachments(item.get('attachmentHashes', {}))
+        for key in ('testcaseHash', 'priority', 'owner'):
+            if item.get(key) is not None and type(item[key]) != str:
+                raise ValueError(f'{key} should be string')
+
+
+@app.route('/batch', methods=['POST'])
+def submit_batch():
+    '''
+    submit many submissions in one zip. `manifest.json` in it is a list
+    of `{"id": submission_id, "testcaseHash": ..., "attachmentHashes":
+    ..., "priority": ..., "owner": ...}` (all but id are optional), and
+    files of each submission are put in a folder named by its id,
+    including the source `main.py`. those files are written into the
+    submission directory directly, only data referred by hashes comes
+    from store.
+    '''
+    parse_trace = {}
+    with timed(parse_trace, 'parse'):
+        token = request.values['token']
+    if not secrets.compare_digest(token, SANDBOX_TOKEN):
+        logger.debug(f'get invalid token: {token}')
+        return 'invalid token', 403
+    try:
+        z = ZipFile(request.files['submissions'], 'r')
+        manifest = json.loads(z.read('manifest.json'))
+        validate_manifest(manifest)
+    except (KeyError, ValueError, BadZipFile) as e:
+        return f'invalid batch: {e!r}', 400
+    # {submission_id: {filename: zip member}}
+    members = defaultdict(dict)
+    for info in z.infolist():
+        parts = info.filename.split('/')
+        if len(parts) == 2 and parts[1] not in ('', '.', '..') and \
+                not info.is_dir():
+            members[parts[0]][parts[1]] = info
+    results = []
+    accepted = []
+    for item in manifest:
+        submission_id = item['id']
+        result = {'id': submission_id, 'status': 'err'}
+        results.append(result)
+        # every submission waits for the whole request being parsed
+        trace = {**parse_trace}
+        if not SUBMISSION_ID_PATTERN.fullmatch(submission_id):
+            result['msg'] = 'invalid submission id'
+            continue
+        if 'main.py' not in members[submission_id]:
+            result['msg'] = 'main.py not found'
+            continue
+        try:
+            with timed(trace, 'link'):
+                missing = prepare_submission(
+                    submission_id,
+                    item.get('testcaseHash'),
+                    item.get('attachmentHashes', {}),
+                )
+        except (ValueError, FileExistsError) as e:
+            result['msg'] = str(e)
+            continue
+        if len(missing):
+            result['msg'] = 'data not found, please upload it.'
+            result['missing'] = missing
+            continue
+        # files of one submission are rarely shared, don't keep them in
+        # store
+        try:
+            with timed(trace, 'store'):
+                for name, info in members[submission_id].items():
+                    with z.open(info) as src, \
+                            open(SUBMISSION_DIR / submission_id / name,
+                                 'xb') as dest:
+                        shutil.copyfileobj(src, dest)
+        except (OSError, BadZipFile) as e:
+            clean_data(submission_id)
+            result['msg'] = str(e)
+            continue
+        options = {
+            'trace': trace,
+            'priority': item.get('priority'),
+            'owner': item.get('owner', ''),
+        }
+        accepted.append((result, options))
+    logger.debug(f'send {len(accepted)} submissions to dispatcher')
+    try:
+        errors = DISPATCHER.handle_many(
+            [r['id'] for r, _ in accepted],
+            [options for _, options in accepted],
+        )
+    except ConnectionError as e:
+        logger.error(f'dispatcher is unavailable [err={e!r}]')
+        errors = [e] * len(accepted)
+    for (result, _), err in zip(accepted, errors):
+        if err is None:
+            result['status'] = 'ok'
+        else:
+            result['msg'] = f'{err!r}'
+            if isinstance(err, DuplicatedSubmissionIdError):
+                continue
+            # it may be queued if connection is lost after sending
+            if isinstance(err, ConnectionError) and \
+                    not isinstance(err, RequestNotSentError):
+                continue
+            # it's not queued, remove its data
+            clean_data(result['id'])
+    return jsonify({
+        'status': 'ok',
+        'msg': 'ok',
+        'data': results,
+    })
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    try:
+        text = DISPATCHER.export_metrics()
+    except ConnectionError:
+        return 'dispatcher is unavailable', 503
+    return Response(text, content_type='text/plain; version=0.0.4')
+
+
 @app.route('/status', methods=['GET'])
 def status():
-    ret = {
-        'load': DISPATCHER.queue.qsize() / DISPATCHER.max_task_count,
-    }
+    try:
+        ret = DISPATCHER.status()
+    except ConnectionError:
+        return jsonify({'running': False}), 503
     # if token is provided
     if secrets.compare_digest(SANDBOX_TOKEN, request.args.get('token', '')):
-        ret.update({
-            'queueSize': DISPATCHER.queue.qsize(),
-            'maxTaskCount': DISPATCHER.max_task_count,
-            'containerCount': DISPATCHER.container_count,
-            'maxContainerCount': DISPATCHER.max_container_count,
-            'submissions': [*DISPATCHER.submission_ids],
-            'running': DISPATCHER.do_run,
-        })
+        ret['store'] = STORE.stats()
+        ret['delivery'] = DELIVERY.stats()
+    else:
+        ret = {'load': ret['load']}
     return jsonify(ret), 200
@@ -0,0 +1,77 @@
+import logging
+import threading
+from typing import Optional
+import docker
+from docker.errors import APIError
+from requests.exceptions import ConnectionError
+
+
+class SharedDockerClient:
+    '''
+    one long-lived docker client shared by dispatcher and every sandbox
+
+    the underlying client is thread-safe, all threads share its
+    connection pool. if the daemon restarts, call `reconnect` and the
+    following `get` will return a fresh client.
+    '''
+    def __init__(self, max_pool_size: int, **ks):
+        self.max_pool_size = max_pool_size
+        # pass to `docker.DockerClient`, or `docker.DockerClient.from_env`
+        # if `base_url` is not given
+        self.ks = ks
+        self.lock = threading.Lock()
+        self.client: Optional[docker.DockerClient] = None
+        self.reconnect_count = 0
+
+    @property
+    def logger(self) -> logging.Logger:
+        return logging.getLogger('gunicorn.error')
+
+    def get(self) -> docker.DockerClient:
+        with self.lock:
+            if self.client is None:
+                if 'base_url' in self.ks:
+                    create = docker.DockerClient
+                else:
+                    create = docker.DockerClient.from_env
+                self.client = create(
+                    max_pool_size=self.max_pool_size,
+                    **self.ks,
+                )
+            return self.client
+
+    def reconnect(self, broken: Optional[docker.DockerClient] = None):
+        '''
+        drop current client, the next `get` will create a new one
+
+        Args:
+            broken: the client that failed. if another thread has already
+                replaced it, nothing will be done.
+        '''
+        with self.lock:
+            if self.client is None:
+                return
+            if broken is not None and broken is not self.client:
+                return
+            client, self.client = self.client, None
+            self.reconnect_count += 1
+        self.logger.warning('Reconnect to docker daemon')
+        try:
+            client.close()
+        except Exception as e:
+            self.logger.debug(f'Fail to close docker client [err={e}]')
+
+    def ping(self) -> bool:
+        '''
+        check daemon availability, reconnect once if it's unreachable
+        '''
+        client = self.get()
+        try:
+            return client.ping()
+        except (ConnectionError, APIError):
+            self.reconnect(client)
+        try:
+            return self.get().ping()
+        except (ConnectionError, APIError) as e:
+            self.logger.error(f'Docker daemon unavailable [err={e}]')
+            return False
@@ -0,0 +1,56 @@
+from typing import List, Optional, Union
+
+
+class CpusetSlots:
+    '''
+    split cores into fixed groups, each running container gets one group
+    of dedicated cores
+    '''
+    def __init__(self, cores: Union[str, List[int]], cores_per_slot: int = 1):
+        if isinstance(cores, str):
+            cores = self.parse(cores)
+        if cores_per_slot < 1 or len(cores) < cores_per_slot:
+            raise ValueError(
+                f'can not split {len(cores)} cores into '
+                f'slots of {cores_per_slot} cores', )
+        # remaining cores not enough for a slot are left unused
+        slot_count = len(cores) // cores_per_slot
+        self.slots = [
+            cores[i * cores_per_slot:(i + 1) * cores_per_slot]
+            for i in range(slot_count)
+        ]
+        self.free = set(range(len(self.slots)))
+
+    @classmethod
+    def parse(cls, cpuset: str) -> List[int]:
+        '''
+        parse cpuset notation used by docker / linux, e.g. `0-3,8`
+        '''
+        cores = []
+        for part in cpuset.split(','):
+            if '-' in part:
+                start, end = part.split('-')
+                cores += range(int(start), int(end) + 1)
+            else:
+                cores.append(int(part))
+        return cores
+
+    def available(self) -> bool:
+        return len(self.free) > 0
+
+    def acquire(self) -> Optional[int]:
+        '''
+        Returns:
+            the lowest free slot id, None if all are in use
+        '''
+        if not self.free:
+            return None
+        slot = min(self.free)
+        self.free.remove(slot)
+        return slot
+
+    def release(self, slot: int):
+        self.free.add(slot)
+
+    def cpuset(self, slot: int) -> str:
+        return ','.join(map(str, self.slots[slot]))
@@ -0,0 +1,379 @@
+import json
+import logging
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import BinaryIO, Callable, List, Optional, Tuple
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class PendingResult:
+    '''
+    a result waiting to be sent in a batch
+    '''
+    def __init__(
+        self,
+        submission_id: str,
+        data: dict,
+        files: List[Tuple[str, BinaryIO]],
+    ):
+        self.submission_id = submission_id
+        self.data = data
+        self.files = files
+        # status code of the batch request
+        self.status_code = None
+        self.done = threading.Event()
+
+
+class ResultDelivery:
+    '''
+    send judge results to backend
+
+    requests share a keep-alive session and are retried with exponential
+    backoff. results which still fail are saved in `outbox_dir` and
+    re-sent by a background thread until backend accepts them.
+
+    if `batch_size` > 1, results finished within `batch_window` seconds
+    are sent in one request, results are sent one by one again if
+    backend doesn't accept the batch.
+    '''
+    def __init__(
+        self,
+        backend_api: str,
+        token: str,
+        outbox_dir: Path,
+        pool_size: int = 4,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 30,
+        resend_interval: float = 30,
+        batch_size: int = 1,
+        batch_window: float = 0.1,
+    ):
+        self.backend_api = backend_api
+        self.token = token
+        self.outbox_dir = Path(outbox_dir)
+        self.outbox_dir.mkdir(exist_ok=True)
+        # at most `pool_size` requests at the same time
+        self.slots = threading.BoundedSemaphore(pool_size)
+        self.session = requests.Session()
+        self.session.mount(
+            'http://',
+            HTTPAdapter(pool_connections=1, pool_maxsize=pool_size),
+        )
+        self.session.mount(
+            'https://',
+            HTTPAdapter(pool_connections=1, pool_maxsize=pool_size),
+        )
+        self.retries = retries
+        self.backoff = backoff  # float:second
+        self.timeout = timeout  # float:second
+        self.resend_interval = resend_interval  # float:second
+        self.resender = None
+        self.batch_size = batch_size
+        self.batch_window = batch_window  # float:second
+        # results waiting to be batched
+        self.batch_cond = threading.Condition()
+        self.batch_buf: List[PendingResult] = []
+        self.batcher = None
+
+    @property
+    def logger(self) -> logging.Logger:
+        return logging.getLogger('gunicorn.error')
+
+    def start(self):
+        '''
+        start re-sending results in outbox
+        '''
+        if self.resender is not None:
+            return
+        self.resender = threading.Thread(target=self.resend, daemon=True)
+        self.resender.start()
+        if self.batch_size > 1:
+            self.batcher = threading.Thread(target=self.batch, daemon=True)
+            self.batcher.start()
+
+    def url(self, submission_id: str) -> str:
+        return f'{self.backend_api}/submission/{submission_id}/complete'
+
+    def batch_url(self) -> str:
+        return f'{self.backend_api}/submission/complete'
+
+    @classmethod
+    def form(cls, data: dict) -> dict:
+        '''
+        encode non-scalar fields (e.g. `cases`) as json, form fields only
+        take strings
+        '''
+        return {
+            k: json.dumps(v) if isinstance(v, (dict, list, tuple)) else v
+            for k, v in data.items()
+        }
+
+    def put(
+        self,
+        submission_id: str,
+        data: dict,
+        files: List[Tuple[str, BinaryIO]],
+    ) -> Optional[int]:
+        '''
+        send result once
+
+        Returns:
+            response status code, None if request failed
+        '''
+        for _, f in files:
+            f.seek(0)
+        try:
+            with self.slots:
+                resp = self.session.put(
+                    self.url(submission_id),
+                    data={
+                        **self.form(data),
+                        'token': self.token,
+                    },
+                    files=[('files', (name, f, None)) for name, f in files],
+                    timeout=self.timeout,
+                )
+        except requests.RequestException as e:
+            self.logger.warning(
+                'Fail to send result '
+                f'[submission_id={submission_id}, err={e}]', )
+            return None
+        self.logger.debug(f'get BE response: [{resp.status_code}] {resp.text}')
+        return resp.status_code
+
+    def batch_put(self, results: List[PendingResult]) -> Optional[int]:
+        '''
+        send results in one request. `results` field is a json list of
+        `{"id": submission_id, "data": data, "files": [filename]}`, and
+        files are named as `<index of result>/<filename>`.
+
+        Returns:
+            response status code, None if request failed
+        '''
+        manifest = []
+        files = []
+        for i, r in enumerate(results):
+            manifest.append({
+                'id': r.submission_id,
+                'data': r.data,
+                'files': [name for name, _ in r.files],
+            })
+            for name, f in r.files:
+                f.seek(0)
+                files.append(('files', (f'{i}/{name}', f, None)))
+        try:
+            with self.slots:
+                resp = self.session.put(
+                    self.batch_url(),
+                    data={
+                        'results': json.dumps(manifest),
+                        'token': self.token,
+                    },
+                    files=files,
+                    timeout=self.timeout,
+                )
+        except requests.RequestException as e:
+            self.logger.warning(f'Fail to send result batch [err={e}]')
+            return None
+        self.logger.debug(
+            f'get BE batch response: [{resp.status_code}] {resp.text}')
+        return resp.status_code
+
+    def retry(self, put: Callable[[], Optional[int]]) -> Optional[int]:
+        '''
+        call `put` until it succeeds or fails with a not retryable error
+
+        Returns:
+            last status code
+        '''
+        for i in range(self.retries + 1):
+            if i:
+                time.sleep(self.backoff * 2**(i - 1))
+            status_code = put()
+            if not self.retryable(status_code):
+                break
+        return status_code
+
+    def batch(self):
+        while True:
+            with self.batch_cond:
+                self.batch_cond.wait_for(lambda: len(self.batch_buf))
+                # wait for more results
+                self.batch_cond.wait_for(
+                    lambda: len(self.batch_buf) >= self.batch_size,
+                    timeout=self.batch_window,
+                )
+                results = self.batch_buf[:self.batch_size]
+                self.batch_buf = self.batch_buf[self.batch_size:]
+            # failed unless backend responds, so results go to outbox
+            status_code = None
+            try:
+                self.logger.info(f'send {len(results)} results to BE server')
+                status_code = self.retry(lambda: self.batch_put(results))
+            except Exception as e:
+                self.logger.error(f'Fail to send result batch [err={e!r}]')
+            finally:
+                for r in results:
+                    r.status_code = status_code
+                    r.done.set()
+
+    def enqueue(
+        self,
+        submission_id: str,
+        data: dict,
+        files: List[Tuple[str, BinaryIO]],
+    ) -> Optional[int]:
+        '''
+        put result into next batch and wait for it being sent
+
+        Returns:
+            status code of the batch request
+        '''
+        result = PendingResult(submission_id, data, files)
+        with self.batch_cond:
+            self.batch_buf.append(result)
+            self.batch_cond.notify_all()
+        if not result.done.wait(self.batch_wait()):
+            self.logger.warning(
+                'Result batch not sent in time '
+                f'[submission_id={submission_id}]', )
+            return None
+        return result.status_code
+
+    def batch_wait(self) -> float:
+        '''
+        longest time (in seconds) a batched result should take, including
+        all retries, and the same again for batches queued before it
+        '''
+        backoff = self.backoff * (2**self.retries - 1)
+        tries = (self.retries + 1) * self.timeout
+        return 2 * (self.batch_window + backoff + tries)
+
+    @classmethod
+    def retryable(cls, status_code: Optional[int]) -> bool:
+        # backend is unreachable or broken, other errors won't be fixed
+        # by sending it again
+        return status_code is None or status_code >= 500
+
+    def send(self, submission_id: str, data: dict) -> bool:
+        '''
+        send result, retry on failure, save it to outbox if all tries fail
+
+        Args:
+            submission_id: the submission's unique id
+            data: sandbox result, `files` is a list of file objects
+        Returns:
+            whether backend accepts it
+        '''
+        data = data.copy()
+        files = [(f.name.split('/')[-1], f) for f in data.pop('files')]
+        if self.batcher is not None:
+            status_code = self.enqueue(submission_id, data, files)
+        else:
+            self.logger.info(f'send {submission_id} to BE server')
+            status_code = self.retry(
+                lambda: self.put(submission_id, data, files))
+        if status_code == 200:
+            return True
+        # e.g. backend doesn't support batch, send it alone
+        if self.batcher is not None and not self.retryable(status_code):
+            self.logger.info(f'send {submission_id} to BE server')
+            status_code = self.retry(
+                lambda: self.put(submission_id, data, files))
+            if status_code == 200:
+                return True
+        if not self.retryable(status_code):
+            self.logger.error(
+                'Result rejected by backend '
+                f'[submission_id={submission_id}, code={status_code}]', )
+            return False
+        self.logger.warning(
+            'Save result to outbox '
+            f'[submission_id={submission_id}]', )
+        self.save(submission_id, data, files)
+        return False
+
+    def save(
+        self,
+        submission_id: str,
+        data: dict,
+        files: List[Tuple[str, BinaryIO]],
+    ):
+        tmp = self.outbox_dir / f'.{submission_id}'
+        shutil.rmtree(tmp, ignore_errors=True)
+        (tmp / 'files').mkdir(parents=True)
+        for name, f in files:
+            f.seek(0)
+            with (tmp / 'files' / name).open('wb') as dest:
+                shutil.copyfileobj(f, dest)
+        (tmp / 'result.json').write_text(json.dumps(data))
+        # only complete results are visible to re-sender
+        shutil.rmtree(self.outbox_dir / submission_id, ignore_errors=True)
+        tmp.rename(self.outbox_dir / submission_id)
+
+    def outbox(self) -> List[Path]:
+        # skip results being saved
+        paths = [
+            p for p in self.outbox_dir.iterdir() if not p.name.startswith('.')
+        ]
+        return sorted(paths, key=lambda p: p.stat().st_mtime)
+
+    def resend(self):
+        while True:
+            time.sleep(self.resend_interval)
+            try:
+                self.drain()
+            except Exception as e:
+                self.logger.error(f'Fail to drain outbox [err={e!r}]')
+
+    def quarantine(self, result_dir: Path):
+        '''
+        move a broken result out of outbox, it's kept for inspection
+        '''
+        dest = self.outbox_dir / '.quarantine' / result_dir.name
+        dest.parent.mkdir(exist_ok=True)
+        shutil.rmtree(dest, ignore_errors=True)
+        result_dir.rename(dest)
+
+    def drain(self):
+        '''
+        send results in outbox until backend fails again
+        '''
+        for result_dir in self.outbox():
+            submission_id = result_dir.name
+            files = []
+            try:
+                data = json.loads((result_dir / 'result.json').read_text())
+                for f in (result_dir / 'files').iterdir():
+                    files.append((f.name, f.open('rb')))
+                status_code = self.put(submission_id, data, files)
+            except (OSError, ValueError) as e:
+                self.logger.error(
+                    'Quarantine broken result in outbox '
+                    f'[submission_id={submission_id}, err={e!r}]', )
+                self.quarantine(result_dir)
+                continue
+            finally:
+                for _, f in files:
+                    f.close()
+            if self.retryable(status_code):
+                # backend is still unavailable, try later
+                break
+            if status_code == 200:
+                self.logger.info(
+                    'Re-send result from outbox '
+                    f'[submission_id={submission_id}]', )
+            else:
+                self.logger.error(
+                    'Result in outbox rejected by backend '
+                    f'[submission_id={submission_id}, code={status_code}]', )
+            shutil.rmtree(result_dir)
+
+    def stats(self) -> dict:
+        return {
+            'outbox': len(self.outbox()),
+        }
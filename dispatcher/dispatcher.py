@@ -1,20 +1,41 @@
 import json
+import math
 import os
 import threading
 import time
 import queue
 import logging
 import textwrap
-from typing import Set
-import docker
+from collections import defaultdict, deque
+from typing import Dict, List, Optional, Set
+from concurrent.futures import Future, ThreadPoolExecutor
 import docker.errors
+from requests.exceptions import ConnectionError
 from pathlib import Path
 from flask import current_app
 from sandbox import Sandbox
 from .exception import *
+from .client import SharedDockerClient
+from .journal import Journal
+from .metrics import Metrics, timed
+from .tuner import ConcurrencyTuner
+from .cpuset import CpusetSlots
+from .scheduler import FairQueue
+from .pool import ContainerPool
+from .hosts import Host, HostRegistry
 
 
 class Dispatcher(threading.Thread):
+    # {field in meta.json: sandbox argument}
+    LIMIT_FIELDS = {
+        'timeLimit': 'time_limit',
+        'memoryLimit': 'mem_limit',
+        'outputSizeLimit': 'output_size_limit',
+        'fileSizeLimit': 'file_size_limit',
+    }
+    # docker rejects memory limit lower than 6 MB
+    MIN_MEM_LIMIT = 6144
+
     def __init__(
         self,
         on_complete,
@@ -23,32 +44,116 @@ class Dispatcher(threading.Thread):
         super().__init__()
         self.testing = False
         # read config
-        config = {}
-        if os.path.exists(dispatcher_config):
-            config = json.load(open(dispatcher_config))
-        else:
-            self.logger.warning(
-                f'dispatcher config not found '
-                f'[path={dispatcher_config}]', )
+        config = self.load_config(dispatcher_config)
         # flag to decided whether the loop should run
         self.do_run = True
         # submission location (inside container)
         self.base_dir = Path(config.get('base_dir', 'submissions'))
         self.base_dir.mkdir(exist_ok=True)
-        # host dir must be the mount point of base dir
-        self.host_dir = Path(config.get('host_dir', '/tmp/submissions'))
         # task queue
         self.max_task_count = config.get('queue_size', 16)
-        # submission queue
-        self.queue = queue.Queue(self.max_task_count)
+        # submission queue, shared fairly by priority classes and owners
+        self.queue = FairQueue(
+            self.max_task_count,
+            weights=config.get(
+                'priority_weights',
+                {
+                    'interactive': 4,
+                    'normal': 2,
+                    'rejudge': 1,
+                },
+            ),
+            default_priority=config.get('default_priority', 'normal'),
+        )
+        # priority class of each queued submission
+        self.priorities: Dict[str, str] = {}
         self.submission_ids: Set[str] = set()
+        # persist queue state, so submissions survive restart
+        self.journal = Journal(
+            config.get('journal_path', 'submissions.journal'))
+        # {filename: sha256} of each submission's data
+        self.input_hashes: Dict[str, Dict[str, str]] = {}
+        # monotonic time each queued submission entered the queue
+        self.enqueue_time: Dict[str, float] = {}
+        # {phase: seconds} of each unfinished submission
+        self.traces: Dict[str, Dict[str, float]] = {}
+        self.metrics = Metrics(config.get('trace_path'))
+        # limits of submissions without meta.json
+        self.default_limits = {
+            'time_limit': config.get('time_limit', 10000),  # 10s
+            'mem_limit': config.get('mem_limit', 128000),  # 128 MB
+            'output_size_limit': config.get('output_size_limit', 4096),
+            'file_size_limit': config.get('file_size_limit', 64 * 10**6),
+        }
+        # sandbox limits of each queued submission
+        self.limits: Dict[str, dict] = {}
+        # image used to judge
+        self.image = config['image']
+        # re-check the image after this many seconds
+        self.image_refresh_interval = config.get(
+            'image_refresh_interval',
+            600,
+        )
+        # judge in a tmpfs of this many bytes instead of container's
+        # writable layer
+        self.tmpfs_size = config.get('tmpfs_size')
+        # run programs by a warm interpreter in pooled containers
+        self.zygote = config.get('zygote', False)
+        # docker daemons running containers, the local one by default
+        hosts = [
+            self.create_host(h, config) for h in config.get('hosts', [{}])
+        ]
+        self.hosts = HostRegistry(
+            hosts,
+            health_interval=config.get('health_interval', 10),
+        )
         # manage containers
-        self.max_container_count = config.get('max_container_count', 8)
+        self.max_container_count = config.get(
+            'max_container_count',
+            sum(h.slots for h in hosts),
+        )
         self.container_count = 0
+        # guard counters updated by worker threads
+        self.lock = threading.Lock()
+        # how many containers can run now, tuned by host load if enabled
+        self.concurrency = self.max_container_count
+        self.admitted = 0
+        # notified when a container releases its resources
+        self.resource_freed = threading.Condition(self.lock)
+        self.tuner = None
+        if config.get('auto_tune', False):
+            self.tuner = ConcurrencyTuner(
+                min_count=1,
+                max_count=self.max_container_count,
+                max_load=config.get('max_load', 1.5),
+                min_free_memory=config.get('min_free_memory', 262144),
+                baseline_decay=config.get('overhead_baseline_decay', 0.01),
+            )
+        self.tune_interval = config.get('tune_interval', 5)
+        # released when a container finished
+        self.slots = threading.BoundedSemaphore(self.max_container_count)
+        # threads running containers, one for each slot
+        self.runners = ThreadPoolExecutor(
+            max_workers=self.max_container_count,
+            thread_name_prefix='runner',
+        )
+        # statistics of queue waiting time (in seconds)
+        self.dispatch_count = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        # {priority: recent queue waiting time}
+        self.queue_waits = defaultdict(lambda: deque(maxlen=1000))
+        # how long the loop blocks before re-checking `do_run`
+        self.wake_interval = config.get('wake_interval', 1)
         # completion handler
         self.on_complete = on_complete
-        # image used to judge
-        self.image = config['image']
+        # threads sending results, so a slow backend won't hold a slot
+        self.delivery_workers = config.get('delivery_workers', 4)
+        self.deliverers = ThreadPoolExecutor(
+            max_workers=self.delivery_workers,
+            thread_name_prefix='delivery',
+        )
+        self.delivery_backlog = 0
 
     @property
     def logger(self) -> logging.Logger:
@@ -57,30 +162,270 @@ class Dispatcher(threading.Thread):
         except RuntimeError:
             return logging.getLogger('gunicorn.error')
 
-    def ensure_image(self):
-        client = docker.client.from_env()
+    @classmethod
+    def load_config(cls, dispatcher_config: str) -> dict:
+        if os.path.exists(dispatcher_config):
+            with open(dispatcher_config) as f:
+                return json.load(f)
+        logging.getLogger('gunicorn.error').warning(
+            f'dispatcher config not found '
+            f'[path={dispatcher_config}]', )
+        return {}
+
+    def create_host(self, host_config: dict, config: dict) -> Host:
+        '''
+        Args:
+            host_config: an item of `hosts` in dispatcher config
+            config: dispatcher config, used for fields `host_config`
+                doesn't give
+        '''
+        host_config = {**config, **host_config}
+        slots = host_config.get(
+            'slots',
+            host_config.get('max_container_count', 8),
+        )
+        # dedicated cores for each container
+        cpusets = None
+        cores_per_container = host_config.get('cores_per_container', 1)
+        if 'cpuset' in host_config:
+            cpusets = CpusetSlots(host_config['cpuset'], cores_per_container)
+        # CPUs given to each container, and the total can be reserved
+        cpu_limit = host_config.get(
+            'cpu_limit',
+            1 if cpusets is None else cores_per_container,
+        )
+        # docker client shared by all threads, by default one connection
+        # for each container, and extra ones for pool and dispatcher
+        client = SharedDockerClient(
+            host_config.get('docker_pool_size', slots + 2),
+            **{
+                k: host_config[k]
+                for k in ('base_url', 'version') if k in host_config
+            },
+        )
+        host = Host(
+            name=host_config.get('name', 'local'),
+            client=client,
+            slots=slots,
+            # containers are packed by their memory limit (in kb)
+            memory_budget=host_config.get(
+                'memory_budget',
+                slots * self.default_limits['mem_limit'],
+            ),
+            cpu_limit=cpu_limit,
+            cpu_budget=host_config.get('cpu_budget', slots * cpu_limit),
+            cpusets=cpusets,
+        )
+        # pre-created containers, one for each slot
+        host.pool = ContainerPool(
+            factory=lambda: self.create_pooled_container(host),
+            size=host_config.get('pool_size', slots),
+        )
+        return host
+
+    def ensure_image(self, host: Host):
+        client = host.client.get()
         try:
             client.images.get(self.image)
         except docker.errors.ImageNotFound:
-            self.logger.info(f'Image not found. Start pulling. [{self.image}]')
+            self.logger.info(
+                'Image not found. Start pulling. '
+                f'[{self.image}, host={host.name}]', )
             client.images.pull(self.image)
+        except ConnectionError:
+            host.client.reconnect(client)
+            raise
+        host.image_checked_at = time.monotonic()
+
+    def image_expired(self, host: Host) -> bool:
+        checked_at = host.image_checked_at
+        return checked_at is None or \
+            time.monotonic() - checked_at >= self.image_refresh_interval
+
+    def refresh_image(self, host: Host):
+        '''
+        ensure image only if the cached check is expired
+
+        Raises:
+            docker.errors.APIError: the image can't be pulled
+        '''
+        if not self.image_expired(host):
+            return
+        with host.image_lock:
+            # checked by another runner while waiting
+            if self.image_expired(host):
+                self.ensure_image(host)
+
+    def create_pooled_container(self, host: Host):
+        client = host.client.get()
+        try:
+            return Sandbox.create_container(
+                client,
+                self.image,
+                self.default_limits['mem_limit'],
+                nano_cpus=int(host.cpu_limit * 10**9),
+                tmpfs_size=self.tmpfs_size,
+                use_zygote=self.zygote,
+            )
+        except ConnectionError:
+            host.client.reconnect(client)
+            raise
 
     def get_path(self, submission_id) -> Path:
         return self.base_dir / submission_id
 
-    def get_host_path(self, submission_id) -> Path:
-        return self.host_dir / submission_id
+    def load_limits(self, submission_path: Path) -> dict:
+        '''
+        read sandbox limits from `meta.json` of a submission, limits not
+        given there use the defaults in dispatcher config. if it has
+        `tasks`, the largest limit among them is used, since they all run
+        in the same container. if every task has `caseCount`, limits of
+        each task are also given as `tasks`, so their testcases can be
+        judged by their own limits.
+        '''
+        limits = {**self.default_limits}
+        meta_path = submission_path / 'meta.json'
+        if not meta_path.exists():
+            return limits
+        try:
+            meta = json.loads(meta_path.read_text())
+            for field, key in self.LIMIT_FIELDS.items():
+                values = [
+                    int(m[field]) for m in (meta, *meta.get('tasks', []))
+                    if field in m
+                ]
+                if len(values):
+                    limits[key] = max(values)
+            tasks = meta.get('tasks', [])
+            if len(tasks) and all('caseCount' in t for t in tasks):
+                limits['tasks'] = [self.task_limits(meta, t) for t in tasks]
+        except (ValueError, TypeError, AttributeError) as e:
+            self.logger.warning(
+                'Invalid meta.json, use default limits '
+                f'[path={meta_path}, err={e!r}]', )
+            return {**self.default_limits}
+        limits['mem_limit'] = max(limits['mem_limit'], self.MIN_MEM_LIMIT)
+        return limits
+
+    def task_limits(self, meta: dict, task: dict) -> dict:
+        '''
+        limits of a task in `meta.json`, fall back to the ones of problem
+        and then the defaults
+        '''
+        limits = {'case_count': int(task['caseCount'])}
+        for field in ('timeLimit', 'memoryLimit'):
+            key = self.LIMIT_FIELDS[field]
+            value = task.get(field, meta.get(field, self.default_limits[key]))
+            limits[key] = int(value)
+        limits['mem_limit'] = max(limits['mem_limit'], self.MIN_MEM_LIMIT)
+        return limits
 
-    def handle(self, submission_id: str) -> bool:
+    def admissible(self, mem_limit: int) -> Optional[Host]:
+        '''
+        Returns:
+            the host to run a container with `mem_limit`, None if it
+            should wait
+        '''
+        if self.admitted >= self.concurrency:
+            return None
+        return self.hosts.pick(mem_limit)
+
+    def reserve(self, limits: dict) -> bool:
+        '''
+        wait until a container with `limits` fits in memory and CPU
+        budget of a host, and concurrency limit. the chosen host is set as
+        `limits['host']`, and if cpuset slots are enabled on it, the
+        assigned one is set as `limits['cpu_slot']`.
+
+        Returns:
+            False if dispatcher is stopped while waiting
+        '''
+        with self.resource_freed:
+            while True:
+                host = self.resource_freed.wait_for(
+                    lambda: self.admissible(limits['mem_limit']),
+                    timeout=self.wake_interval,
+                )
+                if host is not None:
+                    break
+                if not self.do_run:
+                    return False
+            self.admitted += 1
+            cpu_slot = host.reserve(limits['mem_limit'])
+        limits['host'] = host.name
+        if cpu_slot is not None:
+            limits['cpu_slot'] = cpu_slot
+        return True
+
+    def release(
+        self,
+        mem_limit: int,
+        host: str,
+        cpu_slot: Optional[int] = None,
+    ):
+        with self.resource_freed:
+            self.admitted -= 1
+            self.hosts.get(host).release(mem_limit, cpu_slot)
+            self.resource_freed.notify_all()
+
+    def tune(self):
+        '''
+        adjust concurrency limit by host load periodically
+        '''
+        while self.do_run:
+            time.sleep(self.tune_interval)
+            with self.resource_freed:
+                self.concurrency = self.tuner.tune(
+                    self.concurrency,
+                    self.admitted,
+                )
+                self.resource_freed.notify_all()
+
+    def handle(
+        self,
+        submission_id: str,
+        sync: bool = True,
+        trace: Optional[Dict[str, float]] = None,
+        priority: Optional[str] = None,
+        owner: str = '',
+    ) -> bool:
         '''
         handle a submission, save its config and push into task queue
 
         Args:
             submission_id -> str: the submission's unique id
+            sync -> bool: wait for the journal record being saved
+            trace -> dict: {phase: seconds} already spent by the caller
+            priority -> str: priority class, default one if not given
+            owner -> str: user / course sharing the class fairly
         Returns:
             a bool denote whether the submission has successfully put into queue
+        Raises:
+            ValueError: unknown priority class
+            OSError: the journal record failed to be written, the
+                submission is not queued
+        '''
+        priority = self.admit(submission_id, sync, trace, priority, owner)
+        self.enqueue(submission_id, priority, owner)
+        return True
+
+    def admit(
+        self,
+        submission_id: str,
+        sync: bool = True,
+        trace: Optional[Dict[str, float]] = None,
+        priority: Optional[str] = None,
+        owner: str = '',
+    ) -> str:
+        '''
+        check a submission and journal it, arguments are the same as
+        `handle`'s
+
+        Returns:
+            its priority class
         '''
         self.logger.info(f'receive submission {submission_id}.')
+        priority = self.queue.validate(priority)
         submission_path = self.get_path(submission_id)
         # check whether the submission directory exist
         if not submission_path.exists():
@@ -94,18 +439,110 @@ class Dispatcher(threading.Thread):
                 f'duplicated submission id {submission_id}.')
         self.submission_ids.add(submission_id)
         self.logger.debug(f'current submissions {[*self.submission_ids]}')
+        trace = self.traces[submission_id] = {**(trace or {})}
+        with timed(trace, 'enqueue'):
+            self.input_hashes[submission_id] = Sandbox.hash_files(
+                str(submission_path))
+            self.limits[submission_id] = self.load_limits(submission_path)
+            try:
+                self.journal.record(
+                    submission_id,
+                    Journal.ENQUEUE,
+                    sync=sync,
+                    info={
+                        'priority': priority,
+                        'owner': owner,
+                    },
+                )
+            except OSError:
+                # the record is retried later, don't recover it
+                self.drop(submission_id)
+                raise
+        self.priorities[submission_id] = priority
+        return priority
+
+    def enqueue(self, submission_id: str, priority: str, owner: str):
+        '''
+        push an admitted submission into task queue
+
+        Raises:
+            queue.Full: the submission is dropped
+        '''
         try:
-            self.queue.put_nowait(submission_id)
+            self.enqueue_time[submission_id] = time.monotonic()
+            self.queue.put_nowait(submission_id, priority, owner)
             self.logger.debug(
                 'new submission enqueue '
                 f'[submission_id={submission_id}]', )
         except queue.Full as e:
-            self.submission_ids.remove(submission_id)
+            self.drop(submission_id)
             self.logger.warning(
                 'submissino queue is full now, this submission is dropped '
                 f'[submission_id={submission_id}]', )
             raise e
-        return True
+
+    def drop(self, submission_id: str):
+        '''
+        forget a submission which is not queued
+        '''
+        self.submission_ids.remove(submission_id)
+        self.enqueue_time.pop(submission_id, None)
+        self.input_hashes.pop(submission_id, None)
+        self.limits.pop(submission_id, None)
+        self.traces.pop(submission_id, None)
+        self.priorities.pop(submission_id, None)
+        self.journal.record(submission_id, Journal.DROP)
+
+    def handle_many(
+        self,
+        submission_ids: List[str],
+        options: Optional[List[dict]] = None,
+    ) -> list:
+        '''
+        handle several submissions, their journal records are saved together
+
+        Args:
+            submission_ids: the submissions' unique ids
+            options: keyword arguments of `handle` for each submission,
+                e.g. trace and priority
+        Returns:
+            the error raised by handling each submission, None if it's
+            successfully put into queue
+        '''
+        if options is None:
+            options = [{}] * len(submission_ids)
+        ret = []
+        # {index: priority} of journaled ones, queued after being saved
+        admitted = {}
+        for i, (submission_id, ks) in enumerate(zip(submission_ids, options)):
+            try:
+                admitted[i] = self.admit(submission_id, sync=False, **ks)
+                ret.append(None)
+            except (
+                    FileNotFoundError,
+                    NotADirectoryError,
+                    DuplicatedSubmissionIdError,
+                    ValueError,
+            ) as e:
+                ret.append(e)
+        try:
+            self.journal.sync()
+        except OSError as e:
+            self.logger.error(f'Fail to journal submissions [err={e}]')
+            for i in admitted:
+                self.drop(submission_ids[i])
+                ret[i] = e
+            return ret
+        for i, priority in admitted.items():
+            try:
+                self.enqueue(
+                    submission_ids[i],
+                    priority,
+                    options[i].get('owner', ''),
+                )
+            except queue.Full as e:
+                ret[i] = e
+        return ret
 
     def idle(self):
         '''
@@ -118,51 +555,223 @@ class Dispatcher(threading.Thread):
             print('print: ' + msg)
             time.sleep(0.16)
 
-    def cannot_run_submission(self):
-        return any((
-            self.no_testcase(),
-            self.no_slot(),
-        ))
+    def run(self):
+        self.do_run = True
+        self.logger.debug('start dispatcher loop')
+        for host in self.hosts:
+            if not host.client.ping():
+                # wait for health check to bring it back
+                host.healthy = False
+                self.logger.error(
+                    'Cannot connect to docker daemon '
+                    f'[host={host.name}]', )
+                continue
+            try:
+                self.ensure_image(host)
+            except (docker.errors.APIError, ConnectionError) as e:
+                # pulled again once health check brings it back
+                host.healthy = False
+                self.logger.error(
+                    'Fail to prepare image '
+                    f'[host={host.name}, err={e}]', )
+        for host in self.hosts:
+            host.pool.start()
+        self.hosts.start()
+        threading.Thread(target=self.recover, daemon=True).start()
+        if self.tuner is not None:
+            threading.Thread(target=self.tune, daemon=True).start()
+        while self.do_run:
+            # wait for a free slot
+            if not self.slots.acquire(timeout=self.wake_interval):
+                continue
+            # get a submission
+            try:
+                submission_id = self.queue.get(timeout=self.wake_interval)
+            except queue.Empty:
+                self.slots.release()
+                continue
+            limits = {
+                **self.limits.pop(submission_id, self.default_limits),
+            }
+            # wait for enough resource, it's still kept in journal if
+            # dispatcher stops now
+            if not self.reserve(limits):
+                self.slots.release()
+                continue
+            self.record_queue_wait(submission_id)
+            self.journal.record(submission_id, Journal.START)
+            # assign a runner
+            self.runners.submit(
+                self.create_container,
+                submission_id=submission_id,
+                image=self.image,
+                **limits,
+            ).add_done_callback(self.log_exception)
+        # let running submissions finish
+        self.runners.shutdown()
+        self.deliverers.shutdown()
+        for host in self.hosts:
+            host.pool.close()
+        self.journal.close()
+        self.logger.debug('exit dispatcher loop')
 
-    def no_slot(self):
+    def recover(self):
         '''
-        no space for new cotainer now
+        re-enqueue submissions left unfinished by last run
         '''
-        return self.container_count >= self.max_container_count
+        for submission_id in self.journal.pending:
+            if submission_id in self.submission_ids:
+                continue
+            submission_path = self.get_path(submission_id)
+            if not submission_path.is_dir():
+                self.logger.warning(
+                    'Drop unfinished submission without data '
+                    f'[submission_id={submission_id}]', )
+                self.journal.record(submission_id, Journal.DROP)
+                continue
+            self.logger.info(
+                'Recover unfinished submission '
+                f'[submission_id={submission_id}]', )
+            self.submission_ids.add(submission_id)
+            self.input_hashes[submission_id] = Sandbox.hash_files(
+                str(submission_path))
+            self.limits[submission_id] = self.load_limits(submission_path)
+            self.traces[submission_id] = {}
+            info = self.journal.info.get(submission_id, {})
+            try:
+                priority = self.queue.validate(info.get('priority'))
+            except ValueError:
+                # the class is removed from config
+                priority = self.queue.default_priority
+            self.priorities[submission_id] = priority
+            self.enqueue_time[submission_id] = time.monotonic()
+            # may wait for free space in queue
+            self.queue.put(
+                submission_id,
+                priority=priority,
+                owner=info.get('owner', ''),
+            )
 
-    def no_testcase(self):
+    def record_queue_wait(self, submission_id: str):
+        enqueue_time = self.enqueue_time.pop(submission_id, None)
+        if enqueue_time is None:
+            return
+        wait = time.monotonic() - enqueue_time
+        if submission_id in self.traces:
+            self.traces[submission_id]['queue'] = wait
+        priority = self.priorities.pop(submission_id, None)
+        with self.lock:
+            if priority is not None:
+                self.queue_waits[priority].append(wait)
+            self.dispatch_count += 1
+            self.queue_wait_total += wait
+            self.queue_wait_max = max(self.queue_wait_max, wait)
+
+    def log_exception(self, future: Future):
+        e = future.exception()
+        if e is not None:
+            self.logger.error(f'Task failed [err={e!r}]')
+
+    @classmethod
+    def percentile(cls, values: List[float], q: float) -> float:
         '''
-        no testcase need to be run
+        nearest-rank percentile of sorted `values`
         '''
-        return self.queue.empty()
+        return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
 
-    def run(self):
-        self.do_run = True
-        self.logger.debug('start dispatcher loop')
-        while self.do_run:
-            self.ensure_image()
-            if self.cannot_run_submission():
-                time.sleep(1)
-                continue
-            # get a submission
-            submission_id = self.queue.get()
-            # assign a new runner
-            threading.Thread(
-                target=self.create_container,
-                kwargs={
-                    'submission_id': submission_id,
-                    'mem_limit': 128000,  # 128 MB
-                    'time_limit': 10,  # 10s
-                    'file_size_limit': 64 * 10**6,
-                    'output_size_limit': 4096,  # 4KB
-                    'image': self.image,
+    def queue_wait_percentiles(self) -> Dict[str, dict]:
+        '''
+        percentiles of recent queue waiting time (in ms) of each class
+        '''
+        with self.lock:
+            waits = {k: sorted(v) for k, v in self.queue_waits.items() if v}
+        return {
+            priority: {
+                'count': len(values),
+                **{
+                    f'p{q}': 1000 * self.percentile(values, q)
+                    for q in (50, 90, 99)
                 },
-            ).start()
-        self.logger.debug('exit dispatcher loop')
+            }
+            for priority, values in waits.items()
+        }
+
+    def stats(self) -> dict:
+        '''
+        snapshot of slot usage, queue waiting time and delivery backlog
+        '''
+        queue_waits = self.queue_wait_percentiles()
+        with self.lock:
+            dispatch_count = max(self.dispatch_count, 1)
+            hosts = self.hosts.stats()
+            return {
+                'occupancy': self.container_count / self.max_container_count,
+                # in ms
+                'avgQueueWait': 1000 * self.queue_wait_total / dispatch_count,
+                'maxQueueWait': 1000 * self.queue_wait_max,
+                'deliveryBacklog': self.delivery_backlog,
+                'queueWaitByPriority': queue_waits,
+                # totals of all hosts, in kb
+                'memoryUsed': sum(h['memoryUsed'] for h in hosts),
+                'memoryBudget': sum(h['memoryBudget'] for h in hosts),
+                'cpuUsed': sum(h['cpuUsed'] for h in hosts),
+                'cpuBudget': sum(h['cpuBudget'] for h in hosts),
+                'concurrency': self.concurrency,
+                'deliveryWorkers': self.delivery_workers,
+                'hosts': hosts,
+            }
+
+    def status(self) -> dict:
+        return {
+            'load': self.queue.qsize() / self.max_task_count,
+            'queueSize': self.queue.qsize(),
+            'maxTaskCount': self.max_task_count,
+            'containerCount': self.container_count,
+            'maxContainerCount': self.max_container_count,
+            'submissions': [*self.submission_ids],
+            'running': self.do_run,
+            **self.stats(),
+        }
+
+    def export_metrics(self) -> str:
+        '''
+        phase latency histograms and current load, in prometheus text format
+        '''
+        stats = self.stats()
+        hosts = stats['hosts']
+        return self.metrics.render({
+            'queue_size':
+            self.queue.qsize(),
+            'max_task_count':
+            self.max_task_count,
+            'container_count':
+            self.container_count,
+            'max_container_count':
+            self.max_container_count,
+            'delivery_backlog':
+            self.delivery_backlog,
+            'memory_used_bytes':
+            stats['memoryUsed'] * 1024,
+            'memory_budget_bytes':
+            stats['memoryBudget'] * 1024,
+            'cpu_used':
+            stats['cpuUsed'],
+            'cpu_budget':
+            stats['cpuBudget'],
+            'concurrency':
+            self.concurrency,
+            'pool_idle':
+            sum(h['pool']['idle'] for h in hosts),
+            'hosts':
+            len(hosts),
+            'healthy_hosts':
+            sum(h['healthy'] for h in hosts),
+        })
 
     def graceful_shutdown(self):
         self.logger.info('Prepare to shutdown')
-        # TODO: cleanup ot store submission queue?
+        # unfinished submissions are kept in journal and will be
+        # recovered on next start
         self.stop()
 
     def stop(self):
@@ -171,21 +780,73 @@ class Dispatcher(threading.Thread):
     def create_container(
             self,
             submission_id: str,
+            host: str,
+            cpu_slot: Optional[int] = None,
             **ks,  # pass to sandbox
     ):
         if submission_id not in self.submission_ids:
+            self.release(ks['mem_limit'], host, cpu_slot)
+            self.slots.release()
             raise SubmissionIdNotFoundError(f'{submission_id} not found!')
         self.logger.info(f'Create container [submission_id={submission_id}]')
-        self.container_count += 1
-        res = Sandbox(
-            src_dir=str(self.get_host_path(submission_id).absolute()),
-            container_src_dir=str(self.get_path(submission_id).absolute()),
-            ignores=[
-                '__pycache__',
-            ] + [f.name for f in self.get_path(submission_id).iterdir()],
-            **ks,
-        ).run()
-        self.container_count -= 1
+        with self.lock:
+            self.container_count += 1
+        host = self.hosts.get(host)
+        client = host.client.get()
+        trace = self.traces.setdefault(submission_id, {})
+        if cpu_slot is not None:
+            ks['cpuset'] = host.cpusets.cpuset(cpu_slot)
+        try:
+            self.refresh_image(host)
+            sandbox = Sandbox(
+                src_dir=str(self.get_path(submission_id).absolute()),
+                ignores=['__pycache__', 'meta.json'],
+                input_hashes=self.input_hashes.pop(submission_id, None),
+                pool=host.pool,
+                client=client,
+                tmpfs_size=self.tmpfs_size,
+                use_zygote=self.zygote,
+                **ks,
+            )
+            res = sandbox.run()
+            trace.update(sandbox.timings)
+            if self.tuner is not None:
+                self.tuner.observe(
+                    sum(t for phase, t in sandbox.timings.items()
+                        if phase != 'exec'))
+        except ConnectionError as e:
+            self.logger.error(
+                'Lost connection to docker daemon '
+                f'[host={host.name}, err={e}]', )
+            host.client.reconnect(client)
+            # skip it until health check passes
+            host.healthy = False
+            res = Sandbox.judge_error_result()
+        except docker.errors.APIError as e:
+            # e.g. the image is removed and can't be pulled
+            self.logger.error(
+                'Docker API error '
+                f'[host={host.name}, err={e}]', )
+            # skip it until health check passes, then pull again
+            host.healthy = False
+            res = Sandbox.judge_error_result()
+        except Exception as e:
+            # still report a result, so the submission isn't lost
+            self.logger.error(
+                'Fail to judge submission '
+                f'[submission_id={submission_id}, err={e!r}]',
+                exc_info=True,
+            )
+            res = Sandbox.judge_error_result()
+        finally:
+            with self.lock:
+                self.container_count -= 1
+            self.release(ks['mem_limit'], host.name, cpu_slot)
+            self.slots.release()
+        res['host'] = host.name
+        if cpu_slot is not None:
+            res['cpuSlot'] = cpu_slot
+            res['cpuset'] = ks['cpuset']
         self.logger.info(f'Finish task [submission_id={submission_id}]')
         if self.logger.isEnabledFor(logging.DEBUG):
             # truncate long stdout/stderr
@@ -205,8 +866,32 @@ class Dispatcher(threading.Thread):
             self.logger.info(
                 'current in testing'
                 f'skip submission [{submission_id}] completion', )
+            self.journal.record(submission_id, Journal.COMPLETE)
+            self.metrics.trace(
+                submission_id,
+                self.traces.pop(submission_id),
+                res,
+            )
             return True
-        # post data
-        self.on_complete(submission_id, res)
-        # remove this submission
-        self.submission_ids.remove(submission_id)
+        with self.lock:
+            self.delivery_backlog += 1
+        self.deliverers.submit(
+            self.deliver,
+            submission_id,
+            res,
+        ).add_done_callback(self.log_exception)
+        return True
+
+    def deliver(self, submission_id: str, res: dict):
+        trace = self.traces.pop(submission_id, {})
+        try:
+            # post data
+            with timed(trace, 'deliver'):
+                self.on_complete(submission_id, res)
+        finally:
+            with self.lock:
+                self.delivery_backlog -= 1
+            self.journal.record(submission_id, Journal.COMPLETE)
+            self.metrics.trace(submission_id, trace, res)
+            # remove this submission
+            self.submission_ids.remove(submission_id)
@@ -7,4 +7,11 @@ class SubmissionIdNotFoundError(BaseException):
 class DuplicatedSubmissionIdError(BaseException):
     '''
     raise this when receive a duplicated submission id
-    '''
\ No newline at end of file
+    '''
+
+
+class RequestNotSentError(ConnectionError):
+    '''
+    raise this when a request can't reach the dispatcher, so it's
+    known not to be handled
+    '''
@@ -0,0 +1,146 @@
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+from .client import SharedDockerClient
+from .cpuset import CpusetSlots
+from .pool import ContainerPool
+
+
+class Host:
+    '''
+    a docker daemon running judging containers, and resources reserved
+    on it. counters are guarded by the dispatcher's lock.
+    '''
+    def __init__(
+        self,
+        name: str,
+        client: SharedDockerClient,
+        slots: int,
+        memory_budget: int,
+        cpu_limit: float,
+        cpu_budget: float,
+        cpusets: Optional[CpusetSlots] = None,
+    ):
+        self.name = name
+        self.client = client
+        # at most this many containers run on it
+        self.slots = slots
+        self.memory_budget = memory_budget  # int:kb
+        # CPUs given to each container
+        self.cpu_limit = cpu_limit
+        self.cpu_budget = cpu_budget
+        self.cpusets = cpusets
+        # set by dispatcher, containers are created on this host
+        self.pool: Optional[ContainerPool] = None
+        self.healthy = True
+        # last time the judging image was found on it
+        self.image_checked_at: Optional[float] = None
+        # only one runner checks (and pulls) the image at a time
+        self.image_lock = threading.Lock()
+        self.running = 0
+        self.memory_used = 0
+        self.cpu_used = 0
+
+    def fits(self, mem_limit: int) -> bool:
+        # a submission larger than the budget runs alone
+        mem_limit = min(mem_limit, self.memory_budget)
+        return self.healthy and self.running < self.slots and \
+            self.memory_used + mem_limit <= self.memory_budget and \
+            self.cpu_used + self.cpu_limit <= self.cpu_budget and \
+            (self.cpusets is None or self.cpusets.available())
+
+    def load(self) -> float:
+        return self.running / self.slots
+
+    def reserve(self, mem_limit: int) -> Optional[int]:
+        '''
+        Returns:
+            the assigned cpuset slot, None if cpuset is not enabled
+        '''
+        self.running += 1
+        self.memory_used += min(mem_limit, self.memory_budget)
+        self.cpu_used += self.cpu_limit
+        if self.cpusets is not None:
+            return self.cpusets.acquire()
+        return None
+
+    def release(self, mem_limit: int, cpu_slot: Optional[int] = None):
+        self.running -= 1
+        self.memory_used -= min(mem_limit, self.memory_budget)
+        self.cpu_used -= self.cpu_limit
+        if cpu_slot is not None:
+            self.cpusets.release(cpu_slot)
+
+    def stats(self) -> dict:
+        return {
+            'name': self.name,
+            'healthy': self.healthy,
+            'running': self.running,
+            'slots': self.slots,
+            # in kb
+            'memoryUsed': self.memory_used,
+            'memoryBudget': self.memory_budget,
+            'cpuUsed': self.cpu_used,
+            'cpuBudget': self.cpu_budget,
+            'pool': None if self.pool is None else self.pool.stats(),
+        }
+
+
+class HostRegistry:
+    '''
+    docker daemons shared by the dispatcher, submissions go to the least
+    loaded healthy one. daemons are pinged every `health_interval`
+    seconds, unreachable ones get no submissions until they come back.
+    '''
+    def __init__(self, hosts: List[Host], health_interval: float = 10):
+        self.hosts: Dict[str, Host] = {h.name: h for h in hosts}
+        if len(self.hosts) != len(hosts):
+            raise ValueError('duplicated host name')
+        self.health_interval = health_interval  # float:second
+        self.checker = None
+
+    @property
+    def logger(self) -> logging.Logger:
+        return logging.getLogger('gunicorn.error')
+
+    def __iter__(self):
+        return iter(self.hosts.values())
+
+    def get(self, name: str) -> Host:
+        return self.hosts[name]
+
+    def pick(self, mem_limit: int) -> Optional[Host]:
+        '''
+        Returns:
+            the least loaded host which can run a container with
+            `mem_limit` kb now, None if there isn't one
+        '''
+        candidates = [h for h in self if h.fits(mem_limit)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda h: h.load())
+
+    def check(self):
+        for host in self:
+            healthy = host.client.ping()
+            if healthy != host.healthy:
+                self.logger.warning(
+                    'Docker host becomes '
+                    f'{"healthy" if healthy else "unhealthy"} '
+                    f'[host={host.name}]', )
+            host.healthy = healthy
+
+    def watch(self):
+        while True:
+            time.sleep(self.health_interval)
+            self.check()
+
+    def start(self):
+        if self.checker is not None:
+            return
+        self.checker = threading.Thread(target=self.watch, daemon=True)
+        self.checker.start()
+
+    def stats(self) -> List[dict]:
+        return [h.stats() for h in self]
@@ -0,0 +1,189 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+
+class Journal:
+    '''
+    append-only log of submission state transitions
+
+    records are written by a background thread, records arrived during an
+    fsync are written and synced together in the next batch. a batch
+    failed to write is retried with the next one, and callers waiting for
+    it get the error. on startup, submissions which are not completed can
+    be read from `pending`.
+    '''
+    ENQUEUE = 'enqueue'
+    START = 'start'
+    COMPLETE = 'complete'
+    # rejected / lost submissions, they won't be recovered
+    DROP = 'drop'
+    # seconds between writes when the disk keeps failing
+    RETRY_INTERVAL = 1
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        # extra data saved with enqueue records of pending submissions
+        self.info: Dict[str, dict] = {}
+        # unfinished submissions before this start, in enqueue order
+        self.pending: List[str] = self.load()
+        self.compact()
+        self.file = self.path.open('a')
+        self.cond = threading.Condition()
+        # lines not written yet
+        self.buf: List[str] = []
+        # sequence number of last appended / synced record
+        self.seq = 0
+        self.synced_seq = 0
+        # last write error, and the last record in that failed batch
+        self.error: Optional[OSError] = None
+        self.error_seq = 0
+        self.closed = False
+        self.writer = threading.Thread(target=self.write, daemon=True)
+        self.writer.start()
+
+    @property
+    def logger(self) -> logging.Logger:
+        return logging.getLogger('gunicorn.error')
+
+    def load(self) -> List[str]:
+        if not self.path.exists():
+            return []
+        states = OrderedDict()
+        with self.path.open() as f:
+            for line in f:
+                # left after a failed write
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # last line may be partially written before crash
+                    self.logger.warning(f'Skip broken journal record {line}')
+                    continue
+                _id, state = record['id'], record['state']
+                if state in (self.COMPLETE, self.DROP):
+                    states.pop(_id, None)
+                    self.info.pop(_id, None)
+                else:
+                    states.setdefault(_id, state)
+                    if 'info' in record:
+                        self.info[_id] = record['info']
+        return [*states]
+
+    def compact(self):
+        '''
+        rewrite journal with only pending submissions
+        '''
+        tmp = self.path.with_name(f'{self.path.name}.tmp')
+        with tmp.open('w') as f:
+            for _id in self.pending:
+                f.write(self.dumps(_id, self.ENQUEUE, self.info.get(_id)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    @classmethod
+    def dumps(
+        cls,
+        submission_id: str,
+        state: str,
+        info: Optional[dict] = None,
+    ) -> str:
+        record = {'id': submission_id, 'state': state}
+        if info is not None:
+            record['info'] = info
+        return json.dumps(record) + '\n'
+
+    def record(
+        self,
+        submission_id: str,
+        state: str,
+        sync: bool = False,
+        info: Optional[dict] = None,
+    ):
+        '''
+        append a record
+
+        Args:
+            submission_id: the submission's unique id
+            state: one of ENQUEUE, START, COMPLETE and DROP
+            sync: wait until the record is flushed to disk
+            info: extra data of this submission, kept until it completes
+        Raises:
+            OSError: `sync` is set and the record failed to be written,
+                it's still retried later
+        '''
+        with self.cond:
+            if self.closed:
+                raise ValueError('journal is closed')
+            self.buf.append(self.dumps(submission_id, state, info))
+            self.seq += 1
+            seq = self.seq
+            self.cond.notify_all()
+            if sync:
+                self.wait(seq)
+
+    def sync(self):
+        '''
+        wait until all appended records are flushed to disk
+
+        Raises:
+            OSError: some records failed to be written
+        '''
+        with self.cond:
+            self.wait(self.seq)
+
+    def wait(self, seq: int):
+        # called with `cond` held
+        self.cond.wait_for(
+            lambda: self.synced_seq >= seq or self.error_seq >= seq)
+        if self.synced_seq < seq:
+            raise self.error
+
+    def write(self):
+        # a failed write may leave a partial line
+        broken = False
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.buf or self.closed)
+                if not self.buf and self.closed:
+                    break
+                buf, self.buf = self.buf, []
+                seq = self.seq
+            # write a batch with only one fsync
+            try:
+                self.file.write(('\n' if broken else '') + ''.join(buf))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except OSError as e:
+                self.logger.error(f'Fail to write journal [err={e}]')
+                broken = True
+                with self.cond:
+                    self.error = e
+                    self.error_seq = seq
+                    # retry with the next batch, unless it's closing
+                    if not self.closed:
+                        self.buf[:0] = buf
+                    self.cond.notify_all()
+                time.sleep(self.RETRY_INTERVAL)
+                continue
+            broken = False
+            with self.cond:
+                self.synced_seq = seq
+                self.cond.notify_all()
+        try:
+            self.file.close()
+        except OSError as e:
+            self.logger.error(f'Fail to close journal [err={e}]')
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.writer.join()
@@ -0,0 +1,182 @@
+import bisect
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+
+class Histogram:
+    '''
+    cumulative histogram in prometheus style
+    '''
+    # upper bounds in seconds
+    BUCKETS = (
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1,
+        2.5,
+        5,
+        10,
+        30,
+        60,
+    )
+    # upper bounds in bytes
+    SIZE_BUCKETS = tuple(2**i for i in range(10, 34, 2))
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        # the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str = '') -> List[str]:
+        lines = []
+        acc = 0
+        for le, count in zip((*self.buckets, '+Inf'), self.counts):
+            acc += count
+            bucket_labels = ','.join(l for l in (labels, f'le="{le}"') if l)
+            lines.append(f'{name}_bucket{{{bucket_labels}}} {acc}')
+        # no braces for unlabeled series
+        labels = labels and f'{{{labels}}}'
+        lines.append(f'{name}_sum{labels} {self.sum}')
+        lines.append(f'{name}_count{labels} {self.count}')
+        return lines
+
+
+@contextmanager
+def timed(phases: Dict[str, float], phase: str):
+    '''
+    add the time spent in this block to `phases[phase]` (in seconds)
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        phases[phase] = phases.get(phase, 0.0) + elapsed
+
+
+class Metrics:
+    '''
+    per-phase latency and resource usage of submissions
+
+    each finished submission's phases and usage are added into
+    histograms, and its trace is written as a json line to `trace_path`
+    (or debug log if not set).
+    '''
+    PREFIX = 'sandbox'
+    # resource usage fields in sandbox result
+    USAGE_KEYS = ('wallTime', 'cpuTime', 'memoryUsage', 'ioRead', 'ioWrite')
+    # {name: (help, buckets)}
+    FAMILIES = {
+        'phase_seconds': (
+            'Time spent in each phase of a submission.',
+            Histogram.BUCKETS,
+        ),
+        'cpu_seconds': (
+            'CPU time used by a submission.',
+            Histogram.BUCKETS,
+        ),
+        'memory_bytes': (
+            'Peak memory usage of a submission.',
+            Histogram.SIZE_BUCKETS,
+        ),
+        'io_bytes': (
+            'Bytes read from / written to block devices by a submission.',
+            Histogram.SIZE_BUCKETS,
+        ),
+    }
+
+    def __init__(self, trace_path: Optional[str] = None):
+        self.lock = threading.Lock()
+        # {(family, labels): histogram}
+        self.histograms: Dict[Tuple[str, str], Histogram] = {}
+        self.trace_file = None
+        if trace_path is not None:
+            self.trace_file = Path(trace_path).open('a', buffering=1)
+
+    @property
+    def logger(self) -> logging.Logger:
+        return logging.getLogger('gunicorn.error')
+
+    def observe(self, family: str, value: float, labels: str = ''):
+        key = (family, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(self.FAMILIES[family][1])
+            self.histograms[key].observe(value)
+
+    def trace(
+        self,
+        submission_id: str,
+        phases: Dict[str, float],
+        result: dict = {},
+    ):
+        '''
+        record phases and resource usage of a finished submission
+
+        Args:
+            submission_id: the submission's unique id
+            phases: {phase: seconds}
+            result: sandbox result, only resource usage is used
+        '''
+        usage = {k: result[k] for k in self.USAGE_KEYS if k in result}
+        for phase, seconds in phases.items():
+            self.observe('phase_seconds', seconds, f'phase="{phase}"')
+        if 'cpuTime' in usage:
+            self.observe('cpu_seconds', usage['cpuTime'] / 1000)
+        if 'memoryUsage' in usage:
+            self.observe('memory_bytes', usage['memoryUsage'] * 1024)
+        for key, direction in (('ioRead', 'read'), ('ioWrite', 'write')):
+            if key in usage:
+                labels = f'direction="{direction}"'
+                self.observe('io_bytes', usage[key], labels)
+        line = json.dumps({
+            'id': submission_id,
+            'time': time.time(),
+            # in ms
+            'phases': {k: round(v * 1000, 3)
+                       for k, v in phases.items()},
+            'usage': usage,
+        })
+        if self.trace_file is None:
+            self.logger.debug(f'Submission trace {line}')
+            return
+        with self.lock:
+            try:
+                self.trace_file.write(line + '\n')
+            except OSError as e:
+                self.logger.error(f'Fail to write trace [err={e}]')
+
+    def render(self, gauges: Dict[str, float] = {}) -> str:
+        '''
+        export histograms and `gauges` in prometheus text format
+        '''
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            for family, (_help, _) in self.FAMILIES.items():
+                name = f'{self.PREFIX}_{family}'
+                lines.append(f'# HELP {name} {_help}')
+                lines.append(f'# TYPE {name} histogram')
+                for (_family, labels), histogram in histograms:
+                    if _family == family:
+                        lines += histogram.render(name, labels)
+        for key, value in gauges.items():
+            lines.append(f'# TYPE {self.PREFIX}_{key} gauge')
+            lines.append(f'{self.PREFIX}_{key} {value}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,141 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque
+from docker.errors import APIError, NotFound
+from docker.models.containers import Container
+
+
+class ContainerPool:
+    '''
+    keep pre-created, paused judger containers ready to be leased
+
+    every container is used by exactly one submission, after that it is
+    removed and a fresh one is created in background to take its place.
+    '''
+    def __init__(
+        self,
+        factory: Callable[[], Container],
+        size: int,
+    ):
+        # create a started container
+        self.factory = factory
+        # number of containers the pool tries to keep paused
+        self.size = size
+        self.idle: Deque[Container] = deque()
+        self.lock = threading.Lock()
+        # background jobs (create / remove containers)
+        self.jobs = queue.Queue()
+        self.worker = None
+        self.closed = False
+        # statistics
+        self.hit_count = 0
+        self.miss_count = 0
+        self.lease_count = 0
+        self.lease_time = 0.0
+
+    @property
+    def logger(self) -> logging.Logger:
+        return logging.getLogger('gunicorn.error')
+
+    def start(self):
+        if self.worker is not None:
+            return
+        self.closed = False
+        self.worker = threading.Thread(target=self.work, daemon=True)
+        self.worker.start()
+        for _ in range(self.size):
+            self.jobs.put(self.fill)
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            try:
+                job()
+            except Exception as e:
+                self.logger.error(f'Container pool job failed [err={e!r}]')
+
+    def fill(self):
+        if self.closed:
+            return
+        with self.lock:
+            if len(self.idle) >= self.size:
+                return
+        container = self.factory()
+        container.pause()
+        with self.lock:
+            if not self.closed:
+                self.idle.append(container)
+                return
+        self.remove(container)
+
+    def remove(self, container: Container):
+        try:
+            container.remove(force=True)
+        except NotFound:
+            pass
+
+    def lease(self) -> Container:
+        '''
+        get a running container, create a new one if no one is ready
+
+        Returns:
+            a started container which can run a submission
+        '''
+        start = time.perf_counter()
+        with self.lock:
+            container = self.idle.popleft() if self.idle else None
+        if container is not None:
+            try:
+                container.unpause()
+                hit = True
+            except APIError as e:
+                self.logger.warning(
+                    'Drop broken pooled container '
+                    f'[id={container.short_id}, err={e}]', )
+                self.jobs.put(lambda: self.remove(container))
+                container = None
+        if container is None:
+            container = self.factory()
+            hit = False
+        with self.lock:
+            if hit:
+                self.hit_count += 1
+            else:
+                self.miss_count += 1
+            self.lease_count += 1
+            self.lease_time += time.perf_counter() - start
+        return container
+
+    def release(self, container: Container):
+        '''
+        give back a leased container, it will be recycled in background
+        '''
+        self.jobs.put(lambda: self.remove(container))
+        self.jobs.put(self.fill)
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            idle, self.idle = [*self.idle], deque()
+        for container in idle:
+            self.jobs.put(lambda c=container: self.remove(c))
+        self.jobs.put(None)
+        self.worker = None
+
+    def stats(self) -> dict:
+        with self.lock:
+            lease_count = max(self.lease_count, 1)
+            return {
+                'size': self.size,
+                'idle': len(self.idle),
+                'hit': self.hit_count,
+                'miss': self.miss_count,
+                'hitRate': self.hit_count / lease_count,
+                # in ms
+                'avgLeaseLatency': 1000 * self.lease_time / lease_count,
+            }
@@ -0,0 +1,217 @@
+import fcntl
+import logging
+import os
+import threading
+from multiprocessing.connection import Client, Connection, Listener
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Union
+from .dispatcher import Dispatcher
+from .exception import RequestNotSentError
+
+
+class DispatcherServer(threading.Thread):
+    '''
+    serve dispatcher calls from other worker processes through an unix
+    socket, so all workers share one queue and one container budget
+    '''
+    # methods can be called remotely
+    METHODS = {'handle', 'handle_many', 'status', 'export_metrics'}
+
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        address: str,
+        authkey: bytes,
+        lock_file=None,
+    ):
+        super().__init__(daemon=True)
+        self.dispatcher = dispatcher
+        # keep the file (and its lock) open during process lifetime
+        self.lock_file = lock_file
+        self.address = address
+        # remove socket left by dead leader
+        if os.path.exists(address):
+            os.unlink(address)
+        self.listener = Listener(address, family='AF_UNIX', authkey=authkey)
+
+    @property
+    def logger(self) -> logging.Logger:
+        return logging.getLogger('gunicorn.error')
+
+    def run(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError as e:
+                self.logger.warning(f'Reject dispatcher client [err={e}]')
+                continue
+            threading.Thread(
+                target=self.serve,
+                args=(conn, ),
+                daemon=True,
+            ).start()
+
+    def serve(self, conn: Connection):
+        with conn:
+            while True:
+                try:
+                    method, args = conn.recv()
+                except (EOFError, OSError):
+                    return
+                if method not in self.METHODS:
+                    conn.send((False, AttributeError(method)))
+                    continue
+                try:
+                    conn.send((True, getattr(self.dispatcher, method)(*args)))
+                # forward every error (e.g. queue.Full) to caller
+                except BaseException as e:
+                    conn.send((False, e))
+
+
+class RemoteDispatcher:
+    '''
+    proxy of the dispatcher running in another worker process
+
+    if the leader is gone (e.g. the old one exits after a reload, when
+    new workers have started as followers), `take_over` is called to try
+    to run the dispatcher in this process, calls go to it since then.
+    '''
+    def __init__(
+        self,
+        address: str,
+        authkey: bytes,
+        take_over: Optional[Callable[[], Optional[Dispatcher]]] = None,
+    ):
+        self.address = address
+        self.authkey = authkey
+        self.local = threading.local()
+        self.take_over = take_over
+        self.take_over_lock = threading.Lock()
+        # dispatcher of this process after taking over
+        self.leader: Optional[Dispatcher] = None
+
+    @property
+    def logger(self) -> logging.Logger:
+        return logging.getLogger('gunicorn.error')
+
+    def connection(self) -> Connection:
+        # one connection for each thread
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = Client(
+                self.address,
+                family='AF_UNIX',
+                authkey=self.authkey,
+            )
+            self.local.conn = conn
+        return conn
+
+    def call(self, method: str, *args):
+        '''
+        Raises:
+            RequestNotSentError: the request isn't delivered
+            ConnectionError: connection is lost after sending, the request
+                may be handled
+        '''
+        if self.leader is None:
+            try:
+                return self.remote_call(method, *args)
+            except RequestNotSentError:
+                if not self.promote():
+                    raise
+        return getattr(self.leader, method)(*args)
+
+    def promote(self) -> bool:
+        '''
+        Returns:
+            whether this process runs the dispatcher now
+        '''
+        with self.take_over_lock:
+            if self.leader is None and self.take_over is not None:
+                self.leader = self.take_over()
+                if self.leader is not None:
+                    self.logger.warning('Leader is gone, take over dispatcher')
+            return self.leader is not None
+
+    def remote_call(self, method: str, *args):
+        try:
+            conn = self.connection()
+            conn.send((method, args))
+        except OSError as e:
+            # leader may be restarting, connect again next time
+            self.local.conn = None
+            raise RequestNotSentError(f'dispatcher unavailable: {e}') from e
+        try:
+            ok, ret = conn.recv()
+        except (EOFError, OSError) as e:
+            self.local.conn = None
+            raise ConnectionError(f'dispatcher unavailable: {e}') from e
+        if not ok:
+            raise ret
+        return ret
+
+    def handle(
+        self,
+        submission_id: str,
+        sync: bool = True,
+        trace: Optional[Dict[str, float]] = None,
+        priority: Optional[str] = None,
+        owner: str = '',
+    ) -> bool:
+        return self.call(
+            'handle',
+            submission_id,
+            sync,
+            trace,
+            priority,
+            owner,
+        )
+
+    def handle_many(
+        self,
+        submission_ids: List[str],
+        options: Optional[List[dict]] = None,
+    ) -> list:
+        return self.call('handle_many', submission_ids, options)
+
+    def status(self) -> dict:
+        return self.call('status')
+
+    def export_metrics(self) -> str:
+        return self.call('export_metrics')
+
+
+def elect(
+    lock_path: str,
+    address: str,
+    authkey: bytes,
+    factory: Callable[[], Dispatcher],
+) -> Union[Dispatcher, RemoteDispatcher]:
+    '''
+    make the first worker process run the dispatcher, others talk to it
+
+    Args:
+        lock_path: file locked by the leader until it exits
+        address: unix socket path served by the leader
+        authkey: key used to authenticate workers
+        factory: create the dispatcher if this process is the leader
+    Returns:
+        a started dispatcher, or a proxy of the leader's one
+    '''
+    def lead() -> Optional[Dispatcher]:
+        lock_file = Path(lock_path).open('a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        dispatcher = factory()
+        dispatcher.start()
+        DispatcherServer(dispatcher, address, authkey, lock_file).start()
+        return dispatcher
+
+    dispatcher = lead()
+    if dispatcher is not None:
+        return dispatcher
+    # the leader may exit later
+    return RemoteDispatcher(address, authkey, take_over=lead)
@@ -0,0 +1,157 @@
+import math
+import queue
+import threading
+from collections import OrderedDict, deque
+from typing import Callable, Dict, Optional
+
+
+class Fifo:
+    def __init__(self):
+        self.items = deque()
+
+    def __len__(self):
+        return len(self.items)
+
+    def push(self, item):
+        self.items.append(item)
+
+    def pop(self):
+        return self.items.popleft()
+
+
+class DeficitRoundRobin:
+    '''
+    serve flows in turn, each turn a flow can take `quantum(key)` items.
+    flows are created on demand by `new_flow`, and can be another
+    `DeficitRoundRobin` to build a hierarchy.
+    '''
+    def __init__(
+        self,
+        new_flow: Callable[[], object] = Fifo,
+        quantum: Callable[[str], int] = lambda _: 1,
+    ):
+        self.new_flow = new_flow
+        self.quantum = quantum
+        # non-empty flows, in serving order
+        self.flows = OrderedDict()
+        self.deficit: Dict[str, int] = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, key: str, *args):
+        '''
+        put an item into flow `key`, `args` are passed to the flow
+        '''
+        if key not in self.flows:
+            self.flows[key] = self.new_flow()
+            self.deficit[key] = 0
+        self.flows[key].push(*args)
+        self.size += 1
+
+    def pop(self):
+        if not self.size:
+            raise IndexError('pop from empty queue')
+        while True:
+            key, flow = next(iter(self.flows.items()))
+            if self.deficit[key] < 1:
+                # start of its turn
+                self.deficit[key] += self.quantum(key)
+            if self.deficit[key] >= 1:
+                break
+            self.flows.move_to_end(key)
+        item = flow.pop()
+        self.size -= 1
+        self.deficit[key] -= 1
+        if not len(flow):
+            # idle flows don't save up credit
+            del self.flows[key]
+            del self.deficit[key]
+        elif self.deficit[key] < 1:
+            self.flows.move_to_end(key)
+        return item
+
+
+class FairQueue:
+    '''
+    submission queue shared by priority classes and owners (e.g. users
+    or courses)
+
+    classes are served in turn weighted by `weights`, and inside a class
+    each owner gets an equal share, so a burst from one owner or a bulk
+    rejudge only delays itself. it has the same interface as
+    `queue.Queue`, with extra arguments to `put`.
+    '''
+    def __init__(
+        self,
+        maxsize: int,
+        weights: Dict[str, int],
+        default_priority: str,
+    ):
+        if default_priority not in weights:
+            raise ValueError(f'unknown priority class: {default_priority}')
+        for priority, weight in weights.items():
+            # a class with no weight would never get a turn, and `pop`
+            # would spin forever
+            if type(weight) not in (int, float) or \
+                    not math.isfinite(weight) or weight <= 0:
+                raise ValueError(
+                    f'weight of {priority} should be a positive number, '
+                    f'got {weight!r}')
+        self.maxsize = maxsize
+        self.weights = weights
+        self.default_priority = default_priority
+        self.cond = threading.Condition()
+        self.drr = DeficitRoundRobin(
+            new_flow=DeficitRoundRobin,
+            quantum=lambda priority: self.weights[priority],
+        )
+
+    def qsize(self) -> int:
+        with self.cond:
+            return len(self.drr)
+
+    def validate(self, priority: Optional[str]) -> str:
+        if priority is None:
+            return self.default_priority
+        if priority not in self.weights:
+            raise ValueError(f'unknown priority class: {priority}')
+        return priority
+
+    def put(
+        self,
+        item,
+        block: bool = True,
+        timeout: Optional[float] = None,
+        priority: Optional[str] = None,
+        owner: str = '',
+    ):
+        priority = self.validate(priority)
+        with self.cond:
+            if not self.cond.wait_for(
+                    lambda: len(self.drr) < self.maxsize,
+                    timeout=timeout if block else 0,
+            ):
+                raise queue.Full
+            self.drr.push(priority, owner, item)
+            self.cond.notify_all()
+
+    def put_nowait(
+        self,
+        item,
+        priority: Optional[str] = None,
+        owner: str = '',
+    ):
+        self.put(item, block=False, priority=priority, owner=owner)
+
+    def get(self, block: bool = True, timeout: Optional[float] = None):
+        with self.cond:
+            if not self.cond.wait_for(
+                    lambda: len(self.drr),
+                    timeout=timeout if block else 0,
+            ):
+                raise queue.Empty
+            item = self.drr.pop()
+            self.cond.notify_all()
+            return item
@@ -0,0 +1,341 @@
+import errno
+import hashlib
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from tempfile import NamedTemporaryFile, mkdtemp
+from typing import BinaryIO, Optional, Tuple
+from zipfile import ZipFile
+
+
+class EntryTooLargeError(ValueError):
+    '''
+    raise this when an entry can't fit in the store even if it's empty
+    '''
+
+
+class BlobStore:
+    '''
+    content-addressed storage of submission data, keyed by sha256
+
+    an entry is either a file (attachment) or a directory (extracted
+    testcase), they are hardlinked into submission directories, so the
+    same data is saved only once. least recently used entries are
+    evicted when total size exceeds `max_size`.
+
+    the directory is shared by worker processes, each of them re-reads
+    it every `rescan_interval` seconds to see the real total size and
+    entries used by others (by mtime).
+    '''
+    DIGEST_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+    def __init__(
+        self,
+        root: Path,
+        max_size: int,
+        rescan_interval: float = 60,
+    ):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        # uploading data, moved into root after hash is known. it may be
+        # shared by several worker processes.
+        self.tmp_dir = self.root / '.tmp'
+        self.tmp_dir.mkdir(exist_ok=True)
+        self.max_size = max_size  # int:byte
+        self.rescan_interval = rescan_interval  # float:second
+        self.scanned_at = 0
+        self.lock = threading.Lock()
+        # {digest: size}, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hit_count = 0
+        self.miss_count = 0
+        self.load()
+
+    @property
+    def logger(self) -> logging.Logger:
+        return logging.getLogger('gunicorn.error')
+
+    @classmethod
+    def entry_size(cls, path: Path) -> int:
+        if path.is_file():
+            return path.stat().st_size
+        return sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+
+    def load(self):
+        # remove data left by dead processes
+        expired = time.time() - 3600
+        for p in self.tmp_dir.iterdir():
+            if p.stat().st_mtime < expired:
+                self.remove(p)
+        self.rescan()
+        self.evict()
+
+    def rescan(self):
+        '''
+        reload entries from disk, including ones stored, used or removed
+        by other worker processes
+        '''
+        with self.lock:
+            known = dict(self.entries)
+        found = []
+        for p in self.root.iterdir():
+            if not self.DIGEST_PATTERN.fullmatch(p.name):
+                continue
+            try:
+                mtime = p.stat().st_mtime
+                # entries never change, only measure new ones
+                size = known.get(p.name)
+                if size is None:
+                    size = self.entry_size(p)
+            except FileNotFoundError:
+                continue
+            found.append((mtime, p.name, size))
+        # recently used entries have newer mtime
+        entries = OrderedDict((d, s) for _, d, s in sorted(found))
+        with self.lock:
+            # keep entries added during scanning
+            for digest, size in self.entries.items():
+                if digest not in known and digest not in entries:
+                    entries[digest] = size
+            self.entries = entries
+            self.size = sum(entries.values())
+            self.scanned_at = time.monotonic()
+
+    def validate(self, digest: str):
+        if not self.DIGEST_PATTERN.fullmatch(digest):
+            raise ValueError(f'invalid sha256 digest: {digest}')
+
+    def path(self, digest: str) -> Path:
+        return self.root / digest
+
+    def stored(self, digest: str) -> bool:
+        # may be stored by another worker process
+        path = self.path(digest)
+        if digest not in self.entries and path.exists():
+            self.adopt(digest, path)
+        with self.lock:
+            return digest in self.entries
+
+    def has(self, digest: str) -> bool:
+        self.validate(digest)
+        hit = self.stored(digest)
+        with self.lock:
+            if hit:
+                self.hit_count += 1
+            else:
+                self.miss_count += 1
+            return hit
+
+    def save(self, fileobj: BinaryIO) -> Tuple[Path, str]:
+        '''
+        write stream into a temp file
+
+        Returns:
+            temp file path and sha256 of the content
+        '''
+        h = hashlib.sha256()
+        with NamedTemporaryFile(dir=self.tmp_dir, delete=False) as f:
+            for chunk in iter(lambda: fileobj.read(2**16), b''):
+                h.update(chunk)
+                f.write(chunk)
+        return Path(f.name), h.hexdigest()
+
+    def put_file(
+        self,
+        fileobj: BinaryIO,
+        digest: Optional[str] = None,
+    ) -> str:
+        '''
+        store a file
+
+        Args:
+            fileobj: content to store
+            digest: expected sha256 of the content
+        Returns:
+            sha256 of the content
+        '''
+        tmp, actual = self.save(fileobj)
+        if digest is not None and digest != actual:
+            tmp.unlink()
+            raise ValueError(f'sha256 mismatch: {digest} != {actual}')
+        tmp.chmod(0o444)
+        self.add(actual, tmp)
+        return actual
+
+    def put_tree(
+        self,
+        zip_fileobj: BinaryIO,
+        digest: Optional[str] = None,
+    ) -> str:
+        '''
+        store the content of a zip file, keyed by the hash of zip
+
+        Args:
+            zip_fileobj: zip to extract
+            digest: expected sha256 of the zip
+        Returns:
+            sha256 of the zip
+        '''
+        tmp, actual = self.save(zip_fileobj)
+        try:
+            if digest is not None and digest != actual:
+                raise ValueError(f'sha256 mismatch: {digest} != {actual}')
+            if self.stored(actual):
+                self.touch(actual)
+                return actual
+            tree = Path(mkdtemp(dir=self.tmp_dir))
+            with ZipFile(tmp, 'r') as z:
+                z.extractall(tree)
+            for f in tree.rglob('*'):
+                if f.is_file():
+                    f.chmod(0o444)
+        finally:
+            tmp.unlink()
+        self.add(actual, tree)
+        return actual
+
+    def adopt(self, digest: str, path: Path):
+        try:
+            size = self.entry_size(path)
+        except FileNotFoundError:
+            return
+        with self.lock:
+            if digest not in self.entries:
+                self.entries[digest] = size
+                self.size += size
+
+    def forget(self, digest: str):
+        '''
+        drop an entry removed by another worker process
+        '''
+        with self.lock:
+            size = self.entries.pop(digest, None)
+            if size is not None:
+                self.size -= size
+
+    def add(self, digest: str, tmp: Path):
+        '''
+        move a saved entry into store
+
+        Raises:
+            EntryTooLargeError: the entry is larger than `max_size`, it
+                would be evicted right away
+        '''
+        size = self.entry_size(tmp)
+        if size > self.max_size:
+            self.remove(tmp)
+            raise EntryTooLargeError(
+                f'data too large: {size} > {self.max_size} bytes')
+        path = self.path(digest)
+        with self.lock:
+            exist = digest in self.entries
+            if not exist:
+                try:
+                    os.rename(tmp, path)
+                except OSError as e:
+                    # a directory just stored by another worker process
+                    if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                        self.remove(tmp)
+                        raise
+                    exist = True
+                else:
+                    self.entries[digest] = size
+                    self.size += size
+        if exist:
+            self.remove(tmp)
+            self.adopt(digest, path)
+            self.touch(digest)
+            return
+        if time.monotonic() - self.scanned_at >= self.rescan_interval:
+            self.rescan()
+        self.evict()
+
+    def touch(self, digest: str):
+        with self.lock:
+            if digest not in self.entries:
+                return
+            self.entries.move_to_end(digest)
+        try:
+            os.utime(self.path(digest))
+        except FileNotFoundError:
+            pass
+
+    def link(self, digest: str, dest: Path):
+        '''
+        make an entry appear at `dest`, a file is linked to `dest`, files
+        of a directory are linked under `dest`
+
+        Raises:
+            KeyError: the entry doesn't exist (or was just evicted)
+        '''
+        self.validate(digest)
+        with self.lock:
+            if digest not in self.entries:
+                raise KeyError(digest)
+            self.entries.move_to_end(digest)
+        src = self.path(digest)
+        try:
+            if src.is_file():
+                self.link_file(src, dest)
+            elif src.is_dir():
+                for f in src.rglob('*'):
+                    target = dest / f.relative_to(src)
+                    if f.is_dir():
+                        target.mkdir(parents=True, exist_ok=True)
+                    else:
+                        target.parent.mkdir(parents=True, exist_ok=True)
+                        self.link_file(f, target)
+            else:
+                raise FileNotFoundError(src)
+            # let other worker processes know it's used
+            os.utime(src)
+        except FileNotFoundError:
+            # evicted by another worker process
+            self.forget(digest)
+            raise KeyError(digest)
+
+    def link_file(self, src: Path, dest: Path):
+        try:
+            os.link(src, dest)
+        except OSError:
+            # e.g. store and submissions are on different file systems
+            shutil.copyfile(src, dest)
+
+    def remove(self, path: Path):
+        if path.is_dir():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+
+    def evict(self):
+        while True:
+            with self.lock:
+                if self.size <= self.max_size or not self.entries:
+                    return
+                digest, size = self.entries.popitem(last=False)
+                self.size -= size
+                # keep it out of root before releasing lock
+                path = self.tmp_dir / f'evict-{digest}-{os.getpid()}'
+                try:
+                    os.rename(self.path(digest), path)
+                except FileNotFoundError:
+                    # evicted by another worker process
+                    continue
+            self.logger.debug(f'Evict stored data [digest={digest}]')
+            self.remove(path)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'count': len(self.entries),
+                'size': self.size,
+                'maxSize': self.max_size,
+                'hit': self.hit_count,
+                'miss': self.miss_count,
+            }
@@ -0,0 +1,118 @@
+import logging
+import os
+import threading
+from typing import Optional
+
+
+class ConcurrencyTuner:
+    '''
+    adjust how many containers run at the same time, in AIMD style
+
+    the limit grows by one while it is fully used and the host is
+    healthy, and is halved when the host is overloaded: load average per
+    CPU is over `max_load`, available memory is under `min_free_memory`,
+    or sandbox overhead (time spent outside the program) grows over
+    `latency_factor` times of the best one observed. the best one rises
+    by `baseline_decay` each observation, so a lucky sample long ago
+    doesn't keep the limit low forever.
+    '''
+    def __init__(
+        self,
+        min_count: int,
+        max_count: int,
+        max_load: float = 1.5,
+        min_free_memory: int = 262144,
+        latency_factor: float = 2,
+        baseline_decay: float = 0.01,
+    ):
+        self.min_count = min_count
+        self.max_count = max_count
+        self.max_load = max_load
+        self.min_free_memory = min_free_memory  # int:kb
+        self.latency_factor = latency_factor
+        self.baseline_decay = baseline_decay
+        # observed by runner threads, read by the tuning thread
+        self.lock = threading.Lock()
+        # moving average of sandbox overhead and the lowest one (in seconds)
+        self.overhead: Optional[float] = None
+        self.best_overhead: Optional[float] = None
+
+    @property
+    def logger(self) -> logging.Logger:
+        return logging.getLogger('gunicorn.error')
+
+    def observe(self, overhead: float):
+        '''
+        record sandbox overhead (in seconds) of a finished submission
+        '''
+        with self.lock:
+            if self.overhead is None:
+                self.overhead = overhead
+            else:
+                self.overhead = 0.8 * self.overhead + 0.2 * overhead
+            if self.best_overhead is None:
+                self.best_overhead = self.overhead
+            else:
+                self.best_overhead = min(
+                    self.overhead,
+                    self.best_overhead * (1 + self.baseline_decay),
+                )
+
+    def host_load(self) -> float:
+        try:
+            with open('/proc/loadavg') as f:
+                load = float(f.read().split()[0])
+        except (OSError, ValueError):
+            return 0.0
+        return load / (os.cpu_count() or 1)
+
+    def free_memory(self) -> Optional[int]:
+        try:
+            with open('/proc/meminfo') as f:
+                for line in f:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1])
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def overloaded(self) -> Optional[str]:
+        '''
+        Returns:
+            the reason if host is overloaded, else None
+        '''
+        load = self.host_load()
+        if load > self.max_load:
+            return f'load={load:.2f}'
+        free = self.free_memory()
+        if free is not None and free < self.min_free_memory:
+            return f'free_memory={free}'
+        with self.lock:
+            overhead, best = self.overhead, self.best_overhead
+        if overhead is not None and overhead > self.latency_factor * best:
+            return f'overhead={overhead:.3f}'
+        return None
+
+    def tune(self, limit: int, in_use: int) -> int:
+        '''
+        Args:
+            limit: current concurrency limit
+            in_use: how many containers are running
+        Returns:
+            new concurrency limit
+        '''
+        reason = self.overloaded()
+        if reason is not None:
+            new_limit = max(self.min_count, limit // 2)
+            # wait for overhead under the new limit
+            with self.lock:
+                self.overhead = None
+            if new_limit != limit:
+                self.logger.warning(
+                    'Host overloaded, decrease concurrency '
+                    f'[limit={new_limit}, {reason}]', )
+            return new_limit
+        if in_use >= limit and limit < self.max_count:
+            self.logger.info(f'Increase concurrency [limit={limit + 1}]')
+            return limit + 1
+        return limit
@@ -1,30 +1,181 @@
+import hashlib
+import heapq
 import logging
 import tarfile
 import shutil
-import json
-from io import BytesIO
-from typing import List
-from uuid import uuid1
+import socket
+import threading
+import time
+from io import RawIOBase
+from tempfile import SpooledTemporaryFile
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 from pathlib import Path
 import os
 
 import docker
 import docker.types
 from docker.errors import APIError
-from requests.exceptions import ConnectionError
+from docker.models.containers import Container
+from docker.utils.socket import (
+    consume_socket_output,
+    demux_adaptor,
+    frames_iter,
+)
+from dispatcher.metrics import timed
+import zygote
 
 
 class OutputLimitExceed(Exception):
     pass
 
 
+class ChunkStream(RawIOBase):
+    '''
+    read-only file object over an iterator of bytes chunks
+    '''
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.buf = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not len(self.buf):
+            try:
+                self.buf = memoryview(next(self.chunks))
+            except StopIteration:
+                return 0
+        size = min(len(b), len(self.buf))
+        b[:size] = self.buf[:size]
+        self.buf = self.buf[size:]
+        return size
+
+
+class ExecStream:
+    '''
+    (stdout, stderr) chunks of an exec, it can be closed without reading
+    the rest
+    '''
+    def __init__(self, sock):
+        self.sock = sock
+
+    def __iter__(self):
+        for stream_id, data in frames_iter(self.sock, tty=False):
+            yield demux_adaptor(stream_id, data)
+
+    def close(self):
+        raw = getattr(self.sock, '_sock', self.sock)
+        try:
+            raw.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # already closed by daemon
+            pass
+        self.sock.close()
+        raw.close()
+
+
+class OutputFile(SpooledTemporaryFile):
+    '''
+    file produced by submission, kept in memory until it gets large
+    '''
+    def __init__(self, name: str, max_size: int = 2**20):
+        super().__init__(max_size=max_size)
+        self._name = name
+
+    @property
+    def name(self):
+        return self._name
+
+
 class SandboxResult:
     SUCCESS = 0
     OUTPUT_LIMIT_EXCEED = 1
     JUDGER_ERROR = 2
+    TIME_LIMIT_EXCEED = 3
+
+
+class Watchdog:
+    '''
+    one thread calling callbacks at their deadlines, shared by sandboxes
+    to stop programs exceed time limit
+    '''
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        # (deadline, watch id), earliest first
+        self.heap: List[Tuple[float, int]] = []
+        # {watch id: callback} not fired or cancelled yet
+        self.pending: Dict[int, Callable[[], None]] = {}
+        self.seq = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def default(cls) -> 'Watchdog':
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def watch(self, timeout: float, callback: Callable[[], None]) -> int:
+        '''
+        call `callback` after `timeout` seconds unless it's cancelled
+
+        Returns:
+            id used to cancel it
+        '''
+        with self.cond:
+            self.seq += 1
+            heapq.heappush(self.heap, (time.monotonic() + timeout, self.seq))
+            self.pending[self.seq] = callback
+            self.cond.notify()
+            return self.seq
+
+    def cancel(self, watch_id: int) -> bool:
+        '''
+        Returns:
+            False if the callback has been fired
+        '''
+        with self.cond:
+            return self.pending.pop(watch_id, None) is not None
+
+    def run(self):
+        while True:
+            with self.cond:
+                # skip cancelled ones
+                while self.heap and self.heap[0][1] not in self.pending:
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+                deadline, watch_id = self.heap[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+                heapq.heappop(self.heap)
+                callback = self.pending.pop(watch_id)
+            # don't let a slow callback delay other deadlines
+            threading.Thread(target=callback, daemon=True).start()
 
 
 class Sandbox:
+    # cgroup files read after the program exits, the container is used
+    # only once, so they count this submission only
+    USAGE_FILES = (
+        # cgroup v2
+        'cpu.stat',
+        'memory.peak',
+        'io.stat',
+        # cgroup v1
+        'cpuacct/cpuacct.usage',
+        'memory/memory.max_usage_in_bytes',
+        'blkio/blkio.throttle.io_service_bytes',
+    )
+
     def __init__(
         self,
         time_limit: int,
@@ -33,22 +184,125 @@ class Sandbox:
         file_size_limit: int,
         src_dir: str,
         ignores: List[str],
-        container_src_dir: str,
         image: str,
+        pool=None,
+        client: Optional[docker.DockerClient] = None,
+        input_hashes: Optional[Dict[str, str]] = None,
+        watchdog: Optional[Watchdog] = None,
+        cpuset: Optional[str] = None,
+        tmpfs_size: Optional[int] = None,
+        use_zygote: bool = False,
+        tasks: Optional[List[dict]] = None,
     ):
         self.time_limit = time_limit  # int:ms
         self.mem_limit = mem_limit  # int:kb
         self.file_size_limit = file_size_limit  # int:byte
         self.output_size_limit = output_size_limit  # int:byte
-        # filenames should be ignored
+        # filenames should be neither copied into nor collected from
+        # container
         self.ignores = {*ignores}
         self.image = image  # str
+        # submission data, will be copied into container
         self.src_dir = src_dir
+        # {filename: sha256} of submission data, only new or modified
+        # files are collected after run
+        if input_hashes is None:
+            input_hashes = self.hash_files(src_dir)
+        self.input_hashes = input_hashes
         self.working_dir = '/sandbox'
-        self.client = docker.DockerClient.from_env()
-        self.container = None
-        self.container_src_dir = container_src_dir
-        self.is_OJ = os.path.exists(f'{container_src_dir}/input')
+        # share the dispatcher's client if possible
+        self.client = client or docker.DockerClient.from_env()
+        # lease container from pool if provided
+        self.pool = pool
+        self.container: Optional[Container] = None
+        self.is_OJ = os.path.exists(f'{src_dir}/input')
+        # testcases run one after another in the same container, each
+        # task has `time_limit`, `mem_limit` and `case_count`
+        self.cases = self.find_cases(src_dir, tasks or [])
+        # program shouldn't read expected output
+        self.ignores.update(f'{c["name"]}.out' for c in self.cases)
+        # memory limit (in kb) the container currently has
+        self.container_mem_limit = mem_limit
+        self.is_timeout = False
+        # set after a fired timeout finishes killing the program
+        self.timeout_done = threading.Event()
+        # dedicated cores, e.g. `0,1`. None for no pinning
+        self.cpuset = cpuset
+        # size (in bytes) of tmpfs mounted at working dir of containers
+        # created by this sandbox, None to use container's writable layer
+        self.tmpfs_size = tmpfs_size
+        # run program by the warm interpreter in pooled containers
+        self.use_zygote = use_zygote
+        # kill container when time limit is exceeded
+        self.watchdog = watchdog or Watchdog.default()
+        # {phase: seconds} spent in each step of run
+        self.timings: Dict[str, float] = {}
+
+    @classmethod
+    def create_container(
+        cls,
+        client: docker.DockerClient,
+        image: str,
+        mem_limit: int,
+        nano_cpus: int = 10**9,
+        cpuset_cpus: Optional[str] = None,
+        tmpfs_size: Optional[int] = None,
+        use_zygote: bool = False,
+    ) -> Container:
+        '''
+        create and start an idle judger container, submissions are run
+        inside it by `exec`
+
+        Args:
+            tmpfs_size: if given, working dir is a tmpfs of this many
+                bytes, so files written by submission never reach disk
+            use_zygote: run a warm python interpreter as main process,
+                it's ready when this returns
+        '''
+        tmpfs = None
+        if tmpfs_size is not None:
+            tmpfs = {'/sandbox': f'size={tmpfs_size},mode=1777'}
+        # keep container alive until it is removed
+        command = ['tail', '-f', '/dev/null']
+        if use_zygote:
+            command = zygote.command()
+        container = client.containers.create(
+            image=image,
+            command=command,
+            network_disabled=True,
+            working_dir='/sandbox',
+            mem_limit=f'{mem_limit}k',
+            # no swap, so memory limit can be changed by `update`
+            memswap_limit=f'{mem_limit}k',
+            # storage_opt={
+            #     'size': '64M',
+            # },
+            pids_limit=1024,
+            nano_cpus=nano_cpus,
+            cpuset_cpus=cpuset_cpus,
+            tmpfs=tmpfs,
+        )
+        container.start()
+        if use_zygote:
+            # pooled containers are paused, let it finish imports first
+            container.exec_run(['sh', '-c', zygote.wait_command()])
+        return container
+
+    @classmethod
+    def hash_files(cls, src_dir: str) -> Dict[str, str]:
+        '''
+        calculate sha256 of each file directly under `src_dir`
+        '''
+        ret = {}
+        for f in Path(src_dir).iterdir():
+            if not f.is_file():
+                continue
+            h = hashlib.sha256()
+            with f.open('rb') as fp:
+                for chunk in iter(lambda: fp.read(2**16), b''):
+                    h.update(chunk)
+            ret[f.name] = h.hexdigest()
+        return ret
 
     @classmethod
     def judge_error_result(cls):
@@ -60,137 +314,690 @@ class Sandbox:
             'result': 1,
         }
 
-    def run(self):
-        # docker container settings
-        volume = {
-            self.src_dir: {
-                'bind': self.working_dir,
-                'mode': 'rw'
-            },
-        }
-        command = f'python3 main.py'
-        if self.is_OJ:
-            command += ' < input'
-        self.container = self.client.containers.create(
-            image=self.image,
-            # FIXME: Use `sh` to include can correctly get the redirected input
-            #   But...why?
-            command=['sh', '-c', command],
-            volumes=volume,
-            network_disabled=True,
-            working_dir=self.working_dir,
-            mem_limit=f'{self.mem_limit}k',
-            # storage_opt={
-            #     'size': '64M',
-            # },
-            pids_limit=1024,
-            nano_cpus=10**9,
+    def acquire_container(self) -> Container:
+        if self.pool is not None:
+            container = self.pool.lease()
+            # pooled containers are created with the default limit
+            update = {}
+            if container.attrs['HostConfig']['Memory'] != self.mem_limit * 1024:
+                update['mem_limit'] = f'{self.mem_limit}k'
+                update['memswap_limit'] = f'{self.mem_limit}k'
+            if self.cpuset is not None:
+                update['cpuset_cpus'] = self.cpuset
+            if update:
+                try:
+                    container.update(**update)
+                except APIError:
+                    self.pool.release(container)
+                    raise
+            return container
+        return self.create_container(
+            self.client,
+            self.image,
+            self.mem_limit,
+            cpuset_cpus=self.cpuset,
+            tmpfs_size=self.tmpfs_size,
         )
+
+    def release_container(self):
+        if self.container is None:
+            return
+        if self.pool is not None:
+            self.pool.release(self.container)
+        else:
+            self.container.remove(force=True)
+
+    def archive_src(self) -> SpooledTemporaryFile:
+        '''
+        pack submission data into a tar to be put into container, it's
+        kept in memory until it gets large
+        '''
+        data = SpooledTemporaryFile(max_size=2**22)
+        with tarfile.open(fileobj=data, mode='w') as tar:
+            for f in Path(self.src_dir).iterdir():
+                if f.name in self.ignores:
+                    continue
+                tar.add(f, arcname=f.name, filter=self.writable)
+        data.seek(0)
+        return data
+
+    @classmethod
+    def writable(cls, info: tarfile.TarInfo) -> tarfile.TarInfo:
+        # stored data is read-only on our side, but submission can modify it
+        info.mode |= 0o200
+        return info
+
+    def kill(self):
+        if self.cases:
+            try:
+                # stop the program only, rest cases run in the container.
+                # the main process (pid 1) is not killed
+                _, stream = self.exec_stream(['sh', '-c', 'kill -9 -1'])
+                for _ in stream:
+                    pass
+                return
+            except APIError as e:
+                # rest cases will fail, but the program must stop
+                logging.warning(
+                    f'Fail to kill program, kill container [err={e}]')
         try:
-            # start and wait container
-            self.container.start()
-            api_resp = self.container.wait(timeout=self.time_limit)
-            logging.debug(f'Get docker response: {json.dumps(api_resp)}')
+            self.container.kill()
+        except APIError as e:
+            logging.warning(f'Fail to kill container [err={e}]')
+
+    def timeout(self):
+        try:
+            self.is_timeout = True
+            self.kill()
+        finally:
+            self.timeout_done.set()
+
+    def exec_stream(self, cmd: List[str]):
+        '''
+        start a command inside container
+
+        Returns:
+            exec id and the stream of (stdout, stderr) chunks
+        '''
+        api = self.client.api
+        exec_id = api.exec_create(
+            self.container.id,
+            cmd,
+            workdir=self.working_dir,
+        )['Id']
+        return exec_id, ExecStream(api.exec_start(exec_id, socket=True))
+
+    def read_output(self, stream) -> Tuple[bytes, bytes]:
+        '''
+        read multiplexed (stdout, stderr) chunks until the stream ends
+
+        Raises:
+            OutputLimitExceed: either stdout or stderr exceeds the limit,
+                the rest of stream is not consumed, caller should close it
+        '''
+        stdout, stderr = bytearray(), bytearray()
+        for out, err in stream:
+            if out:
+                stdout += out
+            if err:
+                stderr += err
+            if len(stdout) > self.output_size_limit or \
+                 len(stderr) > self.output_size_limit:
+                raise OutputLimitExceed
+        return bytes(stdout), bytes(stderr)
+
+    def run(self):
+        try:
+            with timed(self.timings, 'lease'):
+                self.container = self.acquire_container()
         except APIError as e:
-            self.container.remove(force=True)
             logging.error(f'Docker API error [err={e}]')
             return self.judge_error_result()
-        except ConnectionError:
-            self.container.remove(force=True)
-            logging.info(f'Container timeout')
-            # TODO: Add TLE status
-            return self.judge_error_result()
-        # result retrive
         try:
-            # assume judge successful
-            status = SandboxResult.SUCCESS
-            # check output size
-            stdout = self.container.logs(
-                stdout=True,
-                stderr=False,
+            if self.cases:
+                return self._run_cases()
+            return self._run()
+        finally:
+            with timed(self.timings, 'release'):
+                self.release_container()
+
+    def exec_stdin(
+        self,
+        cmd: List[str],
+        chunks: Iterable[bytes],
+    ) -> Tuple[int, bytes]:
+        '''
+        run a command inside container, with `chunks` as its stdin
+
+        Returns:
+            exit code and stderr of the command
+        '''
+        api = self.client.api
+        exec_id = api.exec_create(
+            self.container.id,
+            cmd,
+            stdin=True,
+            workdir=self.working_dir,
+        )['Id']
+        sock = api.exec_start(exec_id, socket=True)
+        try:
+            raw = getattr(sock, '_sock', sock)
+            for chunk in chunks:
+                raw.sendall(chunk)
+            # let the command see eof
+            raw.shutdown(socket.SHUT_WR)
+            _, stderr = consume_socket_output(
+                frames_iter(sock, tty=False),
+                demux=True,
             )
-            stderr = self.container.logs(
-                stdout=False,
-                stderr=True,
+        finally:
+            sock.close()
+        return api.exec_inspect(exec_id)['ExitCode'], stderr or b''
+
+    def inject(self):
+        with timed(self.timings, 'inject'), self.archive_src() as data:
+            # sent in chunks, without copying the whole tar
+            chunks = iter(lambda: data.read(2**16), b'')
+            if self.tmpfs_size is None:
+                self.container.put_archive(self.working_dir, chunks)
+                return
+            # `put_archive` writes beneath the tmpfs mount, which the
+            # program can't see, extract it inside container instead
+            exit_code, stderr = self.exec_stdin(
+                ['tar', '-x', '-C', self.working_dir],
+                chunks,
             )
-            if len(stdout) > self.output_size_limit or \
-                 len(stderr) > self.output_size_limit:
+        if exit_code != 0:
+            raise APIError(f'Fail to inject submission: {stderr!r}')
+
+    def command(self, stdin: Optional[str] = None) -> str:
+        # FIXME: Use `sh` to include can correctly get the redirected input
+        #   But...why?
+        if self.use_zygote:
+            # falls back to `python3 main.py` if zygote isn't running
+            return zygote.client_command(stdin)
+        command = 'python3 main.py'
+        if stdin is not None:
+            command += f' < {stdin}'
+        return command
+
+    def exec_program(self, command: str, time_limit: int):
+        '''
+        run `command` inside container, it's stopped after `time_limit`
+        ms or once its output exceeds the limit
+
+        Returns:
+            status, stdout, stderr, exit code and wall time (in seconds)
+        Raises:
+            APIError
+        '''
+        status = SandboxResult.SUCCESS
+        stdout = stderr = b''
+        self.is_timeout = False
+        self.timeout_done.clear()
+        watch_id = None
+        try:
+            with timed(self.timings, 'exec'):
+                start = time.perf_counter()
+                watch_id = self.watchdog.watch(time_limit / 1000, self.timeout)
+                exec_id, stream = self.exec_stream(['sh', '-c', command])
+                try:
+                    stdout, stderr = self.read_output(stream)
+                except OutputLimitExceed:
+                    # stop it now, don't wait for the rest output
+                    self.kill()
+                    stream.close()
+                    status = SandboxResult.OUTPUT_LIMIT_EXCEED
+                wall_time = time.perf_counter() - start
+            exit_code = self.client.api.exec_inspect(exec_id)['ExitCode']
+            logging.debug(f'Get exec result [exit_code={exit_code}]')
+        finally:
+            # it may be firing right now
+            if watch_id is not None and not self.watchdog.cancel(watch_id):
+                self.is_timeout = True
+                # don't let it kill the next testcase
+                self.timeout_done.wait()
+        if self.is_timeout:
+            logging.info(f'Container timeout')
+            status = SandboxResult.TIME_LIMIT_EXCEED
+        return status, stdout, stderr, exit_code, wall_time
+
+    @classmethod
+    def describe(cls, status: int, stdout: bytes, stderr: bytes):
+        '''
+        Returns:
+            stdout and stderr shown to user
+        '''
+        if status == SandboxResult.TIME_LIMIT_EXCEED:
+            return '', '執行失敗: 執行時間超過限制！'
+        if status == SandboxResult.OUTPUT_LIMIT_EXCEED:
+            return '', '執行失敗: 輸出大小超過系統限制，無法評測！'
+        return stdout.decode('utf-8', 'replace'), \
+            stderr.decode('utf-8', 'replace')
+
+    def _run(self):
+        try:
+            # inject submission and run it
+            self.inject()
+            command = self.command('input' if self.is_OJ else None)
+            status, stdout, stderr, exit_code, wall_time = \
+                self.exec_program(command, self.time_limit)
+        except APIError as e:
+            logging.error(f'Docker API error [err={e}]')
+            return self.judge_error_result()
+        # result retrive
+        # in ms
+        usage = {'wallTime': round(wall_time * 1000, 3)}
+        stdout, stderr = self.describe(status, stdout, stderr)
+        if status == SandboxResult.SUCCESS:
+            with timed(self.timings, 'usage'):
+                usage.update(self.read_usage())
+            # try to get files
+            try:
+                files = self.get_files()
+            except OutputLimitExceed:
                 stdout = ''
-                stderr = '執行失敗: 輸出大小超過系統限制，無法評測！'
+                stderr = '執行失敗: 輸出檔案大小超過系統限制，無法評測！'
                 files = []
                 status = SandboxResult.OUTPUT_LIMIT_EXCEED
+            except APIError as e:
+                logging.error(f'Docker API error [err={e}]')
+                return self.judge_error_result()
+        else:
+            files = []
+        ret = {
+            'stdout': stdout,
+            'stderr': stderr,
+            'files': files,
+            'error': None,
+            'exitCode': exit_code,
+            'status': status,
+            **usage,
+        }
+        # add OJ result
+        if self.is_OJ:
+            if status == SandboxResult.OUTPUT_LIMIT_EXCEED:
+                ret['result'] = 3
+            elif status == SandboxResult.TIME_LIMIT_EXCEED:
+                ret['result'] = 2
             else:
-                stdout = stdout.decode('utf-8', 'replace')
-                stderr = stderr.decode('utf-8', 'replace')
-            # try to get files
+                with timed(self.timings, 'compare'):
+                    mismatch = self.compare(f'{self.src_dir}/output', stdout)
+                ret['result'] = 0 if mismatch is None else 1
+                if mismatch is not None:
+                    ret['mismatchLine'] = mismatch
+        return ret
+
+    def compare(self, expected_path: str, stdout: str) -> Optional[int]:
+        '''
+        compare output with the expected one line by line, trailing
+        spaces and blank lines are ignored. the expected file is read
+        while comparing, and stops at the first mismatch.
+
+        Returns:
+            line number of the first mismatch, None if output is correct
+        '''
+        with open(expected_path, 'r', newline='') as f:
+            return self.first_mismatch(
+                self.file_lines(f),
+                self.text_lines(stdout),
+            )
+
+    @classmethod
+    def find_cases(cls, src_dir: str, tasks: List[dict]) -> List[dict]:
+        '''
+        list testcases of `tasks`, the j-th case of i-th task is
+        `<ii><jj>.in` / `.out`
+
+        Returns:
+            cases with their task's limits, empty if some files are
+            missing
+        '''
+        cases = []
+        for i, task in enumerate(tasks):
+            for j in range(task['case_count']):
+                name = f'{i:02d}{j:02d}'
+                if not os.path.exists(f'{src_dir}/{name}.in') or \
+                        not os.path.exists(f'{src_dir}/{name}.out'):
+                    return []
+                cases.append({
+                    'name': name,
+                    'task': i,
+                    'case': j,
+                    'time_limit': task['time_limit'],
+                    'mem_limit': task['mem_limit'],
+                })
+        return cases
+
+    def resize(self, mem_limit: int) -> bool:
+        '''
+        change memory limit (in kb) of container between testcases
+
+        Returns:
+            whether the container has the new limit
+        '''
+        if mem_limit == self.container_mem_limit:
+            return True
+        try:
+            self.container.update(
+                mem_limit=f'{mem_limit}k',
+                memswap_limit=f'{mem_limit}k',
+            )
+            self.container_mem_limit = mem_limit
+            return True
+        except APIError as e:
+            # e.g. memory in use (page cache) is over the new limit
+            logging.error(
+                'Fail to change memory limit '
+                f'[limit={self.container_mem_limit}, err={e}]', )
+            return False
+
+    def run_case(self, case: dict) -> dict:
+        if not self.resize(case['mem_limit']):
+            # judged with a wrong limit is worse than not judged
+            return {
+                'task': case['task'],
+                'case': case['case'],
+                'result': self.judge_error_result()['result'],
+                'status': SandboxResult.JUDGER_ERROR,
+                'exitCode': None,
+                'wallTime': 0,
+                'stdout': '',
+                'stderr': '',
+            }
+        status, stdout, stderr, exit_code, wall_time = self.exec_program(
+            self.command(f'{case["name"]}.in'),
+            case['time_limit'],
+        )
+        # background processes left by the program may disturb next case
+        self.kill()
+        stdout, stderr = self.describe(status, stdout, stderr)
+        if status == SandboxResult.OUTPUT_LIMIT_EXCEED:
+            result = 3
+        elif status == SandboxResult.TIME_LIMIT_EXCEED:
+            result = 2
+        elif exit_code == 137:
+            # killed by OOM killer
+            result = 4
+        else:
+            with timed(self.timings, 'compare'):
+                expected_path = f'{self.src_dir}/{case["name"]}.out'
+                mismatch = self.compare(expected_path, stdout)
+            result = 0 if mismatch is None else 1
+        ret = {
+            'task': case['task'],
+            'case': case['case'],
+            'result': result,
+            'status': status,
+            'exitCode': exit_code,
+            # in ms
+            'wallTime': round(wall_time * 1000, 3),
+            'stdout': stdout,
+            'stderr': stderr,
+        }
+        if result == 1:
+            ret['mismatchLine'] = mismatch
+        return ret
+
+    def _run_cases(self):
+        '''
+        run every testcase one after another in the same container
+        '''
+        try:
+            self.inject()
+            cases = [self.run_case(case) for case in self.cases]
+            with timed(self.timings, 'usage'):
+                usage = self.read_usage()
+            status = SandboxResult.SUCCESS
             try:
                 files = self.get_files()
             except OutputLimitExceed:
-                stdout = ''
-                stderr = '執行失敗: 輸出檔案大小超過系統限制，無法評測！'
                 files = []
                 status = SandboxResult.OUTPUT_LIMIT_EXCEED
         except APIError as e:
-            self.container.remove(force=True)
             logging.error(f'Docker API error [err={e}]')
             return self.judge_error_result()
-        finally:
-            # remove containers
-            self.container.remove(force=True)
-            ret = {
-                'stdout': stdout,
-                'stderr': stderr,
-                'files': files,
-                'error': api_resp.get('Error', None),
-                'exitCode': api_resp.get('StatusCode', None),
-                'status': status,
-            }
-            # add OJ result
-            if self.is_OJ:
-                if status == SandboxResult.OUTPUT_LIMIT_EXCEED:
-                    ret['result'] = 3
-                else:
-                    ret['result'] = 1
-                    with open(f'{self.container_src_dir}/output', 'r') as f:
-                        if self.strip(f.read()) == self.strip(stdout):
-                            ret['result'] = 0
-            return ret
+        # the first failed case represents this submission
+        failed = [c for c in cases if c['result'] != 0]
+        summary = failed[0] if len(failed) else cases[-1]
+        ret = {
+            'stdout': summary['stdout'],
+            'stderr': summary['stderr'],
+            'files': files,
+            'error': None,
+            'exitCode': summary['exitCode'],
+            'status': summary['status'],
+            'result': summary['result'],
+            'cases': cases,
+            **usage,
+            'wallTime': sum(c['wallTime'] for c in cases),
+        }
+        if status == SandboxResult.OUTPUT_LIMIT_EXCEED:
+            ret['stdout'] = ''
+            ret['stderr'] = '執行失敗: 輸出檔案大小超過系統限制，無法評測！'
+            ret['status'] = status
+            ret['result'] = 3
+        return ret
+
+    def read_usage(self) -> dict:
+        '''
+        read resource usage of the container from its cgroup files
+
+        Returns:
+            cpuTime (ms), memoryUsage (peak, kb), ioRead and ioWrite
+            (byte), missing ones are omitted
+        '''
+        files = ' '.join(self.USAGE_FILES)
+        script = (f'cd /sys/fs/cgroup; for f in {files}; do '
+                  '[ -f "$f" ] && echo "== $f" && cat "$f"; done; true')
+        try:
+            _, stream = self.exec_stream(['sh', '-c', script])
+            out = b''.join(out for out, _ in stream if out)
+        except APIError as e:
+            logging.warning(f'Fail to read resource usage [err={e}]')
+            return {}
+        return self.parse_usage(out.decode('utf-8', 'replace'))
+
+    @classmethod
+    def parse_usage(cls, text: str) -> dict:
+        # {filename: lines}
+        files = {}
+        lines = None
+        for line in text.splitlines():
+            if line.startswith('== '):
+                lines = files[line[3:]] = []
+            elif lines is not None and line.strip():
+                lines.append(line.split())
+        try:
+            return cls.usage_of(files)
+        except ValueError as e:
+            # e.g. unknown format of a newer kernel
+            logging.warning(f'Fail to parse resource usage [err={e}]')
+            return {}
+
+    @classmethod
+    def usage_of(cls, files: Dict[str, List[List[str]]]) -> dict:
+        '''
+        Raises:
+            ValueError: a file isn't in the expected format
+        '''
+        usage = {}
+        for key, value in files.get('cpu.stat', []):
+            if key == 'usage_usec':
+                usage['cpuTime'] = int(value) / 1000
+        for value, in files.get('cpuacct/cpuacct.usage', []):
+            usage['cpuTime'] = int(value) / 10**6
+        for value, in files.get(
+                'memory.peak',
+                files.get('memory/memory.max_usage_in_bytes', []),
+        ):
+            usage['memoryUsage'] = int(value) // 1024
+        # `<device> rbytes=.. wbytes=.. ...`
+        if 'io.stat' in files:
+            usage['ioRead'] = usage['ioWrite'] = 0
+        for _, *fields in files.get('io.stat', []):
+            stat = dict(f.split('=', 1) for f in fields)
+            usage['ioRead'] += int(stat.get('rbytes', 0))
+            usage['ioWrite'] += int(stat.get('wbytes', 0))
+        # `<device> <Read|Write|...> <bytes>`, and a `Total <bytes>` line
+        blkio = files.get('blkio/blkio.throttle.io_service_bytes', [])
+        if len(blkio):
+            usage['ioRead'] = usage['ioWrite'] = 0
+        for fields in blkio:
+            if len(fields) != 3:
+                continue
+            if fields[1] == 'Read':
+                usage['ioRead'] += int(fields[2])
+            elif fields[1] == 'Write':
+                usage['ioWrite'] += int(fields[2])
+        return usage
+
+    def changed_files(self) -> List[str]:
+        '''
+        list files directly under working dir which are new or different
+        from submission data
+        '''
+        _, stream = self.exec_stream([
+            'find',
+            '.',
+            '-maxdepth',
+            '1',
+            '-type',
+            'f',
+            '-exec',
+            'sha256sum',
+            '{}',
+            '+',
+        ])
+        output = b''.join(out for out, _ in stream if out)
+        ret = []
+        # each line looks like `<sha256>  ./<filename>`, don't split at
+        # other line breaks which are allowed in filenames
+        for line in output.decode('utf-8', 'replace').split('\n'):
+            if not line:
+                continue
+            digest, path = line.split('  ', 1)
+            # filename contains `\\`, `\n` or `\r`, they are escaped
+            if digest.startswith('\\'):
+                digest = digest[1:]
+                path = self.unescape(path)
+            name = path[2:]
+            if name in self.ignores:
+                continue
+            if self.input_hashes.get(name) == digest:
+                continue
+            ret.append(name)
+        return ret
+
+    @classmethod
+    def unescape(cls, name: str) -> str:
+        '''
+        restore a filename escaped by `sha256sum`
+        '''
+        ret = []
+        chars = iter(name)
+        for c in chars:
+            if c != '\\':
+                ret.append(c)
+                continue
+            c = next(chars, '')
+            ret.append({'n': '\n', 'r': '\r'}.get(c, c))
+        return ''.join(ret)
 
     def get_files(self):
         if self.container is None:
             return []
-        # get user dir archive
-        bits, _ = self.container.get_archive('/sandbox')
-        tarbits = b''.join(bits)
-        tar = tarfile.open(fileobj=BytesIO(tarbits))
-        # check file size
-        total_size = sum(info.size for info in tar.getmembers())
-        if total_size > self.file_size_limit:
-            raise OutputLimitExceed
-        # extract files
-        extract_path = f'/tmp/{uuid1()}'
-        tar.extractall(extract_path)
-        extract_path = Path(extract_path) / 'sandbox'
-        # save files {name: data}
+        with timed(self.timings, 'diff'):
+            names = self.changed_files()
+        if not names:
+            return []
+        with timed(self.timings, 'archive'):
+            return self.read_archive(names)
+
+    def read_archive(self, names: List[str]):
+        '''
+        Raises:
+            OutputLimitExceed: total size of files exceeds the limit
+            APIError: `tar` fails, e.g. a file is removed
+        '''
+        # archive changed files, it's read while being transferred
+        exec_id, stream = self.exec_stream(
+            ['tar', '-c', '-f', '-', '--', *names])
+        bits = (out for out, _ in stream if out)
         ret = []
-        for f in extract_path.iterdir():
-            # ignored files
-            if f.name in self.ignores:
-                continue
-            # skip directory
-            if f.is_dir():
-                continue
-            ret.append(f.open('rb'))
-        # remove tmp data
-        shutil.rmtree(extract_path)
+        try:
+            with tarfile.open(fileobj=ChunkStream(bits), mode='r|') as tar:
+                total_size = 0
+                for info in tar:
+                    # check file size
+                    total_size += info.size
+                    if total_size > self.file_size_limit:
+                        raise OutputLimitExceed
+                    if not info.isfile():
+                        continue
+                    f = OutputFile(info.name)
+                    ret.append(f)
+                    shutil.copyfileobj(tar.extractfile(info), f)
+                    f.seek(0)
+            # let it exit, the end of archive may be followed by padding
+            for _ in bits:
+                pass
+            exit_code = self.client.api.exec_inspect(exec_id)['ExitCode']
+            if exit_code != 0:
+                raise APIError(
+                    f'Fail to archive files [exit_code={exit_code}]')
+        except BaseException:
+            for f in ret:
+                f.close()
+            raise
+        finally:
+            # don't leave the rest of archive on the connection
+            stream.close()
         logging.debug(f'Extract files [files={[f.name for f in ret]}]')
         return ret
 
     @classmethod
-    def strip(cls, s: str) -> list:
-        # strip trailing space for each line
-        ss = [s.rstrip() for s in s.splitlines()]
-        # strip redundant new line
-        while len(ss) and ss[-1] == '':
-            del ss[-1]
-        return ss
+    def file_lines(cls, f, size: int = 2**16) -> Iterator[List[str]]:
+        '''
+        read lines of a text file opened with `newline=''` in blocks of
+        about `size` characters, lines are split like `str.splitlines`
+        and have trailing spaces stripped
+        '''
+        while True:
+            block = f.read(size)
+            if not block:
+                return
+            # end at a line break
+            block += f.readline()
+            yield [line.rstrip() for line in block.splitlines()]
+
+    @classmethod
+    def text_lines(cls, s: str, size: int = 2**16) -> Iterator[List[str]]:
+        '''
+        same as `file_lines`, but lines of a string
+        '''
+        start = 0
+        while start < len(s):
+            end = s.find('\n', start + size)
+            end = len(s) if end == -1 else end + 1
+            yield [line.rstrip() for line in s[start:end].splitlines()]
+            start = end
+
+    @classmethod
+    def first_mismatch(
+        cls,
+        expected: Iterable[List[str]],
+        actual: Iterable[List[str]],
+    ) -> Optional[int]:
+        '''
+        compare blocks of stripped lines, trailing blank lines are ignored
+
+        Returns:
+            line number (from 1) of the first different line, None if
+            they match
+        '''
+        expected, actual = iter(expected), iter(actual)
+        e, a = [], []
+        # line number of e[0] and a[0]
+        line = 1
+        while True:
+            if not e:
+                e = next(expected, None)
+            if not a:
+                a = next(actual, None)
+            if e is None or a is None:
+                break
+            n = min(len(e), len(a))
+            if e[:n] != a[:n]:
+                return line + next(i for i in range(n) if e[i] != a[i])
+            e, a = e[n:], a[n:]
+            line += n
+        # the longer one can only have blank lines left
+        rest, blocks = (e, expected) if a is None else (a, actual)
+        while rest is not None:
+            for i, s in enumerate(rest):
+                if s:
+                    return line + i
+            line += len(rest)
+            rest = next(blocks, None)
+        return None
@@ -0,0 +1,59 @@
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from sandbox import Sandbox
+
+
+def strip(s: str) -> list:
+    # the comparator used before, as a baseline
+    ss = [s.rstrip() for s in s.splitlines()]
+    while len(ss) and ss[-1] == '':
+        del ss[-1]
+    return ss
+
+
+def compare_by_strip(expected_path: str, stdout: str) -> bool:
+    with open(expected_path, 'r') as f:
+        return strip(f.read()) == strip(stdout)
+
+
+def bench(compare, expected_path: str, stdout: str):
+    '''
+    Returns:
+        seconds and peak memory (bytes) allocated by a comparison
+    '''
+    start = time.perf_counter()
+    compare(expected_path, stdout)
+    elapsed = time.perf_counter() - start
+    # measured in another run, tracing slows it down
+    tracemalloc.start()
+    compare(expected_path, stdout)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+if __name__ == '__main__':
+    # size of expected output in MB
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    line = ' '.join(map(str, range(16))) + ' \n'
+    count = size * 2**20 // len(line)
+    sandbox = Sandbox.__new__(Sandbox)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        expected_path = str(Path(tmp_dir) / 'output')
+        Path(expected_path).write_text(line * count)
+        for name, stdout in (
+            ('match', line * count),
+                # wrong at the first line, e.g. a wrong answer
+            ('mismatch', 'wrong\n' + line * (count - 1)),
+        ):
+            for method, compare in (
+                ('strip', compare_by_strip),
+                ('stream', sandbox.compare),
+            ):
+                elapsed, peak = bench(compare, expected_path, stdout)
+                print(
+                    f'{name:<8} {method:<6} {1000 * elapsed:8.1f} ms, '
+                    f'peak memory {peak / 2**20:7.1f} MB', )
@@ -0,0 +1,90 @@
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+import docker
+from dispatcher.cpuset import CpusetSlots
+from sandbox import Sandbox
+
+# cpu-bound program with fixed amount of work
+SOURCE = '''
+n = 0
+for i in range(3 * 10**6):
+    n += i * i
+print(n)
+'''
+
+
+def bench(
+    client: docker.DockerClient,
+    image: str,
+    src_dir: str,
+    count: int,
+    cores: List[int],
+    pinned: bool,
+):
+    '''
+    run `count` submissions with one container for each core at the same
+    time, containers are pinned to their own core if `pinned`
+
+    Returns:
+        throughput (submissions per second) and wall time of each run
+    '''
+    slots = CpusetSlots(cores)
+    lock = threading.Lock()
+
+    def run(_) -> Optional[float]:
+        with lock:
+            slot = slots.acquire()
+        sandbox = Sandbox(
+            time_limit=60000,
+            mem_limit=128000,
+            output_size_limit=4096,
+            file_size_limit=64 * 10**6,
+            src_dir=src_dir,
+            ignores=['__pycache__'],
+            image=image,
+            client=client,
+            cpuset=slots.cpuset(slot) if pinned else None,
+        )
+        try:
+            return sandbox.run().get('wallTime')
+        finally:
+            with lock:
+                slots.release(slot)
+
+    with ThreadPoolExecutor(max_workers=len(cores)) as executor:
+        start = time.perf_counter()
+        wall_times = [*executor.map(run, range(count))]
+        elapsed = time.perf_counter() - start
+    return count / elapsed, [t for t in wall_times if t is not None]
+
+
+if __name__ == '__main__':
+    image = sys.argv[1] if len(sys.argv) > 1 else \
+        'registry.gitlab.com/pyshare/judger'
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    cores = CpusetSlots.parse(sys.argv[3]) if len(sys.argv) > 3 else \
+        [*range(os.cpu_count())]
+    client = docker.from_env()
+    with tempfile.TemporaryDirectory() as src_dir:
+        (Path(src_dir) / 'main.py').write_text(SOURCE)
+        for pinned in (False, True):
+            throughput, wall_times = bench(
+                client,
+                image,
+                src_dir,
+                count,
+                cores,
+                pinned,
+            )
+            mode = 'pinned' if pinned else 'unpinned'
+            print(
+                f'{mode:<8} {throughput:6.2f} submission/s, '
+                f'wall time {statistics.mean(wall_times):8.1f} ms '
+                f'(stdev {statistics.pstdev(wall_times):6.1f} ms)', )
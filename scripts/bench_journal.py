@@ -0,0 +1,46 @@
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from dispatcher.journal import Journal
+
+
+def bench(directory: str, thread_count: int, record_count: int) -> float:
+    '''
+    let `thread_count` threads enqueue submissions concurrently, each
+    waits for its record being synced like `Dispatcher.handle` does. the
+    journal is written under `directory`, it should be on the same disk
+    as `journal_path`.
+
+    Returns:
+        enqueue throughput (records per second)
+    '''
+    with tempfile.TemporaryDirectory(dir=directory) as tmp_dir:
+        journal = Journal(Path(tmp_dir) / 'bench.journal')
+
+        def enqueue(worker: int):
+            for i in range(record_count):
+                journal.record(f'{worker}-{i}', Journal.ENQUEUE, sync=True)
+
+        threads = [
+            threading.Thread(target=enqueue, args=(i, ))
+            for i in range(thread_count)
+        ]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        journal.close()
+    return thread_count * record_count / elapsed
+
+
+if __name__ == '__main__':
+    record_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    # default `journal_path` is under working dir
+    directory = sys.argv[2] if len(sys.argv) > 2 else '.'
+    for thread_count in (1, 5, 20, 50):
+        throughput = bench(directory, thread_count, record_count)
+        print(f'threads={thread_count:<3} {throughput:10.1f} enqueue/s')
@@ -0,0 +1,83 @@
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+import docker
+from dispatcher.dispatcher import Dispatcher
+from dispatcher.pool import ContainerPool
+from sandbox import Sandbox
+
+# trivial program, so the run time is mostly interpreter startup
+SOURCE = '''
+import sys
+print(sys.stdin.readline().strip())
+'''
+
+
+def bench(
+    client: docker.DockerClient,
+    image: str,
+    src_dir: str,
+    count: int,
+    use_zygote: bool,
+) -> List[float]:
+    '''
+    run `count` submissions one by one in pre-created containers, started
+    by a new interpreter or forked by the zygote
+
+    Returns:
+        time (ms) of `exec` phase of each run
+    '''
+    pool = ContainerPool(
+        factory=lambda: Sandbox.create_container(
+            client,
+            image,
+            128000,
+            use_zygote=use_zygote,
+        ),
+        size=count,
+    )
+    pool.start()
+    # every run should lease a warm container
+    while pool.stats()['idle'] < count:
+        time.sleep(0.1)
+    exec_times = []
+    for _ in range(count):
+        sandbox = Sandbox(
+            time_limit=10000,
+            mem_limit=128000,
+            output_size_limit=4096,
+            file_size_limit=64 * 10**6,
+            src_dir=src_dir,
+            ignores=['__pycache__'],
+            image=image,
+            pool=pool,
+            client=client,
+            use_zygote=use_zygote,
+        )
+        res = sandbox.run()
+        assert res.get('result') == 0, res
+        exec_times.append(1000 * sandbox.timings['exec'])
+    pool.close()
+    return exec_times
+
+
+if __name__ == '__main__':
+    image = sys.argv[1] if len(sys.argv) > 1 else \
+        'registry.gitlab.com/pyshare/judger'
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    client = docker.from_env()
+    with tempfile.TemporaryDirectory() as src_dir:
+        (Path(src_dir) / 'main.py').write_text(SOURCE)
+        (Path(src_dir) / 'input').write_text('hello\n')
+        (Path(src_dir) / 'output').write_text('hello\n')
+        for use_zygote in (False, True):
+            exec_times = bench(client, image, src_dir, count, use_zygote)
+            exec_times.sort()
+            p50, p90 = [Dispatcher.percentile(exec_times, q) for q in (50, 90)]
+            mode = 'zygote' if use_zygote else 'cold'
+            print(
+                f'{mode:<6} exec mean {statistics.mean(exec_times):7.1f} ms, '
+                f'p50 {p50:7.1f} ms, p90 {p90:7.1f} ms', )
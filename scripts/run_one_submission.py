@@ -13,13 +13,12 @@ def run(script_path: Path):
         raise ValueError(f'{script_path} is not a file')
     with prepare_src_dir(script_path) as src_dir:
         sandbox = Sandbox(
-            time_limit=10,
+            time_limit=10000,
             mem_limit=128000,
             output_size_limit=4096,
             file_size_limit=64 * 10**6,
             src_dir=src_dir,
-            ignores=['__pycache__', 'main.py'],
-            container_src_dir=src_dir,
+            ignores=['__pycache__'],
             image='registry.gitlab.com/pyshare/judger',
         )
         return sandbox.run()
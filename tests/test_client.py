@@ -0,0 +1,72 @@
+from requests.exceptions import ConnectionError
+from dispatcher import client as client_module
+from dispatcher.client import SharedDockerClient
+
+
+class FakeDockerClient:
+    '''
+    docker client whose daemon is restarted before it is created, so the
+    first client's connection is broken
+    '''
+    created = []
+
+    def __init__(self, **ks):
+        self.ks = ks
+        self.closed = False
+        self.broken = not len(self.created)
+        self.created.append(self)
+
+    @classmethod
+    def from_env(cls, **ks):
+        return cls(**ks)
+
+    def ping(self):
+        if self.broken:
+            raise ConnectionError('daemon restarted')
+        return True
+
+    def close(self):
+        self.closed = True
+
+
+def shared_client(monkeypatch):
+    FakeDockerClient.created = []
+    monkeypatch.setattr(client_module.docker, 'DockerClient', FakeDockerClient)
+    return SharedDockerClient(max_pool_size=4)
+
+
+def test_share_one_client(monkeypatch):
+    shared = shared_client(monkeypatch)
+    assert shared.get() is shared.get()
+    assert shared.get().ks == {'max_pool_size': 4}
+
+
+def test_reconnect_after_daemon_restart(monkeypatch):
+    shared = shared_client(monkeypatch)
+    first = shared.get()
+    assert shared.ping() is True
+    # the broken client is replaced once
+    assert first.closed
+    assert shared.get() is not first
+    assert shared.reconnect_count == 1
+
+
+def test_reconnect_only_broken_client(monkeypatch):
+    shared = shared_client(monkeypatch)
+    first = shared.get()
+    shared.reconnect(first)
+    second = shared.get()
+    # another thread reports the old client again
+    shared.reconnect(first)
+    assert shared.get() is second
+    assert shared.reconnect_count == 1
+
+
+def test_daemon_unavailable(monkeypatch):
+    shared = shared_client(monkeypatch)
+
+    def ping(self):
+        raise ConnectionError('daemon is down')
+
+    monkeypatch.setattr(FakeDockerClient, 'ping', ping)
+    assert shared.ping() is False
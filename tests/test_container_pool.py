@@ -0,0 +1,49 @@
+import time
+from dispatcher.pool import ContainerPool
+
+
+class FakeContainer:
+    def __init__(self):
+        self.paused = False
+        self.removed = False
+        self.short_id = hex(id(self))
+
+    def pause(self):
+        self.paused = True
+
+    def unpause(self):
+        self.paused = False
+
+    def remove(self, force=False):
+        self.removed = True
+
+
+def wait_idle(pool, count, timeout=1):
+    end = time.time() + timeout
+    while len(pool.idle) < count and time.time() < end:
+        time.sleep(0.01)
+
+
+def test_lease_from_warm_pool():
+    pool = ContainerPool(factory=FakeContainer, size=2)
+    pool.start()
+    wait_idle(pool, 2)
+    container = pool.lease()
+    assert container.paused is False
+    assert pool.stats()['hit'] == 1
+    pool.release(container)
+    wait_idle(pool, 2)
+    assert container.removed is True
+    assert len(pool.idle) == 2
+    pool.close()
+
+
+def test_lease_miss_when_pool_empty():
+    pool = ContainerPool(factory=FakeContainer, size=0)
+    pool.start()
+    container = pool.lease()
+    assert container is not None
+    stats = pool.stats()
+    assert stats['miss'] == 1
+    assert stats['hitRate'] == 0
+    pool.close()
@@ -0,0 +1,27 @@
+import pytest
+from dispatcher.cpuset import CpusetSlots
+
+
+def test_parse():
+    assert CpusetSlots.parse('0-3,8') == [0, 1, 2, 3, 8]
+
+
+def test_split_cores():
+    slots = CpusetSlots('0-4', cores_per_slot=2)
+    # core 4 is left unused
+    assert [slots.cpuset(i) for i in range(len(slots.slots))] == ['0,1', '2,3']
+
+
+def test_acquire_and_release():
+    slots = CpusetSlots([2, 3])
+    assert slots.acquire() == 0
+    assert slots.acquire() == 1
+    assert not slots.available()
+    assert slots.acquire() is None
+    slots.release(0)
+    assert slots.acquire() == 0
+
+
+def test_too_few_cores():
+    with pytest.raises(ValueError):
+        CpusetSlots([0], cores_per_slot=2)
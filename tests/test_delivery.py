@@ -0,0 +1,188 @@
+import json
+import threading
+from io import BytesIO
+from urllib.parse import parse_qs
+import pytest
+import requests
+from dispatcher.delivery import ResultDelivery
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = ''
+
+
+class FakeBackend:
+    def __init__(self, *status_codes):
+        self.status_codes = [*status_codes]
+        self.requests = []
+
+    def put(self, url, data, files, timeout):
+        self.requests.append(
+            (url, data, [(n, f.read()) for _, (n, f, _) in files]))
+        return FakeResponse(self.status_codes.pop(0))
+
+
+@pytest.fixture
+def delivery(tmp_path):
+    return ResultDelivery(
+        backend_api='http://web:8080',
+        token='token',
+        outbox_dir=tmp_path / 'outbox',
+        backoff=0,
+    )
+
+
+def new_result(content=b'data'):
+    f = BytesIO(content)
+    f.name = 'out.txt'
+    return {'stdout': 'ok', 'status': 0, 'files': [f]}
+
+
+def test_retry_until_success(delivery):
+    backend = FakeBackend(502, 503, 200)
+    delivery.session = backend
+    assert delivery.send('a', new_result()) is True
+    assert len(backend.requests) == 3
+    url, data, files = backend.requests[-1]
+    assert url == 'http://web:8080/submission/a/complete'
+    assert data['token'] == 'token'
+    assert files == [('out.txt', b'data')]
+    assert delivery.stats()['outbox'] == 0
+
+
+def test_rejected_result_is_not_saved(delivery):
+    delivery.session = FakeBackend(400)
+    assert delivery.send('a', new_result()) is False
+    assert delivery.stats()['outbox'] == 0
+
+
+def test_resend_from_outbox(delivery):
+    delivery.session = FakeBackend(*[500] * 4)
+    assert delivery.send('a', new_result()) is False
+    assert delivery.stats()['outbox'] == 1
+    # backend still fails
+    delivery.session = FakeBackend(500)
+    delivery.drain()
+    assert delivery.stats()['outbox'] == 1
+    # backend recovers
+    backend = FakeBackend(200)
+    delivery.session = backend
+    delivery.drain()
+    assert delivery.stats()['outbox'] == 0
+    _, data, files = backend.requests[0]
+    assert data['stdout'] == 'ok'
+    assert files == [('out.txt', b'data')]
+
+
+def test_batch_results(tmp_path):
+    delivery = ResultDelivery(
+        backend_api='http://web:8080',
+        token='token',
+        outbox_dir=tmp_path / 'outbox',
+        batch_size=3,
+        batch_window=1,
+    )
+    backend = FakeBackend(200)
+    delivery.session = backend
+    delivery.start()
+    threads = [
+        threading.Thread(target=delivery.send,
+                         args=(_id, new_result(_id.encode()))) for _id in 'abc'
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(backend.requests) == 1
+    url, data, files = backend.requests[0]
+    assert url == 'http://web:8080/submission/complete'
+    results = json.loads(data['results'])
+    assert sorted(r['id'] for r in results) == ['a', 'b', 'c']
+    for i, r in enumerate(results):
+        assert (f'{i}/out.txt', r['id'].encode()) in files
+
+
+def test_batch_not_supported(tmp_path):
+    delivery = ResultDelivery(
+        backend_api='http://web:8080',
+        token='token',
+        outbox_dir=tmp_path / 'outbox',
+        batch_size=2,
+        batch_window=0,
+    )
+    backend = FakeBackend(404, 200)
+    delivery.session = backend
+    delivery.start()
+    assert delivery.send('a', new_result()) is True
+    assert backend.requests[1][0] == 'http://web:8080/submission/a/complete'
+
+
+def test_batch_error_goes_to_outbox(tmp_path):
+    delivery = ResultDelivery(
+        backend_api='http://web:8080',
+        token='token',
+        outbox_dir=tmp_path / 'outbox',
+        batch_size=2,
+        batch_window=0,
+    )
+
+    def broken(results):
+        raise OSError('file is gone')
+
+    delivery.batch_put = broken
+    delivery.start()
+    assert delivery.send('a', new_result()) is False
+    assert delivery.stats()['outbox'] == 1
+    # batcher is still alive
+    assert delivery.batcher.is_alive()
+    assert delivery.send('b', new_result()) is False
+    assert delivery.stats()['outbox'] == 2
+
+
+def test_quarantine_broken_result(delivery):
+    delivery.session = FakeBackend(*[500] * 8)
+    for _id in 'ab':
+        delivery.send(_id, new_result())
+    (delivery.outbox_dir / 'a' / 'result.json').write_text('{"stdout": ')
+    backend = FakeBackend(200)
+    delivery.session = backend
+    delivery.drain()
+    # the broken one doesn't block others
+    assert len(backend.requests) == 1
+    assert delivery.stats()['outbox'] == 0
+    assert (delivery.outbox_dir / '.quarantine' / 'a').exists()
+
+
+class EncodingBackend:
+    '''
+    keep request bodies encoded by `requests`, as backend receives them
+    '''
+    def __init__(self):
+        self.bodies = []
+
+    def put(self, url, data, files, timeout):
+        req = requests.Request('PUT', url, data=data, files=files)
+        self.bodies.append(req.prepare().body)
+        return FakeResponse(200)
+
+
+@pytest.mark.parametrize('content', [None, b'data'])
+def test_cases_are_json_encoded(delivery, content):
+    backend = EncodingBackend()
+    delivery.session = backend
+    cases = [{'task': 0, 'case': 0, 'result': 0}]
+    result = new_result(content) if content else {'stdout': 'ok'}
+    result['cases'] = cases
+    if content is None:
+        result['files'] = []
+    assert delivery.send('a', result) is True
+    body = backend.bodies[0]
+    if content is None:
+        # urlencoded form
+        fields = parse_qs(body)
+        assert json.loads(fields['cases'][0]) == cases
+    else:
+        # multipart form
+        assert f'name="cases"\r\n\r\n{json.dumps(cases)}\r\n'.encode() in body
@@ -0,0 +1,336 @@
+import json
+import threading
+import time
+import docker.errors
+import pytest
+from dispatcher import dispatcher as dispatcher_module
+from dispatcher.dispatcher import Dispatcher
+from dispatcher.exception import SubmissionIdNotFoundError
+from sandbox import SandboxResult
+
+
+@pytest.fixture
+def dispatcher(tmp_path):
+    config = tmp_path / 'dispatcher.json'
+    config.write_text(
+        json.dumps({
+            'image': 'judger',
+            'base_dir': str(tmp_path / 'submissions'),
+            'journal_path': str(tmp_path / 'submissions.journal'),
+            'mem_limit': 65536,
+            'memory_budget': 131072,
+            'wake_interval': 0.01,
+        }))
+    return Dispatcher(None, str(config))
+
+
+def test_default_limits(dispatcher, tmp_path):
+    assert dispatcher.load_limits(tmp_path) == dispatcher.default_limits
+
+
+def test_limits_from_tasks(dispatcher, tmp_path):
+    tasks = [
+        {
+            'memoryLimit': 32768,
+            'timeLimit': 1000,
+        },
+        {
+            'memoryLimit': 16384,
+            'timeLimit': 3000,
+        },
+    ]
+    meta = {'outputSizeLimit': 1024, 'tasks': tasks}
+    (tmp_path / 'meta.json').write_text(json.dumps(meta))
+    limits = dispatcher.load_limits(tmp_path)
+    assert limits['mem_limit'] == 32768
+    assert limits['time_limit'] == 3000
+    assert limits['output_size_limit'] == 1024
+    assert limits['file_size_limit'] == dispatcher.default_limits[
+        'file_size_limit']
+
+
+def test_limits_of_each_task(dispatcher, tmp_path):
+    tasks = [
+        {
+            'memoryLimit': 32768,
+            'caseCount': 2,
+        },
+        {
+            'timeLimit': 3000,
+            'caseCount': 1,
+        },
+    ]
+    meta = {'timeLimit': 1000, 'tasks': tasks}
+    (tmp_path / 'meta.json').write_text(json.dumps(meta))
+    limits = dispatcher.load_limits(tmp_path)
+    assert limits['tasks'] == [
+        {
+            'time_limit': 1000,
+            'mem_limit': 32768,
+            'case_count': 2,
+        },
+        {
+            'time_limit': 3000,
+            'mem_limit': 65536,
+            'case_count': 1,
+        },
+    ]
+
+
+def test_invalid_meta(dispatcher, tmp_path):
+    (tmp_path / 'meta.json').write_text('{"timeLimit": "1s"}')
+    assert dispatcher.load_limits(tmp_path) == dispatcher.default_limits
+
+
+def test_pack_by_memory(dispatcher):
+    assert dispatcher.reserve({'mem_limit': 65536})
+    assert dispatcher.reserve({'mem_limit': 32768})
+    reserved = threading.Event()
+
+    def reserve():
+        dispatcher.reserve({'mem_limit': 65536})
+        reserved.set()
+
+    threading.Thread(target=reserve, daemon=True).start()
+    # 160 MB > 128 MB budget
+    assert not reserved.wait(0.1)
+    dispatcher.release(65536, 'local')
+    assert reserved.wait(1)
+    assert dispatcher.hosts.get('local').memory_used == 32768 + 65536
+
+
+def test_concurrency_limit(dispatcher):
+    dispatcher.concurrency = 1
+    assert dispatcher.reserve({'mem_limit': 1024})
+    dispatcher.do_run = False
+    # stop waiting once dispatcher is stopped
+    assert not dispatcher.reserve({'mem_limit': 1024})
+    dispatcher.release(1024, 'local')
+    assert dispatcher.admitted == 0
+
+
+def test_cpuset_slot(tmp_path):
+    config = tmp_path / 'dispatcher.json'
+    config.write_text(
+        json.dumps({
+            'image': 'judger',
+            'base_dir': str(tmp_path / 'submissions'),
+            'journal_path': str(tmp_path / 'submissions.journal'),
+            'cpuset': '0-3',
+            'cores_per_container': 2,
+            'wake_interval': 0.01,
+        }))
+    dispatcher = Dispatcher(None, str(config))
+    host = dispatcher.hosts.get('local')
+    assert host.cpu_limit == 2
+    limits = {'mem_limit': 1024}
+    assert dispatcher.reserve(limits)
+    assert limits['host'] == 'local'
+    assert limits['cpu_slot'] == 0
+    assert dispatcher.reserve({'mem_limit': 1024})
+    dispatcher.do_run = False
+    # all slots are in use
+    assert not dispatcher.reserve({'mem_limit': 1024})
+    dispatcher.release(1024, 'local', 0)
+    assert host.cpusets.available()
+
+
+def test_unexpected_error_is_judge_error(dispatcher, monkeypatch):
+    def broken(host):
+        raise RuntimeError('boom')
+
+    results = []
+    monkeypatch.setattr(dispatcher, 'refresh_image', broken)
+    monkeypatch.setattr(
+        dispatcher.metrics,
+        'trace',
+        lambda _id, trace, res: results.append(res),
+    )
+    host = dispatcher.hosts.get('local')
+    monkeypatch.setattr(host.client, 'get', lambda: None)
+    dispatcher.testing = True
+    dispatcher.submission_ids.add('a')
+    # taken as the run loop does
+    dispatcher.slots.acquire()
+    limits = {'mem_limit': 1024}
+    assert dispatcher.reserve(limits)
+    assert dispatcher.create_container('a', limits['host'], mem_limit=1024)
+    assert results[0]['status'] == SandboxResult.JUDGER_ERROR
+    # resources are given back
+    assert host.running == 0
+    assert free_slots(dispatcher) == dispatcher.max_container_count
+
+
+def test_refresh_image_once(dispatcher, monkeypatch):
+    host = dispatcher.hosts.get('local')
+    pulls = []
+
+    def ensure_image(host):
+        pulls.append(host.name)
+        time.sleep(0.05)
+        host.image_checked_at = time.monotonic()
+
+    monkeypatch.setattr(dispatcher, 'ensure_image', ensure_image)
+    runners = [
+        threading.Thread(target=dispatcher.refresh_image, args=(host, ))
+        for _ in range(4)
+    ]
+    for t in runners:
+        t.start()
+    for t in runners:
+        t.join()
+    assert pulls == ['local']
+
+
+def test_pull_error_marks_host_unhealthy(dispatcher, monkeypatch):
+    def ensure_image(host):
+        raise docker.errors.ImageNotFound('judger')
+
+    monkeypatch.setattr(dispatcher, 'ensure_image', ensure_image)
+    host = dispatcher.hosts.get('local')
+    monkeypatch.setattr(host.client, 'get', lambda: None)
+    dispatcher.testing = True
+    dispatcher.submission_ids.add('a')
+    dispatcher.slots.acquire()
+    limits = {'mem_limit': 1024}
+    assert dispatcher.reserve(limits)
+    assert dispatcher.create_container('a', limits['host'], mem_limit=1024)
+    assert not host.healthy
+    assert host.running == 0
+
+
+def test_journal_error_rejects_submission(dispatcher, monkeypatch):
+    record = dispatcher.journal.record
+
+    def broken(submission_id, state, sync=False, **ks):
+        record(submission_id, state, **ks)
+        if sync:
+            raise OSError('disk error')
+
+    monkeypatch.setattr(dispatcher.journal, 'record', broken)
+    dispatcher.get_path('a').mkdir(parents=True)
+    with pytest.raises(OSError):
+        dispatcher.handle('a')
+    assert 'a' not in dispatcher.submission_ids
+    assert dispatcher.queue.qsize() == 0
+
+
+def test_pull_error_at_startup(dispatcher, monkeypatch):
+    def ensure_image(host):
+        raise docker.errors.APIError('registry unreachable')
+
+    host = dispatcher.hosts.get('local')
+    monkeypatch.setattr(dispatcher, 'ensure_image', ensure_image)
+    monkeypatch.setattr(host.client, 'ping', lambda: True)
+    monkeypatch.setattr(host.pool, 'start', lambda: None)
+    monkeypatch.setattr(dispatcher.hosts, 'start', lambda: None)
+    runner = threading.Thread(target=dispatcher.run, daemon=True)
+    runner.start()
+    time.sleep(0.1)
+    # still dispatching, the host is skipped
+    assert runner.is_alive()
+    assert not host.healthy
+    dispatcher.stop()
+    runner.join(1)
+    assert not runner.is_alive()
+
+
+def test_journal_error_rejects_batch(dispatcher, monkeypatch):
+    def broken():
+        raise OSError('disk error')
+
+    monkeypatch.setattr(dispatcher.journal, 'sync', broken)
+    dispatcher.get_path('a').mkdir(parents=True)
+    errors = dispatcher.handle_many(['a', 'b'])
+    assert isinstance(errors[0], OSError)
+    # `b` has no data
+    assert isinstance(errors[1], FileNotFoundError)
+    assert 'a' not in dispatcher.submission_ids
+    assert dispatcher.queue.qsize() == 0
+
+
+def test_handle_many(dispatcher):
+    for submission_id in ('a', 'b'):
+        dispatcher.get_path(submission_id).mkdir(parents=True)
+    assert dispatcher.handle_many(['a', 'b'], [{}, {'owner': 'x'}]) == \
+        [None, None]
+    assert dispatcher.queue.qsize() == 2
+
+
+def free_slots(dispatcher) -> int:
+    count = 0
+    while dispatcher.slots.acquire(blocking=False):
+        count += 1
+    for _ in range(count):
+        dispatcher.slots.release()
+    return count
+
+
+def test_slot_released_for_unknown_submission(dispatcher):
+    dispatcher.slots.acquire()
+    limits = {'mem_limit': 1024}
+    assert dispatcher.reserve(limits)
+    with pytest.raises(SubmissionIdNotFoundError):
+        dispatcher.create_container('a', limits['host'], mem_limit=1024)
+    assert free_slots(dispatcher) == dispatcher.max_container_count
+    assert dispatcher.hosts.get('local').running == 0
+
+
+def test_slot_released_when_queue_is_empty(dispatcher, monkeypatch):
+    host = dispatcher.hosts.get('local')
+    monkeypatch.setattr(dispatcher, 'ensure_image', lambda host: None)
+    monkeypatch.setattr(host.client, 'ping', lambda: True)
+    monkeypatch.setattr(host.pool, 'start', lambda: None)
+    monkeypatch.setattr(dispatcher.hosts, 'start', lambda: None)
+    runner = threading.Thread(target=dispatcher.run, daemon=True)
+    runner.start()
+    # the loop waits for submissions several times
+    time.sleep(0.1)
+    dispatcher.stop()
+    runner.join(1)
+    assert free_slots(dispatcher) == dispatcher.max_container_count
+
+
+class FakeSandbox:
+    def __init__(self, **ks):
+        self.timings = {}
+
+    def run(self):
+        return {'stdout': '', 'stderr': '', 'status': 0, 'files': []}
+
+
+def wait_for(predicate, timeout=1):
+    end = time.time() + timeout
+    while not predicate() and time.time() < end:
+        time.sleep(0.01)
+    return predicate()
+
+
+@pytest.mark.parametrize('fail', [False, True])
+def test_delivery_backlog(dispatcher, monkeypatch, fail):
+    sending = threading.Event()
+    sent = threading.Event()
+
+    def on_complete(submission_id, res):
+        sending.set()
+        sent.wait(1)
+        if fail:
+            raise ConnectionError('backend is down')
+
+    host = dispatcher.hosts.get('local')
+    monkeypatch.setattr(dispatcher_module, 'Sandbox', FakeSandbox)
+    monkeypatch.setattr(dispatcher, 'refresh_image', lambda host: None)
+    monkeypatch.setattr(host.client, 'get', lambda: None)
+    dispatcher.on_complete = on_complete
+    dispatcher.submission_ids.add('a')
+    dispatcher.slots.acquire()
+    limits = {'mem_limit': 1024}
+    assert dispatcher.reserve(limits)
+    # the slot is freed before the result is sent
+    assert dispatcher.create_container('a', limits['host'], mem_limit=1024)
+    assert sending.wait(1)
+    assert dispatcher.delivery_backlog == 1
+    assert free_slots(dispatcher) == dispatcher.max_container_count
+    sent.set()
+    assert wait_for(lambda: 'a' not in dispatcher.submission_ids)
+    assert dispatcher.delivery_backlog == 0
@@ -0,0 +1,108 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from dispatcher.client import SharedDockerClient
+from dispatcher.dispatcher import Dispatcher
+from dispatcher.hosts import Host, HostRegistry
+
+
+class PingHandler(BaseHTTPRequestHandler):
+    '''
+    stand-in docker daemon, only answers `GET /_ping`
+    '''
+    def do_GET(self):
+        if not self.path.endswith('/_ping'):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'OK')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def daemons():
+    servers = [
+        ThreadingHTTPServer(('127.0.0.1', 0), PingHandler) for _ in range(2)
+    ]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield servers
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def create_host(name, server, slots=2):
+    client = SharedDockerClient(
+        2,
+        base_url=f'tcp://127.0.0.1:{server.server_address[1]}',
+        version='1.41',
+    )
+    return Host(
+        name,
+        client,
+        slots=slots,
+        memory_budget=slots * 65536,
+        cpu_limit=1,
+        cpu_budget=slots,
+    )
+
+
+def test_pick_least_loaded(daemons):
+    hosts = HostRegistry([create_host(n, s) for n, s in zip('ab', daemons)])
+    hosts.check()
+    assert all(h.healthy for h in hosts)
+    picked = []
+    for _ in range(4):
+        host = hosts.pick(65536)
+        host.reserve(65536)
+        picked.append(host.name)
+    assert sorted(picked) == ['a', 'a', 'b', 'b']
+    # all slots are in use
+    assert hosts.pick(1024) is None
+    hosts.get('b').release(65536)
+    assert hosts.pick(65536).name == 'b'
+
+
+def test_skip_unhealthy(daemons):
+    hosts = HostRegistry([create_host(n, s) for n, s in zip('ab', daemons)])
+    hosts.get('a').reserve(65536)
+    daemons[1].shutdown()
+    daemons[1].server_close()
+    hosts.check()
+    assert hosts.get('a').healthy
+    assert not hosts.get('b').healthy
+    # a is more loaded, but b is down
+    assert hosts.pick(65536).name == 'a'
+
+
+def test_hosts_config(tmp_path, daemons):
+    config = tmp_path / 'dispatcher.json'
+    config.write_text(
+        json.dumps({
+            'image':
+            'judger',
+            'base_dir':
+            str(tmp_path / 'submissions'),
+            'journal_path':
+            str(tmp_path / 'submissions.journal'),
+            'mem_limit':
+            65536,
+            'wake_interval':
+            0.01,
+            'hosts': [{
+                'name': name,
+                'base_url': f'tcp://127.0.0.1:{s.server_address[1]}',
+                'version': '1.41',
+                'slots': slots,
+            } for name, s, slots in zip('ab', daemons, (1, 2))],
+        }))
+    dispatcher = Dispatcher(None, str(config))
+    assert dispatcher.max_container_count == 3
+    assert dispatcher.hosts.get('b').memory_budget == 2 * 65536
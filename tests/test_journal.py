@@ -0,0 +1,63 @@
+import errno
+import os
+import pytest
+from dispatcher.journal import Journal
+
+
+def test_pending_after_restart(tmp_path):
+    path = tmp_path / 'submissions.journal'
+    journal = Journal(path)
+    journal.record('a', Journal.ENQUEUE, sync=True)
+    journal.record('b', Journal.ENQUEUE, sync=True)
+    journal.record('c', Journal.ENQUEUE, sync=True)
+    journal.record('a', Journal.START)
+    journal.record('b', Journal.START)
+    journal.record('b', Journal.COMPLETE)
+    journal.record('c', Journal.DROP)
+    journal.close()
+    # `a` was running and should be recovered
+    assert Journal(path).pending == ['a']
+
+
+def test_skip_partial_record(tmp_path):
+    path = tmp_path / 'submissions.journal'
+    path.write_text(Journal.dumps('a', Journal.ENQUEUE) + '{"id": "b", "sta')
+    journal = Journal(path)
+    assert journal.pending == ['a']
+    journal.close()
+    # compacted
+    assert path.read_text() == Journal.dumps('a', Journal.ENQUEUE)
+
+
+def test_keep_info(tmp_path):
+    path = tmp_path / 'submissions.journal'
+    journal = Journal(path)
+    journal.record('a', Journal.ENQUEUE, info={'owner': 'alice'})
+    journal.record('b', Journal.ENQUEUE, info={'owner': 'bob'})
+    journal.record('b', Journal.COMPLETE)
+    journal.close()
+    journal = Journal(path)
+    assert journal.info == {'a': {'owner': 'alice'}}
+    journal.close()
+    # still there after compaction
+    assert Journal(path).info == {'a': {'owner': 'alice'}}
+
+
+def test_sync_error(tmp_path, monkeypatch):
+    path = tmp_path / 'submissions.journal'
+    journal = Journal(path)
+    monkeypatch.setattr(journal, 'RETRY_INTERVAL', 0.01)
+    fsync = os.fsync
+
+    def broken(fd):
+        raise OSError(errno.EIO, 'disk error')
+
+    monkeypatch.setattr(os, 'fsync', broken)
+    with pytest.raises(OSError):
+        journal.record('a', Journal.ENQUEUE, sync=True)
+    assert journal.synced_seq == 0
+    # retried once the disk comes back
+    monkeypatch.setattr(os, 'fsync', fsync)
+    journal.record('b', Journal.ENQUEUE, sync=True)
+    journal.close()
+    assert Journal(path).pending == ['a', 'b']
@@ -0,0 +1,40 @@
+import json
+from dispatcher.metrics import Histogram, Metrics, timed
+
+
+def test_histogram_is_cumulative():
+    h = Histogram(buckets=(0.1, 1))
+    for v in (0.05, 0.5, 0.5, 5):
+        h.observe(v)
+    lines = h.render('t', 'phase="exec"')
+    assert lines[:3] == [
+        't_bucket{phase="exec",le="0.1"} 1',
+        't_bucket{phase="exec",le="1"} 3',
+        't_bucket{phase="exec",le="+Inf"} 4',
+    ]
+    assert lines[-1] == 't_count{phase="exec"} 4'
+
+
+def test_timed_accumulates():
+    phases = {}
+    with timed(phases, 'exec'):
+        pass
+    first = phases['exec']
+    with timed(phases, 'exec'):
+        pass
+    assert phases['exec'] >= first
+
+
+def test_trace(tmp_path):
+    metrics = Metrics(str(tmp_path / 'trace'))
+    phases = {'queue': 0.5, 'exec': 2}
+    result = {'stdout': '', 'cpuTime': 1500, 'memoryUsage': 1024}
+    metrics.trace('a', phases, result)
+    record = json.loads((tmp_path / 'trace').read_text())
+    assert record['id'] == 'a'
+    assert record['phases'] == {'queue': 500, 'exec': 2000}
+    assert record['usage'] == {'cpuTime': 1500, 'memoryUsage': 1024}
+    text = metrics.render({'queue_size': 3})
+    assert 'sandbox_phase_seconds_count{phase="exec"} 1' in text
+    assert 'sandbox_cpu_seconds_sum 1.5' in text
+    assert 'sandbox_queue_size 3' in text
@@ -0,0 +1,104 @@
+import fcntl
+import queue
+import threading
+from multiprocessing.connection import Listener
+import pytest
+from dispatcher.exception import RequestNotSentError
+from dispatcher.remote import DispatcherServer, RemoteDispatcher, elect
+
+
+class FakeDispatcher:
+    def __init__(self):
+        self.submission_ids = set()
+
+    def handle(self, submission_id, *args):
+        if len(self.submission_ids) >= 1:
+            raise queue.Full
+        self.submission_ids.add(submission_id)
+        return True
+
+    def handle_many(self, submission_ids, options=None):
+        ret = []
+        for submission_id in submission_ids:
+            try:
+                self.handle(submission_id)
+                ret.append(None)
+            except queue.Full as e:
+                ret.append(e)
+        return ret
+
+    def status(self):
+        return {'submissions': [*self.submission_ids]}
+
+    def start(self):
+        pass
+
+
+@pytest.fixture
+def remote_dispatcher(tmp_path):
+    address = str(tmp_path / 'dispatcher.sock')
+    DispatcherServer(FakeDispatcher(), address, b'token').start()
+    return RemoteDispatcher(address, b'token')
+
+
+def test_forward_calls(remote_dispatcher):
+    assert remote_dispatcher.handle('a') is True
+    assert remote_dispatcher.status() == {'submissions': ['a']}
+
+
+def test_forward_error(remote_dispatcher):
+    remote_dispatcher.handle('a')
+    with pytest.raises(queue.Full):
+        remote_dispatcher.handle('b')
+
+
+def test_forward_batch(remote_dispatcher):
+    errors = remote_dispatcher.handle_many(['a', 'b'])
+    assert errors[0] is None
+    assert isinstance(errors[1], queue.Full)
+
+
+def test_leader_unavailable(tmp_path):
+    remote_dispatcher = RemoteDispatcher(
+        str(tmp_path / 'dispatcher.sock'),
+        b'token',
+    )
+    with pytest.raises(RequestNotSentError):
+        remote_dispatcher.status()
+
+
+def test_leader_lost_after_sending(tmp_path):
+    address = str(tmp_path / 'dispatcher.sock')
+    listener = Listener(address, family='AF_UNIX', authkey=b'token')
+
+    def serve():
+        # leader dies after receiving the request
+        with listener.accept() as conn:
+            conn.recv()
+
+    threading.Thread(target=serve, daemon=True).start()
+    remote_dispatcher = RemoteDispatcher(address, b'token')
+    with pytest.raises(ConnectionError) as e:
+        remote_dispatcher.handle('a')
+    # it may be handled
+    assert not isinstance(e.value, RequestNotSentError)
+
+
+def test_take_over_after_leader_exits(tmp_path):
+    lock_path = tmp_path / 'dispatcher.lock'
+    # held by the old leader, e.g. during a reload
+    old_leader = lock_path.open('a')
+    fcntl.flock(old_leader, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    dispatcher = elect(
+        str(lock_path),
+        str(tmp_path / 'dispatcher.sock'),
+        b'token',
+        FakeDispatcher,
+    )
+    assert isinstance(dispatcher, RemoteDispatcher)
+    old_leader.close()
+    assert dispatcher.handle('a') is True
+    assert dispatcher.status() == {'submissions': ['a']}
+    # other followers reach the new leader
+    follower = RemoteDispatcher(str(tmp_path / 'dispatcher.sock'), b'token')
+    assert follower.status() == {'submissions': ['a']}
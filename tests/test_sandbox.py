@@ -0,0 +1,493 @@
+import hashlib
+import random
+import socket
+import subprocess
+import tarfile
+import threading
+from io import BytesIO, StringIO
+import pytest
+from docker.errors import APIError
+from sandbox import (
+    ExecStream,
+    OutputLimitExceed,
+    Sandbox,
+    SandboxResult,
+    Watchdog,
+)
+
+
+@pytest.fixture
+def sandbox(tmp_path):
+    return Sandbox(
+        time_limit=10,
+        mem_limit=128000,
+        output_size_limit=8,
+        file_size_limit=64,
+        src_dir=str(tmp_path),
+        ignores=['__pycache__'],
+        image='judger',
+        client=object(),
+    )
+
+
+def test_read_output(sandbox):
+    stream = iter([(b'out', None), (None, b'err'), (b'put', b'or')])
+    assert sandbox.read_output(stream) == (b'output', b'error')
+
+
+def test_read_output_stop_at_limit(sandbox):
+    consumed = []
+
+    def stream():
+        while True:
+            consumed.append(1)
+            yield b'x' * 4, None
+
+    with pytest.raises(OutputLimitExceed):
+        sandbox.read_output(stream())
+    # 12 bytes > 8 bytes
+    assert len(consumed) == 3
+
+
+class FakeOutput:
+    '''
+    endless output of a program
+    '''
+    def __init__(self):
+        self.closed = False
+        self.api = self
+
+    def __iter__(self):
+        while not self.closed:
+            yield b'x' * 4, None
+
+    def close(self):
+        self.closed = True
+
+    def exec_inspect(self, exec_id):
+        return {'ExitCode': 137}
+
+
+def test_close_stream_on_output_limit(sandbox, monkeypatch):
+    output = FakeOutput()
+    monkeypatch.setattr(sandbox, 'client', output)
+    monkeypatch.setattr(sandbox, 'exec_stream', lambda cmd: ('id', output))
+    monkeypatch.setattr(sandbox, 'kill', lambda: None)
+    status, *_ = sandbox.exec_program('yes', 1000)
+    assert status == SandboxResult.OUTPUT_LIMIT_EXCEED
+    assert output.closed
+
+
+def test_exec_stream_close():
+    ours, theirs = socket.socketpair()
+    # a stdout frame
+    theirs.sendall(b'\x01\x00\x00\x00\x00\x00\x00\x02hi')
+    stream = ExecStream(ours)
+    assert next(iter(stream)) == (b'hi', None)
+    stream.close()
+    # daemon side sees the connection closed
+    assert theirs.recv(1) == b''
+    theirs.close()
+
+
+class FakeStream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            if self.closed:
+                raise ValueError('read closed stream')
+            yield chunk, None
+
+    def close(self):
+        self.closed = True
+
+
+class FakeWorkdir:
+    '''
+    stand-in of container's working dir, serve `find` and `tar` commands
+    '''
+    def __init__(self, files, tar_exit_code=0):
+        self.files = files
+        self.exit_codes = {'find': 0, 'tar': tar_exit_code}
+        self.api = self
+        self.streams = []
+
+    def exec_inspect(self, exec_id):
+        return {'ExitCode': self.exit_codes[exec_id]}
+
+    @classmethod
+    def sha256sum(cls, name, content):
+        digest = hashlib.sha256(content).hexdigest()
+        escaped = name.replace('\\', '\\\\').replace('\n', '\\n')
+        if escaped != name:
+            return f'\\{digest}  ./{escaped}\n'
+        return f'{digest}  ./{name}\n'
+
+    def exec_stream(self, cmd):
+        if cmd[0] == 'find':
+            output = ''.join(
+                self.sha256sum(name, content)
+                for name, content in self.files.items()).encode()
+        elif cmd[0] == 'tar':
+            data = BytesIO()
+            with tarfile.open(fileobj=data, mode='w') as tar:
+                for name in cmd[cmd.index('--') + 1:]:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(self.files[name])
+                    tar.addfile(info, BytesIO(self.files[name]))
+            output = data.getvalue()
+        chunks = [output[i:i + 100] for i in range(0, len(output), 100)]
+        self.streams.append(FakeStream(chunks))
+        return cmd[0], self.streams[-1]
+
+
+def test_get_files(sandbox, monkeypatch):
+    sandbox.input_hashes = {
+        'main.py': hashlib.sha256(b'print(1)').hexdigest(),
+        'input': hashlib.sha256(b'1 2').hexdigest(),
+    }
+    workdir = FakeWorkdir({
+        'main.py': b'print(1)',
+        'input': b'3 4',
+        'out.txt': b'hello',
+    })
+    monkeypatch.setattr(sandbox, 'container', object())
+    monkeypatch.setattr(sandbox, 'client', workdir)
+    monkeypatch.setattr(sandbox, 'exec_stream', workdir.exec_stream)
+    files = {f.name: f.read() for f in sandbox.get_files()}
+    # modified input and new file
+    assert files == {'input': b'3 4', 'out.txt': b'hello'}
+
+
+def test_get_files_with_special_names(sandbox, monkeypatch):
+    sandbox.input_hashes = {}
+    sandbox.file_size_limit = 2**10
+    workdir = FakeWorkdir({
+        'a\\b.txt': b'1',
+        'c\nd.txt': b'2',
+        'e\x0cf.txt': b'3',
+    })
+    monkeypatch.setattr(sandbox, 'container', object())
+    monkeypatch.setattr(sandbox, 'client', workdir)
+    monkeypatch.setattr(sandbox, 'exec_stream', workdir.exec_stream)
+    files = {f.name: f.read() for f in sandbox.get_files()}
+    assert files == {'a\\b.txt': b'1', 'c\nd.txt': b'2', 'e\x0cf.txt': b'3'}
+
+
+def test_get_files_tar_error(sandbox, monkeypatch):
+    workdir = FakeWorkdir({'a.txt': b'a'}, tar_exit_code=2)
+    monkeypatch.setattr(sandbox, 'container', object())
+    monkeypatch.setattr(sandbox, 'client', workdir)
+    monkeypatch.setattr(sandbox, 'exec_stream', workdir.exec_stream)
+    with pytest.raises(APIError):
+        sandbox.get_files()
+
+
+def test_get_files_exceed_limit(sandbox, monkeypatch):
+    workdir = FakeWorkdir({
+        'a.txt': b'a' * 32,
+        'b.txt': b'b' * 64,
+    })
+    monkeypatch.setattr(sandbox, 'container', object())
+    monkeypatch.setattr(sandbox, 'client', workdir)
+    monkeypatch.setattr(sandbox, 'exec_stream', workdir.exec_stream)
+    with pytest.raises(OutputLimitExceed):
+        sandbox.get_files()
+    # the rest of archive is dropped
+    assert workdir.streams[-1].closed
+
+
+def test_archive_src(sandbox, tmp_path):
+    (tmp_path / 'main.py').write_text('print(1)')
+    (tmp_path / '__pycache__').mkdir()
+    (tmp_path / 'main.py').chmod(0o444)
+    with sandbox.archive_src() as data, tarfile.open(fileobj=data) as tar:
+        assert tar.getnames() == ['main.py']
+        info = tar.getmember('main.py')
+        # submission can modify its data
+        assert info.mode & 0o200
+        assert tar.extractfile(info).read() == b'print(1)'
+
+
+def test_find_cases(tmp_path):
+    tasks = [
+        {
+            'time_limit': 1000,
+            'mem_limit': 65536,
+            'case_count': 2,
+        },
+        {
+            'time_limit': 3000,
+            'mem_limit': 32768,
+            'case_count': 1,
+        },
+    ]
+    for name in ('0000', '0001', '0100'):
+        (tmp_path / f'{name}.in').write_text('')
+        (tmp_path / f'{name}.out').write_text('')
+    cases = Sandbox.find_cases(str(tmp_path), tasks)
+    assert [(c['task'], c['case'], c['name']) for c in cases] == [
+        (0, 0, '0000'),
+        (0, 1, '0001'),
+        (1, 0, '0100'),
+    ]
+    assert cases[2]['time_limit'] == 3000
+    assert cases[2]['mem_limit'] == 32768
+    # incomplete testcases
+    (tmp_path / '0001.out').unlink()
+    assert Sandbox.find_cases(str(tmp_path), tasks) == []
+
+
+def test_run_cases(tmp_path, monkeypatch):
+    for name, expected in (('0000', '3'), ('0001', '7'), ('0002', '0')):
+        (tmp_path / f'{name}.in').write_text('')
+        (tmp_path / f'{name}.out').write_text(expected + '\n')
+    tasks = [{'time_limit': 1000, 'mem_limit': 65536, 'case_count': 3}]
+    sandbox = Sandbox(
+        time_limit=1000,
+        mem_limit=65536,
+        output_size_limit=8,
+        file_size_limit=64,
+        src_dir=str(tmp_path),
+        ignores=[],
+        image='judger',
+        client=object(),
+        tasks=tasks,
+    )
+    # expected output is not copied into container
+    assert {'0000.out', '0001.out', '0002.out'} <= sandbox.ignores
+    outputs = {
+        '0000': (SandboxResult.SUCCESS, b'3 \n\n', b'', 0, 0.1),
+        '0001': (SandboxResult.SUCCESS, b'8\n', b'', 0, 0.2),
+        '0002': (SandboxResult.TIME_LIMIT_EXCEED, b'', b'', 137, 1.0),
+    }
+    monkeypatch.setattr(sandbox, 'container', object())
+    monkeypatch.setattr(sandbox, 'inject', lambda: None)
+    monkeypatch.setattr(
+        sandbox,
+        'exec_program',
+        lambda command, time_limit: outputs[command[-7:-3]],
+    )
+    kills = []
+    monkeypatch.setattr(sandbox, 'kill', lambda: kills.append(1))
+    monkeypatch.setattr(sandbox, 'read_usage', lambda: {})
+    monkeypatch.setattr(sandbox, 'get_files', lambda: [])
+    res = sandbox._run_cases()
+    assert [c['result'] for c in res['cases']] == [0, 1, 2]
+    # first failed case
+    assert res['result'] == 1
+    assert res['stdout'] == '8\n'
+    assert res['wallTime'] == 1300
+    # leftover processes are killed after every case
+    assert len(kills) == 3
+
+
+class FakeCaseContainer:
+    def __init__(self):
+        self.killed = False
+
+    def update(self, **ks):
+        raise APIError('memory in use')
+
+    def kill(self):
+        self.killed = True
+
+
+def test_resize_error_is_judge_error(sandbox):
+    sandbox.container = FakeCaseContainer()
+    case = {'task': 0, 'case': 0, 'time_limit': 10, 'mem_limit': 1024}
+    res = sandbox.run_case(case)
+    assert res['status'] == SandboxResult.JUDGER_ERROR
+    assert res['result'] != 0
+
+
+def test_kill_falls_back_to_container(sandbox, monkeypatch):
+    def broken(cmd):
+        raise APIError('exec failed')
+
+    sandbox.cases = [{'name': '0000'}]
+    sandbox.container = FakeCaseContainer()
+    monkeypatch.setattr(sandbox, 'exec_stream', broken)
+    sandbox.kill()
+    assert sandbox.container.killed
+
+
+def strip(s):
+    # the comparator used before
+    ss = [s.rstrip() for s in s.splitlines()]
+    while len(ss) and ss[-1] == '':
+        del ss[-1]
+    return ss
+
+
+def test_first_mismatch_same_as_strip():
+    rng = random.Random(0)
+    pieces = ['a', 'b', ' ', '\t', '\n', '\r', '\r\n', '\x0c', '\u2028']
+    for _ in range(2000):
+        x = ''.join(rng.choices(pieces, k=rng.randrange(12)))
+        y = x if rng.random() < 0.3 else \
+            ''.join(rng.choices(pieces, k=rng.randrange(12)))
+        # small blocks to split lines across them
+        mismatch = Sandbox.first_mismatch(
+            Sandbox.file_lines(StringIO(x, newline=''), size=3),
+            Sandbox.text_lines(y, size=2),
+        )
+        assert (mismatch is None) == (strip(x) == strip(y)), (x, y)
+
+
+def test_mismatch_line():
+    def first_mismatch(x, y):
+        return Sandbox.first_mismatch(
+            Sandbox.text_lines(x, size=1),
+            Sandbox.text_lines(y, size=4),
+        )
+
+    assert first_mismatch('1\n2 \n3\n\n', '1\n2\n3') is None
+    assert first_mismatch('1\n2\n3\n', '1\n2\n4\n') == 3
+    # missing line
+    assert first_mismatch('1\n2\n\n3\n', '1\n2\n') == 4
+    # extra line
+    assert first_mismatch('1\n', '1\n\n\nx') == 4
+
+
+def test_compare(sandbox, tmp_path):
+    (tmp_path / 'output').write_bytes(b'1 2\r\n3\r\n\r\n')
+    assert sandbox.compare(str(tmp_path / 'output'), '1 2\n3') is None
+    assert sandbox.compare(str(tmp_path / 'output'), '1 2\n4\n') == 2
+
+
+def test_create_container_tmpfs():
+    created = {}
+
+    class FakeContainers:
+        def create(self, **ks):
+            created.update(ks)
+            return FakeContainer()
+
+    class FakeContainer:
+        def start(self):
+            pass
+
+    client = type('FakeClient', (), {'containers': FakeContainers()})()
+    Sandbox.create_container(client, 'judger', 65536, tmpfs_size=2**20)
+    assert created['tmpfs'] == {'/sandbox': 'size=1048576,mode=1777'}
+    Sandbox.create_container(client, 'judger', 65536)
+    assert created['tmpfs'] is None
+
+
+class FakeExecApi:
+    '''
+    run exec commands on host, with container's working dir mapped to
+    `root`
+    '''
+    def __init__(self, root):
+        self.root = root
+        self.procs = {}
+
+    def exec_create(self, container, cmd, stdin=False, workdir=None):
+        self.cmd = [str(self.root) if c == workdir else c for c in cmd]
+        return {'Id': 'exec-id'}
+
+    def exec_start(self, exec_id, **ks):
+        # the command reads stdin from the other end
+        ours, theirs = socket.socketpair()
+        self.procs[exec_id] = subprocess.Popen(
+            self.cmd,
+            stdin=theirs,
+            stdout=subprocess.DEVNULL,
+        )
+        theirs.close()
+        return ours
+
+    def exec_inspect(self, exec_id):
+        return {'ExitCode': self.procs[exec_id].wait()}
+
+
+def test_inject_into_tmpfs(sandbox, tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'main.py').write_text('print(1)')
+    workdir = tmp_path / 'workdir'
+    workdir.mkdir()
+    api = FakeExecApi(workdir)
+    sandbox.src_dir = str(src)
+    sandbox.tmpfs_size = 2**20
+    sandbox.client = type('FakeClient', (), {'api': api})()
+    sandbox.container = type('FakeContainer', (), {'id': 'container-id'})()
+    sandbox.inject()
+    assert api.cmd[:2] == ['tar', '-x']
+    assert (workdir / 'main.py').read_text() == 'print(1)'
+
+
+def test_parse_cgroup_v2_usage():
+    text = '\n'.join([
+        '== cpu.stat',
+        'usage_usec 1500',
+        'user_usec 1000',
+        '== memory.peak',
+        '2097152',
+        '== io.stat',
+        '8:0 rbytes=4096 wbytes=512 rios=1 wios=1',
+        '8:16 rbytes=4096 wbytes=0 rios=1 wios=0',
+    ])
+    assert Sandbox.parse_usage(text) == {
+        'cpuTime': 1.5,
+        'memoryUsage': 2048,
+        'ioRead': 8192,
+        'ioWrite': 512,
+    }
+
+
+def test_parse_cgroup_v1_usage():
+    text = '\n'.join([
+        '== cpuacct/cpuacct.usage',
+        '3000000',
+        '== memory/memory.max_usage_in_bytes',
+        '1048576',
+        '== blkio/blkio.throttle.io_service_bytes',
+        '8:0 Read 100',
+        '8:0 Write 20',
+        '8:0 Total 120',
+        'Total 120',
+    ])
+    assert Sandbox.parse_usage(text) == {
+        'cpuTime': 3,
+        'memoryUsage': 1024,
+        'ioRead': 100,
+        'ioWrite': 20,
+    }
+
+
+def test_parse_bad_usage():
+    text = '\n'.join([
+        '== cpu.stat',
+        'usage_usec many',
+        '== memory.peak',
+        '1048576',
+    ])
+    assert Sandbox.parse_usage(text) == {}
+
+
+def test_watchdog_fires_in_order():
+    watchdog = Watchdog()
+    fired = []
+    done = threading.Event()
+    watchdog.watch(0.05, lambda: (fired.append('b'), done.set()))
+    watchdog.watch(0.01, lambda: fired.append('a'))
+    assert done.wait(1)
+    assert fired == ['a', 'b']
+
+
+def test_watchdog_cancel():
+    watchdog = Watchdog()
+    fired = threading.Event()
+    watch_id = watchdog.watch(0.05, fired.set)
+    assert watchdog.cancel(watch_id)
+    assert not fired.wait(0.1)
+    # already fired
+    watch_id = watchdog.watch(0, fired.set)
+    assert fired.wait(1)
+    assert not watchdog.cancel(watch_id)
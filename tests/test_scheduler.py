@@ -0,0 +1,77 @@
+import queue
+import pytest
+from dispatcher.scheduler import DeficitRoundRobin, FairQueue
+
+
+@pytest.fixture
+def fair_queue():
+    return FairQueue(
+        maxsize=100,
+        weights={
+            'interactive': 2,
+            'rejudge': 1,
+        },
+        default_priority='interactive',
+    )
+
+
+def drain(q):
+    ret = []
+    while q.qsize():
+        ret.append(q.get(timeout=0))
+    return ret
+
+
+def test_round_robin_weights():
+    drr = DeficitRoundRobin(quantum=lambda key: 2 if key == 'a' else 1)
+    for i in range(4):
+        drr.push('a', f'a{i}')
+        drr.push('b', f'b{i}')
+    assert [drr.pop() for _ in range(8)
+            ] == ['a0', 'a1', 'b0', 'a2', 'a3', 'b1', 'b2', 'b3']
+
+
+def test_owners_share_fairly(fair_queue):
+    # a burst from alice doesn't delay bob
+    for i in range(3):
+        fair_queue.put_nowait(f'alice-{i}', owner='alice')
+    fair_queue.put_nowait('bob-0', owner='bob')
+    assert drain(fair_queue) == ['alice-0', 'bob-0', 'alice-1', 'alice-2']
+
+
+def test_rejudge_is_not_starved(fair_queue):
+    for i in range(4):
+        fair_queue.put_nowait(f'r{i}', priority='rejudge', owner='teacher')
+    for i in range(4):
+        fair_queue.put_nowait(f'i{i}', owner=f'student-{i}')
+    assert drain(fair_queue) == [
+        'r0', 'i0', 'i1', 'r1', 'i2', 'i3', 'r2', 'r3'
+    ]
+
+
+def test_full_and_empty(fair_queue):
+    fair_queue.maxsize = 1
+    fair_queue.put_nowait('a')
+    with pytest.raises(queue.Full):
+        fair_queue.put_nowait('b')
+    assert fair_queue.get(timeout=0) == 'a'
+    with pytest.raises(queue.Empty):
+        fair_queue.get(timeout=0.01)
+
+
+def test_unknown_priority(fair_queue):
+    with pytest.raises(ValueError):
+        fair_queue.put_nowait('a', priority='urgent')
+
+
+@pytest.mark.parametrize('weight', [0, -1, '2', None, True, float('nan')])
+def test_invalid_weight(weight):
+    with pytest.raises(ValueError):
+        FairQueue(
+            maxsize=1,
+            weights={
+                'interactive': 1,
+                'rejudge': weight,
+            },
+            default_priority='interactive',
+        )
@@ -0,0 +1,117 @@
+import hashlib
+import os
+from io import BytesIO
+from zipfile import ZipFile
+import pytest
+from dispatcher.store import BlobStore, EntryTooLargeError
+
+
+def sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def test_put_and_link_file(tmp_path):
+    store = BlobStore(tmp_path / 'store', 2**20)
+    digest = store.put_file(BytesIO(b'attachment'))
+    assert digest == sha256(b'attachment')
+    assert store.has(digest)
+    # same content is stored only once
+    store.put_file(BytesIO(b'attachment'), digest)
+    assert store.stats()['count'] == 1
+    dest = tmp_path / 'data.txt'
+    store.link(digest, dest)
+    assert dest.read_bytes() == b'attachment'
+
+
+def test_put_file_with_wrong_digest(tmp_path):
+    store = BlobStore(tmp_path / 'store', 2**20)
+    with pytest.raises(ValueError):
+        store.put_file(BytesIO(b'data'), sha256(b'other'))
+    assert store.stats()['count'] == 0
+
+
+def test_put_and_link_tree(tmp_path):
+    store = BlobStore(tmp_path / 'store', 2**20)
+    data = BytesIO()
+    with ZipFile(data, 'w') as z:
+        z.writestr('input', '1 2\n')
+        z.writestr('output', '3\n')
+    data.seek(0)
+    digest = store.put_tree(data)
+    dest = tmp_path / 'submission'
+    dest.mkdir()
+    store.link(digest, dest)
+    assert (dest / 'input').read_text() == '1 2\n'
+    assert (dest / 'output').read_text() == '3\n'
+
+
+def test_evict_least_recently_used(tmp_path):
+    store = BlobStore(tmp_path / 'store', 10)
+    a = store.put_file(BytesIO(b'a' * 4))
+    b = store.put_file(BytesIO(b'b' * 4))
+    # use `a` so `b` becomes the least recently used one
+    store.link(a, tmp_path / 'a')
+    c = store.put_file(BytesIO(b'c' * 4))
+    assert store.has(a)
+    assert not store.has(b)
+    assert store.has(c)
+    with pytest.raises(KeyError):
+        store.link(b, tmp_path / 'b')
+
+
+def test_reject_too_large_entry(tmp_path):
+    store = BlobStore(tmp_path / 'store', 10)
+    a = store.put_file(BytesIO(b'a' * 4))
+    with pytest.raises(EntryTooLargeError):
+        store.put_file(BytesIO(b'b' * 11))
+    # nothing is evicted for it, and its temp file is removed
+    assert store.has(a)
+    assert store.stats()['count'] == 1
+    assert not any(store.tmp_dir.iterdir())
+
+
+def test_rescan_sees_other_workers(tmp_path):
+    # two worker processes sharing one directory
+    first = BlobStore(tmp_path / 'store', 10, rescan_interval=0)
+    second = BlobStore(tmp_path / 'store', 10, rescan_interval=0)
+    a = first.put_file(BytesIO(b'a' * 6))
+    os.utime(first.path(a), (0, 0))
+    b = second.put_file(BytesIO(b'b' * 6))
+    # `a` is counted by the second one and evicted
+    assert not first.path(a).exists()
+    assert second.has(b)
+    assert second.stats()['size'] == 6
+
+
+def zip_of(files) -> BytesIO:
+    data = BytesIO()
+    with ZipFile(data, 'w') as z:
+        for name, content in files.items():
+            z.writestr(name, content)
+    data.seek(0)
+    return data
+
+
+def test_tree_stored_by_other_worker(tmp_path):
+    first = BlobStore(tmp_path / 'store', 2**20)
+    second = BlobStore(tmp_path / 'store', 2**20)
+    digest = first.put_tree(zip_of({'input': '1 2\n'}))
+    assert second.put_tree(zip_of({'input': '1 2\n'})) == digest
+    dest = tmp_path / 'submission'
+    dest.mkdir()
+    second.link(digest, dest)
+    assert (dest / 'input').read_text() == '1 2\n'
+    assert not any(second.tmp_dir.iterdir())
+
+
+def test_add_tree_stored_meanwhile(tmp_path):
+    first = BlobStore(tmp_path / 'store', 2**20)
+    second = BlobStore(tmp_path / 'store', 2**20)
+    digest = first.put_tree(zip_of({'input': '1 2\n'}))
+    # extracted by the second one before it sees the first one's entry
+    tree = second.tmp_dir / 'tree'
+    tree.mkdir()
+    (tree / 'input').write_text('1 2\n')
+    second.add(digest, tree)
+    assert second.has(digest)
+    assert not tree.exists()
@@ -0,0 +1,47 @@
+import pytest
+from dispatcher.tuner import ConcurrencyTuner
+
+
+@pytest.fixture
+def tuner(monkeypatch):
+    tuner = ConcurrencyTuner(min_count=1, max_count=8)
+    monkeypatch.setattr(tuner, 'host_load', lambda: 0.5)
+    monkeypatch.setattr(tuner, 'free_memory', lambda: 2**20)
+    return tuner
+
+
+def test_increase_when_limit_is_used(tuner):
+    assert tuner.tune(4, 4) == 5
+    # not fully used
+    assert tuner.tune(4, 2) == 4
+    assert tuner.tune(8, 8) == 8
+
+
+def test_decrease_on_high_load(tuner, monkeypatch):
+    monkeypatch.setattr(tuner, 'host_load', lambda: 2.0)
+    assert tuner.tune(4, 4) == 2
+    assert tuner.tune(1, 1) == 1
+
+
+def test_decrease_on_low_memory(tuner, monkeypatch):
+    monkeypatch.setattr(tuner, 'free_memory', lambda: 1024)
+    assert tuner.tune(4, 4) == 2
+
+
+def test_decrease_on_slow_sandbox(tuner):
+    tuner.observe(0.1)
+    assert tuner.tune(4, 4) == 5
+    for _ in range(10):
+        tuner.observe(1.0)
+    assert tuner.tune(5, 5) == 2
+    # wait for new samples
+    assert tuner.tune(2, 2) == 3
+
+
+def test_best_overhead_decays(tuner):
+    tuner.observe(0.1)
+    # the system gets slower for good, not overloaded
+    for _ in range(200):
+        tuner.observe(0.5)
+    assert tuner.best_overhead == pytest.approx(0.5)
+    assert tuner.tune(4, 4) == 5
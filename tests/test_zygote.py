@@ -0,0 +1,64 @@
+import subprocess
+import sys
+import pytest
+import zygote
+
+
+@pytest.fixture
+def fifo(tmp_path):
+    fifo = str(tmp_path / 'zygote')
+    server = subprocess.Popen([sys.executable, *zygote.command(fifo)[1:]])
+    subprocess.run(['sh', '-c', zygote.wait_command(fifo)], check=True)
+    yield fifo
+    server.kill()
+    server.wait()
+
+
+def run(workdir, command):
+    return subprocess.run(
+        ['sh', '-c', command],
+        cwd=workdir,
+        capture_output=True,
+        timeout=10,
+    )
+
+
+def test_run_by_zygote(fifo, tmp_path):
+    workdir = tmp_path / 'sandbox'
+    workdir.mkdir()
+    (workdir / 'main.py').write_text('\n'.join([
+        'import sys',
+        'print(sum(map(int, input().split())))',
+        'print(__name__, sys.argv, file=sys.stderr)',
+        'sys.exit(3)',
+    ]))
+    (workdir / 'input').write_text('1 2\n')
+    res = run(workdir, zygote.client_command('input', fifo))
+    assert res.returncode == 3
+    assert res.stdout == b'3\n'
+    assert res.stderr == b"__main__ ['main.py']\n"
+    # zygote keeps serving
+    res = run(workdir, zygote.client_command('input', fifo))
+    assert res.stdout == b'3\n'
+
+
+def test_traceback(fifo, tmp_path):
+    (tmp_path / 'main.py').write_text('raise ValueError(1)\n')
+    res = run(tmp_path, zygote.client_command(None, fifo))
+    assert res.returncode == 1
+    # same as `python3 main.py`, frames of zygote are hidden
+    assert res.stderr.decode().splitlines() == [
+        'Traceback (most recent call last):',
+        '  File "main.py", line 1, in <module>',
+        '    raise ValueError(1)',
+        'ValueError: 1',
+    ]
+
+
+def test_fallback_without_zygote(tmp_path):
+    (tmp_path / 'main.py').write_text('print(input())\n')
+    (tmp_path / 'input').write_text('cold\n')
+    command = zygote.client_command('input', str(tmp_path / 'missing'))
+    res = run(tmp_path, command.replace('python3', sys.executable))
+    assert res.returncode == 0
+    assert res.stdout == b'cold\n'
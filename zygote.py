@@ -0,0 +1,143 @@
+'''
+warm python interpreter running as the main process of judger containers
+
+it imports common modules once, then waits for requests on a fifo. for
+each request it forks a child, which takes over stdio of the requesting
+process and runs `main.py` as `python3 main.py` would, so submissions
+don't pay for interpreter startup.
+
+this file is run inside the judger image by `python3 -c`, keep it
+standard library only.
+'''
+import os
+import sys
+import traceback
+import types
+
+# imported before forking, shared by children
+PRELOAD = (
+    'bisect',
+    'collections',
+    'datetime',
+    'decimal',
+    'fractions',
+    'functools',
+    'heapq',
+    'itertools',
+    'json',
+    'math',
+    'random',
+    're',
+    'string',
+)
+# request fifo inside container, it exists once the zygote is ready
+FIFO = '/tmp/zygote'
+
+
+def command(fifo=FIFO):
+    '''
+    container command starting the zygote
+    '''
+    with open(__file__) as f:
+        return ['python3', '-c', f.read(), fifo]
+
+
+def wait_command(fifo=FIFO, timeout=5):
+    '''
+    shell script waiting for the zygote to be ready, at most `timeout`
+    seconds
+    '''
+    return (f'i=0; while [ ! -p {fifo} ] && [ $i -lt {timeout * 20} ]; '
+            'do sleep 0.05; i=$((i + 1)); done')
+
+
+def client_command(stdin=None, fifo=FIFO):
+    '''
+    shell script running `main.py` by the zygote, with stdin redirected
+    from file `stdin` if given. it falls back to a new interpreter if the
+    zygote isn't ready, and exits with the program's exit code.
+    '''
+    redirect = f'exec < {stdin}; ' if stdin else ''
+    return (f'{redirect}[ -p {fifo} ] || exec python3 main.py; '
+            f'r={fifo}.$$; mkfifo $r; echo "$$ $r $PWD" > {fifo}; '
+            'read code < $r; rm -f $r; exit $code')
+
+
+def run(pid, cwd):
+    '''
+    run `main.py` in forked child, never returns
+    '''
+    # take over stdio of the requesting process
+    for fd in range(3):
+        flags = os.O_RDONLY if fd == 0 else os.O_WRONLY
+        target = os.open(f'/proc/{pid}/fd/{fd}', flags)
+        os.dup2(target, fd)
+        os.close(target)
+    os.chdir(cwd)
+    sys.argv = ['main.py']
+    sys.path[0] = cwd
+    main = types.ModuleType('__main__')
+    main.__file__ = 'main.py'
+    sys.modules['__main__'] = main
+    try:
+        with open('main.py', 'rb') as f:
+            code = compile(f.read(), 'main.py', 'exec')
+        exec(code, main.__dict__)
+    except SystemExit:
+        raise
+    except BaseException as e:
+        # hide frames of zygote, like the traceback `python3 main.py` prints
+        traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+        sys.exit(1)
+    # let interpreter exit normally, it waits for threads and flushes
+    # output
+    sys.exit(0)
+
+
+def handle(request):
+    pid, reply, cwd = request.split(' ', 2)
+    child = os.fork()
+    if child == 0:
+        try:
+            run(pid, cwd)
+        except SystemExit:
+            raise
+        except BaseException:
+            # never return to the serving loop
+            traceback.print_exc()
+            os._exit(1)
+    _, status = os.waitpid(child, 0)
+    if os.WIFEXITED(status):
+        code = os.WEXITSTATUS(status)
+    else:
+        code = 128 + os.WTERMSIG(status)
+    # client may be killed with the child, don't wait for a reader
+    fd = os.open(reply, os.O_WRONLY | os.O_NONBLOCK)
+    with open(fd, 'w') as f:
+        f.write(f'{code}\n')
+
+
+def serve(fifo=FIFO):
+    for name in PRELOAD:
+        try:
+            __import__(name)
+        except ImportError:
+            pass
+    os.mkfifo(fifo)
+    while True:
+        # blocks until a client writes, the fifo is closed before forking
+        # so children don't inherit it
+        with open(fifo) as f:
+            requests = f.read().splitlines()
+        for request in requests:
+            try:
+                handle(request)
+            except (OSError, ValueError) as e:
+                print(
+                    f'zygote: bad request {request!r}: {e!r}',
+                    file=sys.stderr,
+                )
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1] if len(sys.argv) > 1 else FIFO)